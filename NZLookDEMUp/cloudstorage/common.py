@@ -397,7 +397,13 @@ def local_run():
 
 
 def local_api_url():
-  """Return URL for GCS emulation on dev appserver."""
+  """Return URL for GCS emulation on dev appserver.
+
+  The GCS_API_URL environment variable overrides the dev appserver stub, e.g.
+  to use a stand-alone fake GCS server (see fakegcs.py).
+  """
+  if os.environ.get('GCS_API_URL'):
+    return os.environ['GCS_API_URL']
   return 'http://%s%s' % (os.environ.get('HTTP_HOST'), LOCAL_GCS_ENDPOINT)
 
 
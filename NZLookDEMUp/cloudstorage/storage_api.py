@@ -211,6 +211,7 @@ class ReadBuffer(object):
 
   DEFAULT_BUFFER_SIZE = 1024 * 1024
   MAX_REQUEST_SIZE = 30 * DEFAULT_BUFFER_SIZE
+  MAX_RANGES_PER_REQUEST = 64
 
   def __init__(self,
                api,
@@ -242,6 +243,7 @@ class ReadBuffer(object):
 
     self._buffer = _Buffer()
     self._etag = None
+    self._multirange = True
 
     get_future = self._get_segment(offset, self._buffer_size, check_response=False)
 
@@ -295,6 +297,7 @@ class ReadBuffer(object):
     self._file_size = state['size']
     self._offset = state['offset']
     self._buffer = _Buffer()
+    self._multirange = True
     self.closed = state['closed']
     self._buffer_future = None
     if self._remaining() and not self.closed:
@@ -488,6 +491,91 @@ class ReadBuffer(object):
       raise ndb.Return(content)
     raise ndb.Return(content, _checker)
 
+  def read_ranges(self, ranges):
+    """Read several byte ranges of the file.
+
+    Unlike read(), this does not use or move the current offset, so it can be
+    used for scattered random access without disturbing sequential reads.
+
+    Args:
+      ranges: a list of (start, size) tuples. Ranges should not overlap and
+        have to be within the range of the file.
+
+    Returns:
+      A list of str, the content of each range in the order given.
+
+    Raises:
+      IOError: When this buffer is closed.
+      ValueError: if the file has changed while reading.
+    """
+    self._check_open()
+    futures = []
+    for i in xrange(0, len(ranges), self.MAX_RANGES_PER_REQUEST):
+      futures.append(
+          self._get_ranges(ranges[i:i + self.MAX_RANGES_PER_REQUEST]))
+    result = []
+    for fut in futures:
+      result.extend(fut.get_result())
+    return result
+
+  @ndb.tasklet
+  def _get_ranges(self, ranges):
+    """Get several segments of the file from Google Storage.
+
+    Ranges are sent as one multi-range request (several byte ranges in one
+    Range header) while the server is known to support it. The response may
+    be a multipart/byteranges body, a single range or the whole object; any
+    range that is not covered by the response is fetched with its own
+    request. If the server answers a multi-range request with the whole
+    object, multi-range requests are not used again for this buffer.
+
+    Args:
+      ranges: a list of (start, size) tuples.
+
+    Yields:
+      A list of str, the content of each range in the order given.
+    """
+    if len(ranges) == 1 or not self._multirange:
+      segments = yield [self._get_segment(start, size)
+                        for start, size in ranges]
+      raise ndb.Return(segments)
+
+    headers = {'Range': 'bytes=' + ','.join(
+        '%d-%d' % (start, start + size - 1) for start, size in ranges)}
+    status, resp_headers, content = yield self._api.get_object_async(
+        self._path, headers=headers)
+    errors.check_status(status, [200, 206], self._path, headers,
+                        resp_headers, body=content)
+    self._check_etag(resp_headers.get('etag'))
+
+    if status == 200:
+      self._multirange = False
+      parts = [(0, content)]
+    elif resp_headers.get('content-type', '').startswith(
+        'multipart/byteranges'):
+      parts = _parse_multipart_byteranges(resp_headers['content-type'],
+                                          content)
+    else:
+      parts = [(_parse_content_range(resp_headers.get('content-range')),
+                content)]
+
+    segments = [None] * len(ranges)
+    missing = []
+    for i, (start, size) in enumerate(ranges):
+      for part_start, part_content in parts:
+        offset = start - part_start
+        if offset >= 0 and offset + size <= len(part_content):
+          segments[i] = part_content[offset:offset + size]
+          break
+      else:
+        missing.append(i)
+    if missing:
+      missing_segments = yield [self._get_segment(*ranges[i])
+                                for i in missing]
+      for i, segment in zip(missing, missing_segments):
+        segments[i] = segment
+    raise ndb.Return(segments)
+
   def _check_etag(self, etag):
     """Check if etag is the same across requests to GCS.
 
@@ -584,6 +672,60 @@ class ReadBuffer(object):
     return False
 
 
+def _parse_content_range(content_range):
+  """Returns the start offset from a 'bytes start-end/size' Content-Range."""
+  if not content_range:
+    return 0
+  return long(content_range.split()[-1].split('-', 1)[0])
+
+
+def _parse_multipart_byteranges(content_type, content):
+  """Split a multipart/byteranges response body into its parts.
+
+  Each part is located by its Content-Range header and read by length, so
+  part content that happens to contain the boundary is handled correctly.
+
+  Args:
+    content_type: value of the Content-Type response header, including
+      the boundary parameter.
+    content: the response body.
+
+  Returns:
+    A list of (start, content) tuples, one per part.
+
+  Raises:
+    ValueError: if the body is not a valid multipart/byteranges body.
+  """
+  boundary = None
+  for param in content_type.split(';')[1:]:
+    name, _, value = param.strip().partition('=')
+    if name.lower() == 'boundary':
+      boundary = value.strip('"')
+  if not boundary:
+    raise ValueError('No boundary in multipart/byteranges response.')
+
+  delimiter = '--' + boundary
+  parts = []
+  pos = content.find(delimiter)
+  while pos >= 0 and not content.startswith(delimiter + '--', pos):
+    header_end = content.find('\r\n\r\n', pos)
+    if header_end < 0:
+      raise ValueError('Truncated multipart/byteranges response.')
+    content_range = None
+    for line in content[pos:header_end].split('\r\n')[1:]:
+      name, _, value = line.partition(':')
+      if name.strip().lower() == 'content-range':
+        content_range = value.strip()
+    if content_range is None:
+      raise ValueError('Part without Content-Range in multipart response.')
+    first, last = content_range.split()[-1].split('/')[0].split('-')
+    start = header_end + 4
+    end = start + long(last) - long(first) + 1
+    parts.append((long(first), content[start:end]))
+    pos = content.find(delimiter, end)
+  return parts
+
+
 class _Buffer(object):
   """In memory buffer."""
 
@@ -20,7 +20,10 @@ Copyright (c) 2014-2016 Tet Woo Lee
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from demset import DEMSet
+from nztm2000 import NZTM2000
+from itertools import izip
 import math
+import numpy as np
 
 set0_E = 1012007.5 # central coordinate of top-left pixel in DEM set
 set0_N = 6233992.5
@@ -39,8 +42,55 @@ class HardLimits:
     Sets hard limits for interpolation algorithms.
     """
     max_line_steps = 1000 #: Max number of steps per line segment
-    max_path_steps = 10000 #: Max number of steps for a path
+    max_path_steps = 100000 #: Max number of steps for a path
     max_linedist_smart = 5000 #: Max line segment distance for smart interpolation algorithm (otherwise simple algorithm used) 
+    chunk_size = 4096 #: Number of points (or grid squares for smart algorithm) processed at a time by iter_ interpolators
+
+def ground_distances(Es, Ns):
+    """
+    Ground lengths of segments between consecutive points, i.e. NZTM2000 
+    grid lengths divided by point scale factor, integrated along each 
+    segment by Simpson's rule from scale factors at its ends and midpoint.
+    Scale factors of points outside the NZTM2000 projected bounds (the DEM
+    set extends about 10 km north of them) are taken at the nearest point 
+    within the bounds.
+
+    Arguments:
+
+        Es, Ns : arrays of floats
+            NZTM2000 coordinates of points
+
+    Return:
+        out : array
+            ground length (metres) of each segment, one fewer than points
+
+    """
+    Es = np.asarray(Es, float)
+    Ns = np.asarray(Ns, float)
+    dEs = np.diff(Es)
+    dNs = np.diff(Ns)
+    # Projected Bounds: 983515.7211, 4728776.8709, 2117458.3527, 6223676.2306
+    k_many = lambda Es, Ns: NZTM2000.NZTM_k_many(np.clip(Es, 983515, 2117459), np.clip(Ns, 4728776, 6223677))[0]
+    k = k_many(Es, Ns)
+    k_mid = k_many(Es[:-1] + 0.5*dEs, Ns[:-1] + 0.5*dNs)
+    return np.hypot(dEs, dNs) * (1.0/k[:-1] + 4.0/k_mid + 1.0/k[1:]) / 6.0
+
+def concatenate_chunks(chunks):
+    """
+    Concatenate chunks of points from an ``iter_`` interpolator.
+
+    Arguments:
+
+        chunks : iterable of (array,array,array) tuples
+            chunks of points as ``(E,N,elevation)`` arrays
+
+    Return:
+        out : (array,array,array) tuple
+            All points as ``(E,N,elevation)`` arrays.
+
+    """
+    chunks = list(chunks)
+    return tuple(np.concatenate([chunk[i] for chunk in chunks]) for i in range(3))
 
 def pairs(it):
     """
@@ -54,13 +104,16 @@ def pairs(it):
         yield prev, v
         prev = v
 
-def interpolate_path_bysamples(path, samples=11):
+def interpolate_path_bysamples(path, samples=11, interpolation='bilinear'):
     """
     Simple algorithm that returns a DEM profile along a path by simple 
     interpolation. Divides path into ``samples-1`` steps then interpolates 
     elevation at each step starting from first point in ``path`` and ending
     at last point in ``path``. Note the elevation for internal points in ``path``
     is not interpolated directly.
+
+    Samples are placed on legs of the path by searching cumulative leg lengths
+    and interpolated together with ``DEMSet.interpolate_DEMxy_many``.
     
     Does not catch exceptions from failed DEM lookups, so these will be 
     propagated to the caller.
@@ -68,69 +121,100 @@ def interpolate_path_bysamples(path, samples=11):
     Arguments:
         
         path : list of (float,float) tuples
-            list of NZTM2000 E,N coordinates
+            list of NZTM2000 E,N coordinates, at least 1 point (all samples 
+            are at a single point)
         samples : integer
             number of samples to interpolate from path
+        interpolation : string
+            method of interpolating DEM, one of ``DEMSet.interpolation_methods``
     
     Return:
-        out : list of (float,float,float) tuples
-            List of points in interpolated path as ``(E,N,elevation)`` 
-            tuples. ``E,N`` are NZTM coordinates of interpolated point and 
-            ``elevation`` is elevation of interpolated point above sea-level in
+        out : (array,array,array) tuple
+            Points in interpolated path as ``(E,N,elevation)`` arrays. 
+            ``E,N`` are NZTM coordinates of interpolated points and 
+            ``elevation`` is elevation of interpolated points above sea-level in
             metres.
 
     """
     samples = min(HardLimits.max_path_steps,samples)
+    return concatenate_chunks(iter_path_bysamples(path, samples, interpolation, chunk_size=samples))
+
+def iter_path_bysamples(path, samples=11, interpolation='bilinear', chunk_size=HardLimits.chunk_size, slope=False):
+    """
+    Streaming version of ``interpolate_path_bysamples``, which yields points 
+    in chunks of at most ``chunk_size`` samples and is not limited to 
+    ``HardLimits.max_path_steps`` samples.
+
+    Arguments:
+        
+        path : list of (float,float) tuples
+            list of NZTM2000 E,N coordinates, at least 1 point
+        samples : integer
+            number of samples to interpolate from path
+        interpolation : string
+            method of interpolating DEM, one of ``DEMSet.interpolation_methods``
+        chunk_size : integer
+            max number of samples in each chunk
+        slope : boolean
+            whether to also yield slope and aspect of points, see 
+            ``DEMSet.interpolate_slope_DEMxy_many``
+    
+    Return:
+        out : generator of (array,array,array) tuples
+            Chunks of points in interpolated path as ``(E,N,elevation)`` arrays,
+            or ``(E,N,elevation,slope,aspect)`` arrays if ``slope``.
+
+    """
     samples = max(samples,2)
+    if len(path) < 1: raise ValueError("path must contain at least 1 point")
+    if len(path) == 1: path = [path[0], path[0]] # single leg of no length
 
     # convert to x,y in DEM grid
-    path_xy = map(EN_to_xy,path)
+    path_E, path_N = np.asarray(path, float).T
+    path_x = (path_E-set0_E) / voxelE
+    path_y = (path_N-set0_N) / voxelN
     
     # calculate parameters for start of each leg
-    cumul_dxy = 0
-    legs = []
-    for ((x1,y1),(x2,y2)) in pairs(path_xy):
-        dx = x2 - x1
-        dy = y2 - y1
-        dxy = ( dx**2 + dy**2 ) ** 0.5
-        legs.append((x1,y1,dx,dy,dxy,cumul_dxy))
-        cumul_dxy += dxy
-        
-    # interpolate along path
-    stepxy = cumul_dxy / (samples-1)
-    leg = 0
-    track = []
-    for sample in range(samples):
-        if sample==0: # first sample = first coord in path
-            x,y = path_xy[0]
-            E,N = path[0]
-        elif sample==samples-1: # last sample = last coord in path
-            x,y = path_xy[-1]
-            E,N = path[-1]
+    leg_dx = np.diff(path_x)
+    leg_dy = np.diff(path_y)
+    leg_dxy = ( leg_dx**2 + leg_dy**2 ) ** 0.5
+    leg_cumul_dxy = np.concatenate(([0.0], np.cumsum(leg_dxy)))
+    stepxy = leg_cumul_dxy[-1] / (samples-1)
+
+    for chunk_start in xrange(0, samples, chunk_size):
+        # find leg of each sample, last leg starting at or before sample distance
+        sample = np.arange(chunk_start, min(chunk_start+chunk_size, samples))
+        sample_dxy = sample * stepxy # expected distance
+        leg = np.searchsorted(leg_cumul_dxy, sample_dxy, side='right') - 1
+        leg = np.clip(leg, 0, len(leg_dxy)-1)
+
+        # interpolate along legs
+        leg_fraction = sample_dxy - leg_cumul_dxy[leg]
+        nonzero_leg = leg_dxy[leg] > 0
+        leg_fraction[nonzero_leg] /= leg_dxy[leg][nonzero_leg]
+        leg_fraction[~nonzero_leg] = 0.0
+        x = path_x[leg] + leg_dx[leg]*leg_fraction
+        y = path_y[leg] + leg_dy[leg]*leg_fraction
+        E = x * voxelE + set0_E
+        N = y * voxelN + set0_N
+
+        # first and last samples = first and last coords in path
+        if sample[0] == 0:
+            x[0], y[0], E[0], N[0] = path_x[0], path_y[0], path_E[0], path_N[0]
+        if sample[-1] == samples-1:
+            x[-1], y[-1], E[-1], N[-1] = path_x[-1], path_y[-1], path_E[-1], path_N[-1]
+
+        if slope:
+            yield (E, N) + demset.interpolate_slope_DEMxy_many(x, y, interpolation)
         else:
-            # other sample, interpolate along path
-            sample_dxy = sample*stepxy # expected distance
-            while True:
-                # find correct leg to interpolate this point from
-                leg_x,leg_y,leg_dx,leg_dy,leg_dxy,leg_cumul_dxy = legs[leg]
-                if sample_dxy>=leg_cumul_dxy and \
-                   sample_dxy<=leg_cumul_dxy+leg_dxy: break
-                leg+=1
-            leg_fraction = (sample_dxy - leg_cumul_dxy) / leg_dxy
-            assert leg_fraction>=0.0 and leg_fraction<=1.0
-            x = leg_x + (leg_dx*leg_fraction)
-            y = leg_y + (leg_dy*leg_fraction)
-            E,N = xy_to_EN((x,y))
-        q = demset.interpolate_DEMxy(x, y)
-        track.append((E, N, q))
-    return track
-
-
-def interpolate_line_bysamples(E0, N0, E1, N1, samples=11):
+            yield E, N, demset.interpolate_DEMxy_many(x, y, interpolation)
+
+def interpolate_line_bysamples(E0, N0, E1, N1, samples=11, interpolation='bilinear'):
     """
     Simple algorithm that returns a DEM profile along a line by simple 
     interpolation. Algorithm will return a total of ``samples`` points 
     with elevation along the line segment, inclusive of ``x0,y0`` and ``x1,y1``.
+    All samples are interpolated together with ``DEMSet.interpolate_DEMxy_many``.
     
     Does not catch exceptions from failed DEM lookups, so these will be 
     propagated to the caller.
@@ -141,12 +225,14 @@ def interpolate_line_bysamples(E0, N0, E1, N1, samples=11):
             NZTM2000 coordinates of line to interpolate
         samples : integer
             number of samples to interpolate along line
+        interpolation : string
+            method of interpolating DEM, one of ``DEMSet.interpolation_methods``
     
     Return:
-        out : list of (float,float,float) tuples
-            List of points in interpolated path as ``(E,N,elevation)`` 
-            tuples. ``E,N`` are NZTM coordinates of interpolated point and 
-            ``elevation`` is elevation of interpolated point above sea-level in
+        out : (array,array,array) tuple
+            Points in interpolated path as ``(E,N,elevation)`` arrays. 
+            ``E,N`` are NZTM coordinates of interpolated points and 
+            ``elevation`` is elevation of interpolated points above sea-level in
             metres.
 
     """
@@ -154,39 +240,16 @@ def interpolate_line_bysamples(E0, N0, E1, N1, samples=11):
     samples = min(HardLimits.max_line_steps,samples)
     samples = max(samples,2)
 
-    # find starting and ending x/y coordinates
-    x0,y0 = EN_to_xy((E0,N0))
-    x1,y1 = EN_to_xy((E1,N1))
+    fraction = np.arange(samples) / float(samples-1)
+    return interpolate_line_fractions(E0, N0, E1, N1, fraction, interpolation)
 
-    # determine deltas
-    dx = x1-x0
-    dy = y1-y0
-
-    # interpolate
-    track = []
-    for sample in range(samples):
-        if sample==0: # first sample = first coord
-            x,y = x0,y0
-            E,N = E0,N0
-        elif sample==samples-1: # last sample = last coord
-            x,y = x1,y1
-            E,N = E1,N1
-        else:
-            fraction = float(sample)/(samples-1)
-            x = x0 + fraction*dx
-            y = y0 + fraction*dy
-            E,N = xy_to_EN((x,y))
-        q = demset.interpolate_DEMxy(x, y)
-        track.append((E, N, q))
-
-    return track
-
-def interpolate_line_bysteps(E0, N0, E1, N1, stepsize = 100.0):
+def interpolate_line_bysteps(E0, N0, E1, N1, stepsize = 100.0, interpolation='bilinear'):
     """
     Simple algorithm that returns a DEM profile along a line by simple 
     interpolation. Starts at ``x0, y0``, and moves toward ``x1, y1`` in 
     ``stepsize`` distances until reaching ``x1, y1``. Elevation at ``x0, y0``
     and ``x1, y1`` are always returned as first and last points, respectively.
+    All samples are interpolated together with ``DEMSet.interpolate_DEMxy_many``.
 
     Does not catch exceptions from failed DEM lookups, so these will be 
     propagated to the caller.
@@ -196,64 +259,120 @@ def interpolate_line_bysteps(E0, N0, E1, N1, stepsize = 100.0):
         E0, N0, E1, N1 : floats
             NZTM2000 coordinates of line to interpolate
         stepsize : float
-            size of each step (NZTM2000 metres) to interpolate along line
+            size of each step (ground metres, see ``ground_distances``) to
+            interpolate along line
+        interpolation : string
+            method of interpolating DEM, one of ``DEMSet.interpolation_methods``
     
     Return:
-        out : list of (float,float,float) tuples
-            List of points in interpolated path as ``(E,N,elevation)`` 
-            tuples. ``E,N`` are NZTM coordinates of interpolated point and 
-            ``elevation`` is elevation of interpolated point above sea-level in
+        out : (array,array,array) tuple
+            Points in interpolated path as ``(E,N,elevation)`` arrays. 
+            ``E,N`` are NZTM coordinates of interpolated points and 
+            ``elevation`` is elevation of interpolated points above sea-level in
             metres.
 
     """
 
+    # ensure stepsize does cause # samples to exceed limit
+    dNE = ground_distances((E0,E1), (N0,N1))[0]
+    stepsize = abs(stepsize) # negative stepsizes will cause infinite loop
+    stepsize = max(stepsize,dNE/HardLimits.max_line_steps)
+    return concatenate_chunks(iter_line_bysteps(E0, N0, E1, N1, stepsize, interpolation))
+
+def iter_line_bysteps(E0, N0, E1, N1, stepsize = 100.0, interpolation='bilinear', chunk_size=HardLimits.chunk_size, slope=False):
+    """
+    Streaming version of ``interpolate_line_bysteps``, which yields points 
+    in chunks of at most ``chunk_size`` steps and is not limited to 
+    ``HardLimits.max_line_steps`` steps.
+
+    Arguments:
+        
+        E0, N0, E1, N1 : floats
+            NZTM2000 coordinates of line to interpolate
+        stepsize : float
+            size of each step (ground metres, see ``ground_distances``) to
+            interpolate along line
+        interpolation : string
+            method of interpolating DEM, one of ``DEMSet.interpolation_methods``
+        chunk_size : integer
+            max number of steps in each chunk
+        slope : boolean
+            whether to also yield slope and aspect of points, see 
+            ``DEMSet.interpolate_slope_DEMxy_many``
+    
+    Return:
+        out : generator of (array,array,array) tuples
+            Chunks of points in interpolated path as ``(E,N,elevation)`` arrays,
+            or ``(E,N,elevation,slope,aspect)`` arrays if ``slope``.
+
+    """
+
+    # determine ground distance, steps are then evenly spaced in grid 
+    # distance, so spacing varies with the point scale factor along the line
+    # (by <0.1% for lines up to 50 km)
+    dNE = ground_distances((E0,E1), (N0,N1))[0]
+
+    stepsize = abs(stepsize)
+    if stepsize == 0.0 and dNE > 0.0: raise ValueError("stepsize must be non-zero")
+
+    # sample every stepsize from start, always ending at last coord
+    steps = int(math.ceil(dNE/stepsize)) if dNE > 0.0 else 1
+    for chunk_start in xrange(0, steps, chunk_size):
+        step = np.arange(chunk_start, min(chunk_start+chunk_size, steps))
+        sample_dNE = step[step > 0] * stepsize
+        sample_dNE = sample_dNE[sample_dNE < dNE] # guard against rounding
+        fraction = sample_dNE/dNE
+        if chunk_start == 0: fraction = np.concatenate(([0.0], fraction))
+        if chunk_start+chunk_size >= steps: fraction = np.concatenate((fraction, [1.0]))
+        yield interpolate_line_fractions(E0, N0, E1, N1, fraction, interpolation, slope)
+
+def interpolate_line_fractions(E0, N0, E1, N1, fraction, interpolation='bilinear', slope=False):
+    """
+    Interpolate DEM profile at points along a line, given as fractions of the
+    line length. Fractions of ``0.0`` and ``1.0`` give exactly the first and
+    last coordinates of the line.
+
+    Arguments:
+        
+        E0, N0, E1, N1 : floats
+            NZTM2000 coordinates of line to interpolate
+        fraction : array of floats
+            fractions along line to interpolate at
+        interpolation : string
+            method of interpolating DEM, one of ``DEMSet.interpolation_methods``
+        slope : boolean
+            whether to also return slope and aspect of points, see 
+            ``DEMSet.interpolate_slope_DEMxy_many``
+
+    Return:
+        out : (array,array,array) tuple
+            Points in interpolated path as ``(E,N,elevation)`` arrays,
+            or ``(E,N,elevation,slope,aspect)`` arrays if ``slope``.
+
+    """
+
     # find starting and ending x/y coordinates
-    print E0,N0
-    print E1,N1
     x0,y0 = EN_to_xy((E0,N0))
     x1,y1 = EN_to_xy((E1,N1))
 
     # determine deltas
-    dE = E1-E0
-    dN = N1-N0
-    dNE = ( dE**2 + dN**2) ** 0.5
     dx = x1-x0
     dy = y1-y0
-    dxy = ( dx**2 + dy**2 ) ** 0.5
-    
-    # determine point scale factor
-    # unnecessary to be this precise
-    #k = NZTM2000.NZTM_k(E0,N0)
-    #dNE*=k # multiply distance by point scale
-    
-    # ensure stepsize does cause # samples to exceed limit
-    stepsize = abs(stepsize) # negative stepsizes will cause infinite loop
-    stepsize = max(stepsize,dxy/HardLimits.max_line_steps)
 
     # interpolate
-    track = []
-    sample_dNE = 0.0
-    done = False
-    while not done:
-        print sample_dNE,dNE
-        if sample_dNE==0.0: # first sample = first coord
-            x,y = x0,y0
-            E,N = E0,N0
-        else:
-            fraction = sample_dNE/dNE
-            if fraction>=1.0: # exceeded total distance, i.e last sample = last coord
-                x,y = x1,y1
-                E,N = E1,N1
-                done = True
-            else:
-                x = x0 + fraction*dx
-                y = y0 + fraction*dy
-                E,N = xy_to_EN((x,y))
-        q = demset.interpolate_DEMxy(x, y)
-        track.append((E, N, q))
-        sample_dNE += stepsize
- 
-    return track
+    x = x0 + fraction*dx
+    y = y0 + fraction*dy
+    E = x * voxelE + set0_E
+    N = y * voxelN + set0_N
+
+    # exact first and last coords
+    first = fraction == 0.0
+    last = fraction == 1.0
+    x[first], y[first], E[first], N[first] = x0, y0, E0, N0
+    x[last], y[last], E[last], N[last] = x1, y1, E1, N1
+
+    if slope: return (E, N) + demset.interpolate_slope_DEMxy_many(x, y, interpolation)
+    return E, N, demset.interpolate_DEMxy_many(x, y, interpolation)
 
 def get_interpolation_vertex(x1, y1, dx, dy, q00, q10, q01, q11):
     """
@@ -310,6 +429,59 @@ def get_interpolation_vertex(x1, y1, dx, dy, q00, q10, q01, q11):
     if x < 0 or y < 0 or x > 1.0 or y > 1.0: return None # not within bounds
     return x, y, maxmin, a < 0
 
+def get_interpolation_vertices(x1, y1, dx, dy, q00, q10, q01, q11):
+    """
+    Array version of ``get_interpolation_vertex``, for many lines.
+
+    Arguments:
+        
+        x1, y1, dx, dy : arrays of floats
+            parameters of each line
+        q00, q10, q01, q11 : arrays of floats
+            values defined at coordinates ``0, 0``; ``1, 0``; ``0, 1``  and 
+            ``1, 0`` for each line
+    
+    Return:
+    
+        out : (array,array,array) tuple
+            Returns ``x, y, maxmin`` arrays for vertices of each line, as in 
+            ``get_interpolation_vertex``. Values are ``nan`` for lines
+            without a vertex in the range [``0, 0`` to ``1, 1``].
+
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q_sum = q00 - q10 - q01 + q11
+
+        # y = mx + y0
+        m = dy / dx
+        y0 = y1-m * x1
+        a_m = q_sum * m
+        b_m = (-q00 + q01) * m + q_sum * y0 + (-q00 + q10)
+        c_m = q00 - q00 * y0 + q01 * y0
+        x_m = -b_m / (2 * a_m)
+        y_m = m * x_m + y0
+
+        # x = ny + x0
+        n = dx / dy
+        x0 = x1-n * y1
+        a_n = q_sum * n
+        b_n = (-q00 + q10) * n + q_sum * x0 + (-q00 + q01)
+        c_n = q00 - q00 * x0 + q10 * x0
+        y_n = -b_n / (2 * a_n)
+        x_n = n * y_n + x0
+
+        use_m = np.abs(dx) >= np.abs(dy) # chose a formula depending on relative dx/dy, to avoid divide by 0
+        a = np.where(use_m, a_m, a_n)
+        b = np.where(use_m, b_m, b_n)
+        c = np.where(use_m, c_m, c_n)
+        x = np.where(use_m, x_m, x_n)
+        y = np.where(use_m, y_m, y_n)
+        maxmin = (4 * a * c-b * b) / (4 * a)
+        # no vertex if q is flat or not within bounds
+        no_vertex = (a == 0.0) | ~((x >= 0) & (y >= 0) & (x <= 1.0) & (y <= 1.0))
+    x[no_vertex] = y[no_vertex] = maxmin[no_vertex] = float('nan')
+    return x, y, maxmin
+
 def interpolate_line_smart(E0, N0, E1, N1, min_grade_delta=0.01, force_minmax=True):
     """
     Given a continuous line that passes through a discrete DEM image, will
@@ -346,6 +518,10 @@ def interpolate_line_smart(E0, N0, E1, N1, min_grade_delta=0.01, force_minmax=Tr
            information in the line. Maximum/minimum points on the line (where 
            grade sign changes) will always be kept if ``force_minmax`` is ``True``.
            
+    Steps 1) to 5) are calculated for all grid squares crossed by the line
+    together, with DEM points for all squares looked up in one batch. Only
+    filtering in 6) is done point-by-point, by ``simplify_line_bygrade``.
+
     Does not catch exceptions from failed DEM lookups, so these will be 
     propagated to the caller. If length of line is more than hard limit, by steps
     algorithm will be used instead.
@@ -362,10 +538,10 @@ def interpolate_line_smart(E0, N0, E1, N1, min_grade_delta=0.01, force_minmax=Tr
           whether to force min/max points on line to be kept regardless of grade_delta
 
     Return:
-        out : list of (float,float,float) tuples
-            List of points in interpolated path as ``(E,N,elevation)`` 
-            tuples. ``E,N`` are NZTM coordinates of interpolated point and 
-            ``elevation`` is elevation of interpolated point above sea-level in
+        out : (array,array,array) tuple
+            Points in interpolated path as ``(E,N,elevation)`` arrays. 
+            ``E,N`` are NZTM coordinates of interpolated points and 
+            ``elevation`` is elevation of interpolated points above sea-level in
             metres.
  
     """
@@ -386,194 +562,785 @@ def interpolate_line_smart(E0, N0, E1, N1, min_grade_delta=0.01, force_minmax=Tr
         # use simple algorithm
         return interpolate_line_bysteps(E0, N0, E1, N1)
 
-    #start at point 0
-    x = x0
-    y = y0
+    return concatenate_chunks(iter_line_smart(E0, N0, E1, N1, min_grade_delta, force_minmax))
+
+def iter_line_smart(E0, N0, E1, N1, min_grade_delta=0.01, force_minmax=True, chunk_size=HardLimits.chunk_size):
+    """
+    Streaming version of ``interpolate_line_smart``, which yields points 
+    in chunks, processing at most ``chunk_size`` grid squares at a time, and 
+    is not limited to ``HardLimits.max_linedist_smart``.
+
+    Arguments:
+
+        E0, N0, E1, N1 : floats
+          NZTM2000 coordinates of line to interpolate
+        min_grade_delta : float
+          min delta between two grade segments to keep segments separate
+        force_minmax : boolean
+          whether to force min/max points on line to be kept regardless of grade_delta
+        chunk_size : integer
+          max number of grid squares processed for each chunk
+
+    Return:
+        out : generator of (array,array,array) tuples
+            Chunks of points in interpolated path as ``(E,N,elevation)`` arrays. 
+
+    """
+    for E, N, q, path_index in iter_path_smart([(E0, N0), (E1, N1)], min_grade_delta, force_minmax, chunk_size):
+        yield E, N, q
+
+def iter_path_smart(path, min_grade_delta=0.01, force_minmax=True, chunk_size=HardLimits.chunk_size, slope=False):
+    """
+    Smart interpolation of a path, as ``interpolate_line_smart`` for each line
+    segment (leg) of the path, but processing all legs together. Grid squares
+    of consecutive legs are traversed and looked up together, and grade
+    simplification continues from one leg to the next, always keeping the 
+    points of ``path``. Yields points in chunks, processing at most 
+    ``chunk_size`` grid squares at a time. Vertices are found on the bilinear
+    surface, so the profile is always bilinearly interpolated.
+
+    Does not catch exceptions from failed DEM lookups, so these will be 
+    propagated to the caller.
+
+    Arguments:
+
+        path : list of (float,float) tuples
+          list of NZTM2000 E,N coordinates, at least 2 points
+        min_grade_delta : float
+          min delta between two grade segments to keep segments separate
+        force_minmax : boolean
+          whether to force min/max points on line to be kept regardless of grade_delta
+        chunk_size : integer
+          max number of grid squares processed for each chunk
+        slope : boolean
+          whether to also yield slope and aspect of points, see 
+          ``DEMSet.interpolate_slope_DEMxy_many``
+
+    Return:
+        out : generator of (array,array,array,array) tuples
+            Chunks of points in interpolated path as ``(E,N,elevation,path_index)``
+            arrays, or ``(E,N,elevation,path_index,slope,aspect)`` arrays if 
+            ``slope``. ``path_index`` is the index of the point in ``path``, or 
+            ``-1`` for interpolated points.
+
+    """
+    if len(path) < 2: raise ValueError("path must contain at least 2 points")
+
+    # convert to x,y in DEM grid
+    path_E, path_N = np.asarray(path, float).T
+    path_x = (path_E-set0_E) / voxelE
+    path_y = (path_N-set0_N) / voxelN
+
+    simplifier = GradeSimplifier(path_x[0], path_y[0], min_grade_delta, force_minmax)
+    for points in iter_path_points(path_x, path_y, chunk_size):
+        xs, ys, qs, path_indices = simplifier.add(*points)
+        if len(xs): yield simplified_chunk(xs, ys, qs, path_indices, slope)
+    yield simplified_chunk(*simplifier.finish(), slope=slope)
+
+def iter_path_points(path_x, path_y, chunk_size=HardLimits.chunk_size):
+    """
+    Find all points along a path for ``iter_path_smart`` before 
+    simplification, i.e. first point, points entering each grid square, 
+    vertices within squares and last point of each leg, and their 
+    interpolated ``q``. The first point of each leg after the first is the 
+    last point of the leg before, so is not repeated.
+
+    Arguments:
+
+        path_x, path_y : arrays of floats
+          x, y coordinates of path in DEM grid, at least 2 points
+        chunk_size : integer
+          max number of grid squares processed for each chunk
+
+    Return:
+        out : generator of (array,array,array,array,array) tuples
+            Chunks of points as ``(x,y,q,path_index,repeat)`` arrays. 
+            ``path_index`` is the index of the point in path, or ``-1`` for
+            interpolated points. ``repeat`` is ``True`` for last points of 
+            legs that must be repeated (when reached before jumping to last 
+            point, e.g. if point0 == point1).
+
+    """
+
+    # find parameters of each leg
+    leg_x0, leg_y0 = path_x[:-1], path_y[:-1]
+    leg_x1, leg_y1 = path_x[1:], path_y[1:]
+
+    # find deltas
+    leg_dx = leg_x1-leg_x0
+    leg_dy = leg_y1-leg_y0
+    leg_abs_dx = np.abs(leg_dx)
+    leg_abs_dy = np.abs(leg_dy)
 
     # define 1 unit change with direction
-    dx1 = +1 if dx >= 0 else -1
-    dy1 = +1 if dy >= 0 else -1
-
-    # find numbers to add to floor to give minus and plus points surrounding current point
-    xm = + 1 if dx < 0 else 0 # if x is decreasing, 'minus' point is ahead of current point (floor+1), else behind (floor+0)
-    ym = + 1 if dy < 0 else 0
-    xp = + 1 if dx >= 0 else 0 # if x is increasing, 'plus' point is ahead of current point (floor+1), else behind (floor+0)
-    yp = + 1 if dy >= 0 else 0
-
-    # find surrounding whole points for first point
-    x_int_m = int(x // 1) + xm
-    x_int_p = int(x // 1) + xp
-    y_int_m = int(y // 1) + ym
-    y_int_p = int(y // 1) + yp
-
-    # find terminating whole points
-    x1_int_m = int(x1 // 1) + xm
-    y1_int_m = int(y1 // 1) + ym
-
-    #print x0,",", y0,"to", x1,",", y1
-    #print "delta", dx, dy
-
-    # lookup q values of surrounding points
-    qmm = demset.get_value(x_int_m, y_int_m)
-    qpm = demset.get_value(x_int_p, y_int_m)
-    qmp = demset.get_value(x_int_m, y_int_p)
-    qpp = demset.get_value(x_int_p, y_int_p)
-
-    # determine deltas for interpolation
-    dxm = abs(x - x_int_m)
-    dxp = abs(x_int_p - x)
-    dym = abs(y - y_int_m)
-    dyp = abs(y_int_p - y)
-
-    # interpolate first point
-    q = qmm * dxp * dyp + qpm * dxm * dyp + qmp * dxp * dym + qpp * dxm * dym
-
-    # track to produce with interpolated q values
-    track = []
-
-    # variables updated in script
-    q_m1 = dist_m1 = None # minus 1 values (penultimate)
-    q_0 = dist_0 = grade_0 = None # zero/last values
-    grade = d_q = d_dist = None # current values
-
-    check_vertex = True # True if should check if vertex is present
-
-    index = 0 # index of interpolated point
-
-    while True:
-        expect_q = qmm * dxp * dyp + qpm * dxm * dyp + qmp * dxp * dym + qpp * dxm * dym
-        #print x, y
-        assert abs(q-expect_q) < 1e-10, "{} vs {}".format(q, expect_q)
-        dist = ((voxelE * (x-x0)) ** 2 + (voxelN * (y-y0)) ** 2) ** 0.5 # calculate distance in map units
-        if q_0 is not None: # if last point is present
-            d_q = q-q_0 # find deltas to last
-            d_dist = dist-dist_0
-            grade = d_q / d_dist
-
-            # strategy: always add new point to track,
-            # but remove last from track if it is redundant
-
-            # should we add a new point to track?
-            if (grade_0 is None or # not enough previous points, must keep point
-                (force_minmax and grade * grade_0 < 0) or # grade sign change, always keep last point
-                abs(grade-grade_0) >= min_grade_delta): # grade delta more than cutoff
-                # yes, add current point to track
-                q_m1 = q_0 # push zero to -1
-                dist_m1 = dist_0
+    leg_dx1 = np.where(leg_dx >= 0, 1, -1)
+    leg_dy1 = np.where(leg_dy >= 0, 1, -1)
+
+    # find numbers to add to floor to give minus point surrounding current point
+    # if x is decreasing, 'minus' point is ahead of current point (floor+1), else behind (floor+0)
+    leg_xm = (leg_dx < 0).astype(np.int64)
+    leg_ym = (leg_dy < 0).astype(np.int64)
+
+    # find surrounding whole 'minus' points for first point and terminating whole points
+    leg_x_int_m0 = np.floor(leg_x0).astype(np.int64) + leg_xm
+    leg_y_int_m0 = np.floor(leg_y0).astype(np.int64) + leg_ym
+    leg_x1_int_m = np.floor(leg_x1).astype(np.int64) + leg_xm
+    leg_y1_int_m = np.floor(leg_y1).astype(np.int64) + leg_ym
+
+    # number of whole x and y points crossed by each leg, each crossing moves 
+    # along one whole point in x or y direction
+    leg_n_cross_x = (leg_x1_int_m-leg_x_int_m0) * leg_dx1
+    leg_n_cross_y = (leg_y1_int_m-leg_y_int_m0) * leg_dy1
+    leg_cumul_squares = np.cumsum(1 + leg_n_cross_x + leg_n_cross_y)
+    n_legs = len(leg_x0)
+
+    # current leg, crossings processed in this leg, current grid square and 
+    # point entering it (if part of leg already processed)
+    leg = 0
+    i_cross_x = i_cross_y = 0
+    x_int_m = y_int_m = None
+    x_enter = y_enter = q_enter = None
+
+    while leg < n_legs:
+        # process current leg and following legs that fit in chunk,
+        # or next chunk_size crossings of current leg if it does not fit
+        squares_done = leg_cumul_squares[leg-1] if leg > 0 else 0
+        squares_done += i_cross_x + i_cross_y
+        n_batch = np.searchsorted(leg_cumul_squares, squares_done + chunk_size, side='right') - leg
+        n_batch = max(n_batch, 1)
+        b = slice(leg, leg + n_batch)
+        x0, y0, x1, y1 = leg_x0[b], leg_y0[b], leg_x1[b], leg_y1[b]
+        dx, dy, dx1, dy1 = leg_dx[b], leg_dy[b], leg_dx1[b], leg_dy1[b]
+
+        # find next crossings of each leg, in order along leg
+        # (Amanatides & Woo traversal), x crossing first if both at same point
+        start_x = np.zeros(n_batch, np.int64)
+        start_y = np.zeros(n_batch, np.int64)
+        start_x[0] = i_cross_x
+        start_y[0] = i_cross_y
+        n_x = np.minimum(leg_n_cross_x[b] - start_x, chunk_size)
+        n_y = np.minimum(leg_n_cross_y[b] - start_y, chunk_size)
+        cross_leg = np.concatenate((np.repeat(np.arange(n_batch), n_x), np.repeat(np.arange(n_batch), n_y)))
+        cross_is_x = np.arange(len(cross_leg)) < n_x.sum()
+        cross_i = (np.arange(len(cross_leg)) + 1 -
+                   np.concatenate((np.repeat(np.cumsum(n_x) - n_x, n_x), np.repeat(n_x.sum() + np.cumsum(n_y) - n_y, n_y))) +
+                   np.where(cross_is_x, start_x[cross_leg], start_y[cross_leg]))
+        cross_int = np.where(cross_is_x, 
+                             leg_x_int_m0[b][cross_leg] + dx1[cross_leg] * cross_i, 
+                             leg_y_int_m0[b][cross_leg] + dy1[cross_leg] * cross_i)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cross_t = np.where(cross_is_x, 
+                               (cross_int-x0[cross_leg]) / dx[cross_leg],
+                               (cross_int-y0[cross_leg]) / dy[cross_leg])
+        order = np.lexsort((~cross_is_x, cross_t, cross_leg))[:chunk_size]
+        cross_leg, cross_is_x, cross_int = cross_leg[order], cross_is_x[order], cross_int[order]
+        n_cross_x = np.bincount(cross_leg[cross_is_x], minlength=n_batch)
+        n_cross_y = np.bincount(cross_leg[~cross_is_x], minlength=n_batch)
+        leg_done = ((start_x + n_cross_x == leg_n_cross_x[b]) & 
+                    (start_y + n_cross_y == leg_n_cross_y[b]))
+
+        # grid squares entered, current square of each leg followed by square
+        # entered at each crossing
+        n_squares = 1 + n_cross_x + n_cross_y
+        first_square = np.cumsum(n_squares) - n_squares
+        last_square = first_square + n_squares - 1
+        square_leg = np.repeat(np.arange(n_batch), n_squares)
+        is_cross = np.ones(len(square_leg), bool)
+        is_cross[first_square] = False
+        is_x = np.zeros(len(square_leg), bool)
+        is_x[is_cross] = cross_is_x
+        is_y = is_cross & ~is_x
+        cross_leg = square_leg[is_cross]
+
+        # whole 'minus' and 'plus' points of each grid square
+        x_int_m0 = leg_x_int_m0[b].copy()
+        y_int_m0 = leg_y_int_m0[b].copy()
+        if x_int_m is not None:
+            x_int_m0[0] = x_int_m
+            y_int_m0[0] = y_int_m
+        count_x = np.cumsum(is_x)
+        count_y = np.cumsum(is_y)
+        x_int_ms = x_int_m0[square_leg] + dx1[square_leg] * (count_x - count_x[first_square][square_leg])
+        y_int_ms = y_int_m0[square_leg] + dy1[square_leg] * (count_y - count_y[first_square][square_leg])
+        x_int_ps = x_int_ms + dx1[square_leg]
+        y_int_ps = y_int_ms + dy1[square_leg]
+
+        # lookup q values of surrounding points for all squares
+        n = len(square_leg)
+        q_corners = demset.get_values(np.concatenate((x_int_ms, x_int_ps, x_int_ms, x_int_ps)),
+                                      np.concatenate((y_int_ms, y_int_ms, y_int_ps, y_int_ps)))
+        qmm, qpm, qmp, qpp = q_corners.reshape(4, n)
+
+        # points where line enters each square, i.e. first point or whole x/y
+        # crossing, and interpolate q at these
+        x = np.empty(n)
+        y = np.empty(n)
+        x[first_square] = x0
+        y[first_square] = y0
+        if x_enter is not None:
+            x[0] = x_enter
+            y[0] = y_enter
+        cross_x = cross_int[cross_is_x]
+        cross_y = cross_int[~cross_is_x]
+        x_leg, y_leg = cross_leg[cross_is_x], cross_leg[~cross_is_x]
+        x[is_x] = cross_x # start at whole x location
+        y[is_x] = y0[x_leg] + (cross_x-x0[x_leg]) / dx[x_leg] * dy[x_leg] # determine y at this whole x
+        y[is_y] = cross_y # start at whole y location
+        x[is_y] = x0[y_leg] + (cross_y-y0[y_leg]) / dy[y_leg] * dx[y_leg] # determine x at this whole y
+        dxm = np.abs(x - x_int_ms)
+        dxp = np.abs(x_int_ps - x)
+        dym = np.abs(y - y_int_ms)
+        dyp = np.abs(y_int_ps - y)
+        q = qmm * dxp * dyp + qpm * dxm * dyp + qmp * dxp * dym + qpp * dxm * dym
+        if q_enter is not None: q[0] = q_enter
+        q[is_x] = qmm[is_x] * dyp[is_x] + qmp[is_x] * dym[is_x] # interpolate y at whole x point
+        q[is_y] = qmm[is_y] * dxp[is_y] + qpm[is_y] * dxm[is_y] # interpolate x at whole y point
+
+        # vertex is a point on the line than may give a maximum or minimum value of
+        # q in the linear interpolation algorithm, look for one in each square
+        # vertex finding algorithm assumes x, y are defined in terms of
+        # 0, 1 coordinates of qmm-qpp, will return correct values if
+        # given absolute x, y, dx, dy values, if q values
+        # defined in line direction (i.e. qmm closest to origin of line)
+        vertex_x, vertex_y, vertex_q = get_interpolation_vertices(dxm, dym, 
+            leg_abs_dx[b][square_leg], leg_abs_dy[b][square_leg], qmm, qpm, qmp, qpp)
+        vertex_x = x_int_ms + np.copysign(vertex_x, dx[square_leg]) # calculate x, y in image scale
+        vertex_y = y_int_ms + np.copysign(vertex_y, dy[square_leg])
+
+        # check if vertex is within line bounds (may be less than 0-1 bounds of
+        # qmm-qpp, if out of bounds, skip processing vertex
+        with np.errstate(invalid='ignore'):
+            has_vertex = (~np.isnan(vertex_q) &
+                          (vertex_x >= np.minimum(x0, x1)[square_leg]) & (vertex_x <= np.maximum(x0, x1)[square_leg]) &
+                          (vertex_y >= np.minimum(y0, y1)[square_leg]) & (vertex_y <= np.maximum(y0, y1)[square_leg]))
+
+        # jump to exact endpoint from terminating square of each leg
+        # only used if leg is done
+        x_int_m1, x_int_p1 = x_int_ms[last_square], x_int_ps[last_square]
+        y_int_m1, y_int_p1 = y_int_ms[last_square], y_int_ps[last_square]
+        q_end = (qmm[last_square] * np.abs(x_int_p1 - x1) * np.abs(y_int_p1 - y1) + 
+                 qpm[last_square] * np.abs(x1 - x_int_m1) * np.abs(y_int_p1 - y1) + 
+                 qmp[last_square] * np.abs(x_int_p1 - x1) * np.abs(y1 - y_int_m1) + 
+                 qpp[last_square] * np.abs(x1 - x_int_m1) * np.abs(y1 - y_int_m1))
+
+        # points along path are point entering each square followed by any 
+        # vertex in that square, then endpoint of each leg 
+        # slots for points of each square, leaving a slot after squares of each leg
+        square_slot = 2 * np.arange(n) + square_leg
+        end_slot = 2 * last_square + 2 + np.arange(n_batch)
+        n_slots = 2 * n + n_batch
+        point_x, point_y, point_q = np.empty(n_slots), np.empty(n_slots), np.empty(n_slots)
+        point_leg = np.empty(n_slots, np.int64)
+        point_used = np.zeros(n_slots, bool)
+        point_is_end = np.zeros(n_slots, bool)
+        point_x[square_slot], point_y[square_slot], point_q[square_slot] = x, y, q
+        point_x[square_slot+1], point_y[square_slot+1], point_q[square_slot+1] = vertex_x, vertex_y, vertex_q
+        point_x[end_slot], point_y[end_slot], point_q[end_slot] = x1, y1, q_end
+        point_leg[square_slot] = point_leg[square_slot+1] = square_leg
+        point_leg[end_slot] = np.arange(n_batch)
+        point_used[square_slot] = True
+        point_used[square_slot+1] = has_vertex
+        point_used[end_slot] = leg_done
+        point_is_end[end_slot] = True
+        # first point of each leg is last point of leg before, except first point of path,
+        # and current square of leg was processed in last chunk
+        if leg > 0 or x_enter is not None: point_used[square_slot[0]] = False
+        point_used[square_slot[first_square[1:]]] = False
+        if x_enter is not None: point_used[square_slot[0]+1] = False
+
+        # leg stops at first point reaching end point, if this is not the 
+        # jump to the endpoint (e.g. if point0 == point1) end point must be repeated
+        point_reached_end = point_used & (point_x == x1[point_leg]) & (point_y == y1[point_leg])
+        if leg == 0 and x_enter is None: point_reached_end[0] = False # first point of path
+        reached_end = np.nonzero(point_reached_end)[0]
+        reached_end_leg, first_reached = np.unique(point_leg[reached_end], return_index=True)
+        reached_end = reached_end[first_reached]
+        leg_end = end_slot.copy()
+        leg_end[reached_end_leg] = reached_end
+        leg_done[reached_end_leg] = True
+        point_used &= np.arange(n_slots) <= leg_end[point_leg]
+
+        point_path_index = np.empty(n_slots, np.int64)
+        point_path_index.fill(-1)
+        point_path_index[leg_end[leg_done]] = leg + np.arange(n_batch)[leg_done] + 1
+        if leg == 0 and x_enter is None: point_path_index[0] = 0
+        point_repeat = np.zeros(n_slots, bool)
+        point_repeat[leg_end[leg_done]] = ~point_is_end[leg_end[leg_done]]
+        yield (point_x[point_used], point_y[point_used], point_q[point_used], 
+               point_path_index[point_used], point_repeat[point_used])
+
+        if leg_done[-1]:
+            leg += n_batch
+            i_cross_x = i_cross_y = 0
+            x_int_m = y_int_m = None
+            x_enter = y_enter = q_enter = None
+        else:
+            # part of leg done, only possible if single leg in chunk
+            i_cross_x += n_cross_x[0]
+            i_cross_y += n_cross_y[0]
+            x_int_m, y_int_m = x_int_ms[-1], y_int_ms[-1]
+            x_enter, y_enter, q_enter = x[-1], y[-1], q[-1]
+
+class GradeSimplifier:
+    """
+    Simplify interpolated points along a path by grade, as in step 6) of
+    ``interpolate_line_smart``. A point is replaced by the next point if the 
+    grade from the point before to the next point differs by less than 
+    ``min_grade_delta``, unless this is a maximum/minimum point and 
+    ``force_minmax`` is ``True``. Points of the path itself are always kept, 
+    and points repeating the position of the last point replace it.
+
+    Points are added in chunks. As the last point kept may still be replaced,
+    ``add`` returns points kept before it, and ``finish`` returns the last point.
+    """
+
+    def __init__(self, x0, y0, min_grade_delta=0.01, force_minmax=True):
+        """
+        Arguments:
+
+            x0, y0 : floats
+              x, y coordinates of start of path, which distances are measured from
+            min_grade_delta : float
+              min delta between two grade segments to keep segments separate
+            force_minmax : boolean
+              whether to force min/max points on line to be kept regardless of grade_delta
+
+        """
+        self.x0 = x0
+        self.y0 = y0
+        self.min_grade_delta = min_grade_delta
+        self.force_minmax = force_minmax
+
+        self.q_m1 = self.dist_m1 = None # minus 1 values (penultimate)
+        self.q_0 = self.dist_0 = self.grade_0 = None # zero/last values
+        self.last = None # last point in track, as (x,y,q,path_index) tuple
+        self.last_fixed = False # True if last point is point of path and must be kept
+
+    def add(self, xs, ys, qs, path_indices, repeats):
+        """
+        Add interpolated points along path, in order.
+
+        xs, ys, qs : arrays of floats
+        path_indices : array of integers, index of point in path or ``-1``
+        repeats : array of booleans, ``True`` if point of path must be repeated
+
+        Returns ``(x,y,q,path_index)`` arrays of points kept before last point.
+
+        """
+        x0, y0 = self.x0, self.y0
+        min_grade_delta, force_minmax = self.min_grade_delta, self.force_minmax
+        q_m1, dist_m1 = self.q_m1, self.dist_m1
+        q_0, dist_0, grade_0 = self.q_0, self.dist_0, self.grade_0
+        last, last_fixed = self.last, self.last_fixed
+        kept = []
+
+        for x, y, q, path_index, repeat in izip(xs.tolist(), ys.tolist(), qs.tolist(), 
+                                                path_indices.tolist(), repeats.tolist()):
+            dist = ((voxelE * (x-x0)) ** 2 + (voxelN * (y-y0)) ** 2) ** 0.5 # calculate distance in map units
+            if q_0 is None: # first point
+                q_0 = q
+                dist_0 = dist
+                last = (x, y, q, -1)
+            elif dist == dist_0:
+                # same position as last point (e.g. crossing grid corner)
+                # replace last point without changing grade
+                if not last_fixed:
+                    q_0 = q
+                    last = (x, y, q, -1)
             else:
-                # no, replace last point
-                track.pop()
-                # point 0 is now effectively invalidated, -1 unchanged
-                # new point is now 0, and calc'd from -1
-                d_q = q-q_m1
-                d_dist = dist-dist_m1
+                d_q = q-q_0 # find deltas to last
+                d_dist = dist-dist_0
                 grade = d_q / d_dist
-            grade_0 = grade
-        q_0 = q # current point is now 0
-        dist_0 = dist
 
-        E = x * voxelE + set0_E
-        N = y * voxelN + set0_N
-        track.append((E, N, q))
+                # strategy: always add new point to track,
+                # but remove last from track if it is redundant
+
+                # should we add a new point to track?
+                if (grade_0 is None or last_fixed or # not enough previous points or point of path, must keep point
+                    (force_minmax and grade * grade_0 < 0) or # grade sign change, always keep last point
+                    abs(grade-grade_0) >= min_grade_delta): # grade delta more than cutoff
+                    # yes, add current point to track
+                    q_m1 = q_0 # push zero to -1
+                    dist_m1 = dist_0
+                    kept.append(last)
+                else:
+                    # no, replace last point
+                    # point 0 is now effectively invalidated, -1 unchanged
+                    # new point is now 0, and calc'd from -1
+                    d_q = q-q_m1
+                    d_dist = dist-dist_m1
+                    grade = d_q / d_dist
+                grade_0 = grade
+                q_0 = q # current point is now 0
+                dist_0 = dist
+                last = (x, y, q, -1)
+                last_fixed = False
+
+            if path_index >= 0:
+                # point of path, keep it and measure distances from it for next leg
+                if repeat or last_fixed: kept.append(last)
+                last = last[:3] + (path_index,)
+                last_fixed = True
+                x0, y0 = last[0], last[1]
+                dist_0 = 0.0
+
+        self.x0, self.y0 = x0, y0
+        self.q_m1, self.dist_m1 = q_m1, dist_m1
+        self.q_0, self.dist_0, self.grade_0 = q_0, dist_0, grade_0
+        self.last, self.last_fixed = last, last_fixed
+        return self.as_arrays(kept)
+
+    def finish(self):
+        """
+        Returns ``(x,y,q,path_index)`` arrays of last point, or empty arrays 
+        if no points were added.
+        """
+        return self.as_arrays([self.last] if self.last else [])
+
+    @staticmethod
+    def as_arrays(points):
+        points = np.array(points).reshape(-1, 4)
+        return points[:,0], points[:,1], points[:,2], points[:,3].astype(np.int64)
+
+def simplified_chunk(xs, ys, qs, path_indices, slope=False):
+    """
+    Convert chunk of simplified points from DEM grid to NZTM2000, adding
+    slope and aspect of points (see ``DEMSet.interpolate_slope_DEMxy_many``)
+    if ``slope``. As slope is found only for points kept, it is looked up 
+    separately from elevation.
 
+    Return:
+        out : tuple of arrays
+            ``(E,N,elevation,path_index)`` or 
+            ``(E,N,elevation,path_index,slope,aspect)`` arrays
 
-        if x == x1 and y == y1:
-            # reached end point
-            if index != -1:
-                # ensure always add last point
-                # may get here if point0 == point1
-                track.append((E, N, q))
-            break
+    """
+    chunk = (xs * voxelE + set0_E, ys * voxelN + set0_N, qs, path_indices)
+    if slope: chunk += demset.interpolate_slope_DEMxy_many(xs, ys)[1:]
+    return chunk
 
-        index += 1
+def iter_path_bytolerance(path, tolerance=1.0, chunk_size=HardLimits.chunk_size, slope=False):
+    """
+    Interpolate a path keeping only points needed for the linear profile of 
+    the path to stay within ``tolerance`` metres in elevation of the full
+    resolution profile, i.e. all points found by ``iter_path_points``. Points
+    are selected by Douglas-Peucker simplification in the distance/elevation 
+    plane. Points of ``path`` are always kept. Yields points in chunks, 
+    processing at most ``chunk_size`` grid squares at a time.
 
-        # vertex is a point on the line than may give a maximum or minimum value of
-        # q in the linear interpolation algorithm
-        if check_vertex: # if looking for a vertex, will be False if found a vertex in last iteration
-
-            vertex = get_interpolation_vertex(dxm, dym, abs_dx, abs_dy, qmm, qpm, qmp, qpp)
-                # vertex finding algorithm assumes x, y are defined in terms of
-                # 0, 1 coordinates of qmm-qpp
-                # vertex algorithm will return correct values if
-                # given absolute x, y, dx, dy values, if q values
-                # defined in line direction (i.e. qmm closest to origin
-                # of line)
-                # vertex algorithm will return a vertex if present within 0-1 bounds
-
-            if vertex is not None: # got a vertex
-                vertex_x, vertex_y, vertex_q, vertex_ismax = vertex
-                vertex_x = x_int_m + math.copysign(vertex_x, dx) # calculate x, y in image scale
-                vertex_y = y_int_m + math.copysign(vertex_y, dy)
-
-                # check if vertex is within line bounds (may be less than 0-1 bounds of
-                # qmm-qpp, if out of bounds, skip processing vertex
-                if dx >= 0   and (vertex_x < x0 or vertex_x > x1): pass
-                elif dx < 0  and (vertex_x > x0 or vertex_x < x1): pass
-                elif dy >= 0 and (vertex_y < y0 or vertex_y > y1): pass
-                elif dy < 0  and (vertex_y > y0 or vertex_y < y1): pass
-                else:
-                    check_vertex = False # don't look for vertex in next iteration
-                    x = vertex_x # process x, y point at top of point
-                    y = vertex_y
-                    q = vertex_q
-                    #print vertex
-                    dxm = abs(x - x_int_m)
-                    dxp = abs(x_int_p - x)
-                    dym = abs(y - y_int_m)
-                    dyp = abs(y_int_p - y)
-                    continue
-
-        if x_int_m == x1_int_m and y_int_m == y1_int_m: # reached terminating whole points
-            # if got here, next point should be endpoint
-            # jump to exact endpoint
-            x = x1
-            y = y1
-            dxm = abs(x - x_int_m)
-            dxp = abs(x_int_p - x)
-            dym = abs(y - y_int_m)
-            dyp = abs(y_int_p - y)
-            q = qmm * dxp * dyp + qpm * dxm * dyp + qmp * dxp * dym + qpp * dxm * dym
-            index = -1 # mark last point with index -1
-        else:
-            check_vertex = True # well be incrementing qmm-qpp points, check a vertex next iteration
-
-            # should we increment x or increment y?
-            dx_next = x_int_p - x # determine distance to next whole x/y points
-            dy_next = y_int_p - y
-
-            if dx_next / dx <= dy_next / dy: # closer to a whole x point
-                x_int_m = x_int_p # move along one whole point in x direction
-                x_int_p = x_int_p + dx1
-                x = x_int_m # start at whole x location
-                y = y0 + (x-x0) / dx * dy # determine y at this whole x
-
-                # reassign/get/calculate q and delta values
-                qmm = qpm
-                qmp = qpp
-                qpm = demset.get_value(x_int_p, y_int_m)
-                qpp = demset.get_value(x_int_p, y_int_p)
-                dxm = 0.0
-                dxp = 1.0
-                dym = abs(y - y_int_m)
-                dyp = abs(y_int_p - y)
-
-                q = qmm * dyp + qmp * dym # interpolate y at whole x point
-
-            else:  # closer to a whole y point
-                y_int_m = y_int_p # move along one whole point in y direction
-                y_int_p = y_int_p + dy1
-                y = y_int_m # start at whole y location
-                x = x0 + (y-y0) / dy * dx # determine x at this whole y
-
-                # reassign/get/calculate q and delta values
-                qmm = qmp
-                qpm = qpp
-                qmp = demset.get_value(x_int_m, y_int_p)
-                qpp = demset.get_value(x_int_p, y_int_p)
-                dxm = abs(x - x_int_m)
-                dxp = abs(x_int_p - x)
-                dym = 0.0
-                dyp = 1.0
-
-                q = qmm * dxp + qpm * dxm # interpolate y at whole x point
-    return track
+    Does not catch exceptions from failed DEM lookups, so these will be 
+    propagated to the caller.
+
+    Arguments:
+
+        path : list of (float,float) tuples
+          list of NZTM2000 E,N coordinates, at least 2 points
+        tolerance : float
+          max difference in elevation (metres) between simplified and full 
+          resolution profile
+        chunk_size : integer
+          max number of grid squares processed for each chunk
+        slope : boolean
+          whether to also yield slope and aspect of points, see 
+          ``DEMSet.interpolate_slope_DEMxy_many``
+
+    Return:
+        out : generator of (array,array,array,array) tuples
+            Chunks of points in interpolated path as ``(E,N,elevation,path_index)``
+            arrays, or ``(E,N,elevation,path_index,slope,aspect)`` arrays if 
+            ``slope``. ``path_index`` is the index of the point in ``path``, or 
+            ``-1`` for interpolated points.
+
+    """
+    if len(path) < 2: raise ValueError("path must contain at least 2 points")
+
+    # convert to x,y in DEM grid
+    path_E, path_N = np.asarray(path, float).T
+    path_x = (path_E-set0_E) / voxelE
+    path_y = (path_N-set0_N) / voxelN
+
+    simplifier = ToleranceSimplifier(path_x[0], path_y[0], tolerance, chunk_size)
+    for points in iter_path_points(path_x, path_y, chunk_size):
+        xs, ys, qs, path_indices = simplifier.add(*points)
+        if len(xs): yield simplified_chunk(xs, ys, qs, path_indices, slope)
+    yield simplified_chunk(*simplifier.finish(), slope=slope)
+
+def simplify_profile(dist, q, tolerance):
+    """
+    Douglas-Peucker simplification of a profile, with error measured as
+    difference in ``q`` from the simplified profile at each ``dist``.
+    First and last points are always kept.
+
+    Arguments:
+
+        dist, q : arrays of floats
+          distance and elevation of each point of profile
+        tolerance : float
+          max difference in ``q`` between simplified and original profile
+
+    Return:
+        out : array of booleans
+            ``True`` for points kept in simplified profile.
+
+    """
+    keep = np.zeros(len(q), bool)
+    keep[0] = keep[-1] = True
+    spans = [(0, len(q)-1)]
+    while spans:
+        start, end = spans.pop()
+        if end-start < 2: continue
+        d_dist = dist[end]-dist[start]
+        fraction = (dist[start+1:end]-dist[start]) / d_dist if d_dist != 0.0 else 0.0
+        error = np.abs(q[start+1:end] - (q[start] + (q[end]-q[start]) * fraction))
+        i = error.argmax()
+        if error[i] > tolerance:
+            i += start+1
+            keep[i] = True
+            spans.append((start, i))
+            spans.append((i, end))
+    return keep
+
+class ToleranceSimplifier:
+    """
+    Simplify interpolated points along a path to within a tolerance in 
+    elevation, for ``iter_path_bytolerance``. Points of the path itself are 
+    always kept, and spans between them are simplified with 
+    ``simplify_profile``.
+
+    Points are added in chunks, and are held until the next point of the path.
+    If more than ``max_points`` are held, the points are simplified and all
+    but the last span kept, so memory is bounded (this may keep slightly
+    more points than needed).
+    """
+
+    def __init__(self, x0, y0, tolerance=1.0, max_points=HardLimits.chunk_size):
+        """
+        Arguments:
+
+            x0, y0 : floats
+              x, y coordinates of start of path, which distances are measured from
+            tolerance : float
+              max difference in elevation between simplified and original profile
+            max_points : integer
+              max number of points held before simplifying
+
+        """
+        self.x0 = x0
+        self.y0 = y0
+        self.tolerance = tolerance
+        self.max_points = max_points
+        # points held, first point is start of span to simplify
+        self.points = [np.empty(0) for column in range(4)] + [np.empty(0, np.int64)]
+
+    def add(self, xs, ys, qs, path_indices, repeats):
+        """
+        Add interpolated points along path, in order.
+
+        xs, ys, qs : arrays of floats
+        path_indices : array of integers, index of point in path or ``-1``
+        repeats : array of booleans, ignored as points are not repeated
+
+        Returns ``(x,y,q,path_index)`` arrays of points kept.
+
+        """
+        # distance of each point from start of its leg, i.e. last point of path before it
+        n = len(xs)
+        if n == 0: return xs, ys, qs, path_indices
+        is_path = path_indices >= 0
+        leg_start = np.concatenate(([-1], np.maximum.accumulate(np.where(is_path, np.arange(n), -1))[:-1]))
+        x0 = np.where(leg_start >= 0, xs[leg_start], self.x0)
+        y0 = np.where(leg_start >= 0, ys[leg_start], self.y0)
+        dist = ((voxelE * (xs-x0)) ** 2 + (voxelN * (ys-y0)) ** 2) ** 0.5
+        if is_path.any():
+            self.x0, self.y0 = xs[is_path][-1], ys[is_path][-1]
+
+        held_x, held_y, held_q, held_dist, held_path_index = self.points
+        xs = np.concatenate((held_x, xs))
+        ys = np.concatenate((held_y, ys))
+        qs = np.concatenate((held_q, qs))
+        dist = np.concatenate((held_dist, dist))
+        path_indices = np.concatenate((held_path_index, path_indices))
+        if len(held_x) == 0: dist[0] = 0.0 # first point of path
+
+        # simplify each span up to point of path, which starts next span
+        kept = []
+        start = 0
+        for end in np.nonzero(path_indices[1:] >= 0)[0] + 1:
+            kept.append(start + np.nonzero(simplify_profile(dist[start:end+1], qs[start:end+1], self.tolerance)[:-1])[0])
+            dist[end] = 0.0 # distances of next span from this point
+            start = end
+
+        if len(xs)-start > self.max_points:
+            # too many points held, keep all but last span
+            span_kept = start + np.nonzero(simplify_profile(dist[start:], qs[start:], self.tolerance))[0]
+            if len(xs)-span_kept[-2] > self.max_points // 2: new_start = span_kept[-1]
+            else: new_start = span_kept[-2]
+            kept.append(span_kept[span_kept < new_start])
+            start = new_start
+
+        self.points = [xs[start:], ys[start:], qs[start:], dist[start:], path_indices[start:]]
+        kept = np.concatenate(kept) if kept else np.empty(0, np.int64)
+        return xs[kept], ys[kept], qs[kept], path_indices[kept]
+
+    def finish(self):
+        """
+        Returns ``(x,y,q,path_index)`` arrays of points kept from points held.
+        """
+        xs, ys, qs, dist, path_indices = self.points
+        if len(xs) == 0: return xs, ys, qs, path_indices
+        kept = simplify_profile(dist, qs, self.tolerance)
+        return xs[kept], ys[kept], qs[kept], path_indices[kept]
+
+def path_stats(path, hysteresis=0.0, chunk_size=HardLimits.chunk_size):
+    """
+    Calculate statistics of the full resolution profile of a path, i.e. all 
+    points found by ``iter_path_points``, without keeping the profile.
+    See ``ProfileStats`` for statistics calculated.
+
+    Does not catch exceptions from failed DEM lookups, so these will be 
+    propagated to the caller.
+
+    Arguments:
+
+        path : list of (float,float) tuples
+          list of NZTM2000 E,N coordinates, at least 2 points
+        hysteresis : float
+          min change in elevation (metres) counted in ascent/descent
+        chunk_size : integer
+          max number of grid squares processed for each chunk
+
+    Return:
+        out : dict
+            Statistics, keyed by ``ProfileStats.fields``.
+
+    """
+    if len(path) < 2: raise ValueError("path must contain at least 2 points")
+
+    # convert to x,y in DEM grid
+    path_E, path_N = np.asarray(path, float).T
+    path_x = (path_E-set0_E) / voxelE
+    path_y = (path_N-set0_N) / voxelN
+
+    stats = ProfileStats(hysteresis)
+    for xs, ys, qs, path_indices, repeats in iter_path_points(path_x, path_y, chunk_size):
+        stats.add(xs, ys, qs)
+    return stats.result()
+
+class ProfileStats:
+    """
+    Statistics of a profile, calculated from points added in chunks:
+
+        distance : ground length of profile (metres, see ``ground_distances``)
+        distance_3d : length of profile including change in elevation
+        ascent, descent : total ascent and descent, counting only changes of
+            at least ``hysteresis`` metres between a maximum and minimum, 
+            and the change from the last of these to the end, so ascent - 
+            descent is the change in elevation from start to end
+        min_elevation, max_elevation : min and max elevation
+        max_grade, min_grade : max and min grade between points, ``None`` if
+            all points are at the same position
+    """
+
+    fields = ('distance', 'distance_3d', 'ascent', 'descent', 
+              'min_elevation', 'max_elevation', 'max_grade', 'min_grade')
+
+    def __init__(self, hysteresis=0.0):
+        """
+        Arguments:
+
+            hysteresis : float
+              min change in elevation (metres) counted in ascent/descent
+
+        """
+        self.hysteresis = hysteresis
+        self.last = None # last point added, as (x,y,q) arrays
+        self.distance = self.distance_3d = 0.0
+        self.ascent = self.descent = 0.0
+        self.min_elevation = self.max_elevation = None
+        self.max_grade = self.min_grade = None
+
+        # ascent/descent state
+        self.trend = 0 # +1 if ascending, -1 if descending, 0 if not yet known
+        self.ref = None # last max/min elevation, or first elevation if trend not known
+
+    def add(self, xs, ys, qs):
+        """
+        Add points along profile, in order.
+
+        xs, ys, qs : arrays of floats, x,y coordinates in DEM grid and elevation
+
+        """
+        if len(xs) == 0: return
+        if self.last is not None:
+            # include segment from last point added
+            xs = np.concatenate((self.last[0], xs))
+            ys = np.concatenate((self.last[1], ys))
+            qs = np.concatenate((self.last[2], qs))
+        self.last = (xs[-1:], ys[-1:], qs[-1:])
+
+        d_dist = ground_distances(xs * voxelE + set0_E, ys * voxelN + set0_N)
+        d_q = np.diff(qs)
+        self.distance += d_dist.sum()
+        self.distance_3d += ((d_dist ** 2 + d_q ** 2) ** 0.5).sum()
+        self.min_elevation = min(qs.min(), self.min_elevation if self.min_elevation is not None else qs.min())
+        self.max_elevation = max(qs.max(), self.max_elevation if self.max_elevation is not None else qs.max())
+        moving = d_dist > 0.0
+        if moving.any():
+            grade = d_q[moving] / d_dist[moving]
+            self.max_grade = max(grade.max(), self.max_grade if self.max_grade is not None else grade.max())
+            self.min_grade = min(grade.min(), self.min_grade if self.min_grade is not None else grade.min())
+
+        # ascent and descent only change at local maxima/minima, so only
+        # process these (and first and last points)
+        qs = qs[np.concatenate(([True], d_q != 0.0))] # drop repeated elevations
+        turning = np.ones(len(qs), bool)
+        turning[1:-1] = (qs[1:-1]-qs[:-2]) * (qs[2:]-qs[1:-1]) < 0.0
+        if self.ref is not None: turning[0] = False # last point, already processed
+        self.add_turning_points(qs[turning].tolist())
+
+    def add_turning_points(self, qs):
+        hysteresis = self.hysteresis
+        trend, ref = self.trend, self.ref
+        ascent, descent = self.ascent, self.descent
+        for q in qs:
+            if trend > 0:
+                if q > ref: # continue ascending
+                    ascent += q-ref
+                    ref = q
+                elif ref-q >= hysteresis: # start descending
+                    trend = -1
+                    descent += ref-q
+                    ref = q
+            elif trend < 0:
+                if q < ref: # continue descending
+                    descent += ref-q
+                    ref = q
+                elif q-ref >= hysteresis: # start ascending
+                    trend = +1
+                    ascent += q-ref
+                    ref = q
+            elif ref is None: # first point
+                ref = q
+            elif q > ref and q-ref >= hysteresis: # start ascending
+                trend = +1
+                ascent += q-ref
+                ref = q
+            elif q < ref and ref-q >= hysteresis: # start descending
+                trend = -1
+                descent += ref-q
+                ref = q
+        self.trend, self.ref = trend, ref
+        self.ascent, self.descent = ascent, descent
+
+    def result(self):
+        """
+        Returns statistics as dict keyed by ``fields``.
+        """
+        ret = dict((field, None if getattr(self, field) is None else float(getattr(self, field))) 
+                   for field in self.fields)
+        if self.ref is not None:
+            # change from last max/min to end, within hysteresis so not yet counted
+            end_change = float(self.last[2][-1]) - self.ref
+            if end_change > 0.0: ret['ascent'] += end_change
+            else: ret['descent'] -= end_change
+        return ret
@@ -21,18 +21,75 @@ Copyright (c) 2014-2016 Tet Woo Lee
 
 import cloudstorage
 from collections import deque
+from contextlib import contextmanager
 from itertools import izip
 from google.appengine.api import app_identity
+import logging
+import numpy as np
 import os
 import struct
 import threading
+from tilecache import DiskBlockCache, MemcacheBlockCache, LocalBlockCache
 
 bucket_name = '/' + os.environ.get('BUCKET_NAME', app_identity.get_default_gcs_bucket_name())
 is_devserver = os.environ.get('SERVER_SOFTWARE', '').startswith('Dev')
+use_cloud = os.environ.get('DEM_CLOUD', '0' if is_devserver else '1') == '1' # read DEMs from cloud storage, can force on dev server (see fakegcs)
+memory_cache_size = int(os.environ.get('DEM_MEMORY_CACHE_SIZE', 32 * 1024 * 1024)) # blocks of cloud DEMs kept in memory by each instance, 0 for none
+disk_cache_dir = os.environ.get('DEM_DISK_CACHE_DIR') # e.g. /tmp/dem_cache, disk cache not used if not set
+disk_cache_size = int(os.environ.get('DEM_DISK_CACHE_SIZE', 256 * 1024 * 1024))
+shared_cache = os.environ.get('DEM_SHARED_CACHE') # 'memcache' or 'local', shared cache not used if not set
+shared_cache_size = int(os.environ.get('DEM_SHARED_CACHE_SIZE', 64 * 1024 * 1024)) # for 'local' only
+
+def coalesce_ranges(ranges, max_gap):
+    """
+    Merge byte ranges that overlap or are separated by no more than 
+    ``max_gap`` bytes, so nearby ranges can be fetched with a single read.
+
+    Arguments:
+
+        ranges : list of (int,int) tuples
+            list of ``(offset, size)`` byte ranges, in any order
+        max_gap : int
+            largest gap (in bytes) between two ranges that will be merged
+
+    Return:
+        out : (list of (int,int) tuples, list of ints)
+            Tuple of ``spans, span_indices`` where ``spans`` is the sorted list
+            of merged ``(offset, size)`` ranges and ``span_indices`` gives, for
+            each range in ``ranges``, the index of the span containing it.
+
+    """
+    spans = []
+    span_indices = [None] * len(ranges)
+    span_start = span_end = None
+    for i in sorted(xrange(len(ranges)), key=lambda i: ranges[i][0]):
+        offset, size = ranges[i]
+        if span_end is None or offset - span_end > max_gap:
+            if span_end is not None: spans.append((span_start, span_end-span_start))
+            span_start = offset
+            span_end = offset + size
+        else:
+            span_end = max(span_end, offset + size)
+        span_indices[i] = len(spans)
+    if span_end is not None: spans.append((span_start, span_end-span_start))
+    return spans, span_indices
 
 class DEMReader:
+    """
+    Reads values from a single DEM file, stored locally or in cloud storage.
+
+    Reads are safe to use from many threads at once without locking. Data is
+    read into an immutable buffer ``window``, a ``(start, end, data)`` tuple
+    that is replaced as a whole rather than modified, and all file reads are
+    positional, so there is no shared seek position. Threads that hit the 
+    buffer never take a lock; ``lock`` is only taken to activate or deactivate
+    the reader, and to replace ``window`` after a read (so a window read while
+    the reader was being deactivated is not kept).
+    """
     buffer_size = 4 * 1024 * 1024 # need manual buffer for cloud storage, this does not support buffered random i/o (sequential only)
-    def __init__(self, field_dict, cloud=False):
+    max_range_gap = 16 * 1024 # ranges closer than this are merged into a single read by read_ranges
+    block_size = 64 * 1024 # size of blocks stored in block caches
+    def __init__(self, field_dict, cloud=False, block_caches=(), active_readers=None):
         self.dem_path = field_dict["path"]
         self.image_width = field_dict["image_width"]
         self.image_height = field_dict["image_height"]
@@ -43,50 +100,254 @@ class DEMReader:
         self.data_offset = field_dict["data_offset"]
 
         self.cloud = cloud
+        self.block_caches = block_caches # caches consulted, in order, before reading from file
+        self.active_readers = active_readers # deque that this reader is added to when activated
         self.dem_file = None
         self.deactivate()
-        self.lock = threading.Lock() # lock for acquiring this object when in use
+        self.lock = threading.Lock() # lock for activating/deactivating this object
+        self.file_lock = threading.Lock() # lock for seek and read of local file, if os.pread not available
     def is_active(self):
         return self.dem_file is not None
     def activate(self):
-        print "Activating: ",self.dem_path
+        logging.debug("Activating: %s", self.dem_path)
         assert self.dem_file is None # assert to check for double activation
         if not self.cloud:
             file_path = 'nztmdem_1000x1000/' + self.dem_path
-            self.dem_file_size = os.stat(file_path).st_size
+            file_stat = os.stat(file_path)
+            self.dem_file_size = file_stat.st_size
+            self.dem_generation = '{}-{}'.format(int(file_stat.st_mtime), file_stat.st_size)
             self.dem_file = file(file_path, "rb")
         else:
             bucket_path = bucket_name + '/nztmdem_1000x1000/' + self.dem_path
-            self.dem_file_size = cloudstorage.stat(bucket_path).st_size
-            self.dem_file = cloudstorage.open(bucket_path, "r", read_buffer_size=self.buffer_size)
+            file_stat = cloudstorage.stat(bucket_path)
+            self.dem_file_size = file_stat.st_size
+            self.dem_generation = file_stat.etag
+            # all reads go through read_ranges, so avoid prefetching a large
+            # buffer when opening
+            self.dem_file = cloudstorage.open(bucket_path, "r", read_buffer_size=self.block_size)
+    def ensure_active(self):
+        """
+        Activate this reader if not active, adding it to ``active_readers``.
+        Returns the open DEM file, which stays usable by the caller even if 
+        the reader is deactivated by another thread.
+        """
+        dem_file = self.dem_file
+        if dem_file is None:
+            with self.lock:
+                if self.dem_file is None:
+                    self.activate()
+                    if self.active_readers is not None:
+                        self.active_readers.appendleft(self) # store as an active reader
+                dem_file = self.dem_file
+        return dem_file
     def deactivate(self):
-        if self.is_active(): print "Deactivating: ",self.dem_path
+        if self.is_active(): logging.debug("Deactivating: %s", self.dem_path)
         self.dem_file = None
-        self.buffer = None
-        self.buffer_start = None
-        self.buffer_end = None
+        self.window = None
     def within_bounds(self, x, y):
         return self.image_x0 <= x <= self.image_xn and self.image_y0 <= y <= self.image_yn
     def buffered_read(self, offset, size):
-        if offset > self.buffer_start and offset + size < self.buffer_end and self.buffer is not None:
-            pass # in buffer
-        else:
-            self.buffer_start = min(offset - self.buffer_size / 2, self.dem_file_size - self.buffer_size)
-            if self.buffer_start < 0: self.buffer_start = 0
-            self.dem_file.seek(self.buffer_start)
-            self.buffer = self.dem_file.read(self.buffer_size)
-            self.buffer_end = self.buffer_start + len(self.buffer)
-            print 'Buffer read from {} to {}'.format(self.buffer_start, self.buffer_end)
-        offset_in_buffer = offset-self.buffer_start
-        assert offset_in_buffer > 0 and offset_in_buffer < self.buffer_size
-        data = self.buffer[offset_in_buffer:offset_in_buffer + size]
+        window = self.window # take a reference, may be replaced by other threads
+        if window is None or offset < window[0] or offset + size > window[1]:
+            window = self.read_window(offset)
+        buffer_start, buffer_end, buffer = window
+        offset_in_buffer = offset-buffer_start
+        data = buffer[offset_in_buffer:offset_in_buffer + size]
         assert len(data) == size
         return data
-        
+
+    def read_window(self, offset):
+        """
+        Read a new ``window`` of ``buffer_size`` around ``offset``, and return it.
+        The window is only kept as the buffer if the reader was not 
+        deactivated (or reactivated) while reading.
+        """
+        dem_file = self.ensure_active()
+        buffer_start = min(offset - self.buffer_size / 2, self.dem_file_size - self.buffer_size)
+        if buffer_start < 0: buffer_start = 0
+        buffer_read_size = min(self.buffer_size, self.dem_file_size - buffer_start)
+        if self.block_caches:
+            buffer = self.read_blocks([(buffer_start, buffer_read_size)])[0]
+        else:
+            buffer = self.read_file_ranges([(buffer_start, buffer_read_size)])[0]
+        window = (buffer_start, buffer_start + len(buffer), buffer)
+        with self.lock:
+            if self.dem_file is dem_file: # still active from same activation
+                self.window = window
+        logging.debug('Buffer read from %i to %i', window[0], window[1])
+        return window
+
+    def read_ranges(self, ranges):
+        """
+        Read several byte ranges from this DEM in as few reads as possible.
+        Nearby ranges are merged (see ``coalesce_ranges``) and merged spans 
+        already in the buffer are served from it. For local files, the buffer
+        is refilled around the remaining spans if they fit in ``buffer_size``,
+        as local reads are cheap and later reads then need no lock. For cloud
+        storage, the remaining spans are requested together in one 
+        multi-range request (through the block caches, if any), without 
+        changing the buffer.
+
+        ranges : list of (int,int) tuples, ``(offset, size)`` byte ranges
+
+        Returns list of strings, the data read for each range.
+
+        """
+        spans, span_indices = coalesce_ranges(ranges, self.max_range_gap)
+        span_data = [None] * len(spans)
+        window = self.window
+        fetch = []
+        for i, (offset, size) in enumerate(spans):
+            if window is not None and offset >= window[0] and offset + size <= window[1]:
+                offset_in_buffer = offset - window[0]
+                span_data[i] = window[2][offset_in_buffer:offset_in_buffer + size]
+            else:
+                fetch.append(i)
+        if fetch and not self.cloud:
+            fetch_start = spans[fetch[0]][0]
+            fetch_end = spans[fetch[-1]][0] + spans[fetch[-1]][1]
+            if fetch_end - fetch_start <= self.buffer_size:
+                window = self.read_window((fetch_start + fetch_end) // 2)
+                for i in fetch:
+                    offset_in_buffer = spans[i][0] - window[0]
+                    span_data[i] = window[2][offset_in_buffer:offset_in_buffer + spans[i][1]]
+                fetch = []
+        if fetch:
+            if self.block_caches:
+                fetched = self.read_blocks([spans[i] for i in fetch])
+            else:
+                fetched = self.read_file_ranges([spans[i] for i in fetch])
+            for i, data in izip(fetch, fetched):
+                span_data[i] = data
+            logging.debug('Ranges read: %i spans for %i ranges', len(fetch), len(ranges))
+
+        ret = []
+        for (offset, size), i in izip(ranges, span_indices):
+            offset_in_span = offset - spans[i][0]
+            data = span_data[i][offset_in_span:offset_in_span + size]
+            assert len(data) == size
+            ret.append(data)
+        return ret
+
+    def read_file_ranges(self, ranges):
+        """
+        Read byte ranges directly from file, activating reader if needed. 
+        Reads are positional (``os.pread`` where available), with one 
+        multi-range request for cloud storage.
+
+        ranges : list of (int,int) tuples, ``(offset, size)`` byte ranges
+
+        Returns list of strings, the data read for each range.
+
+        """
+        dem_file = self.ensure_active()
+        if self.cloud: return dem_file.read_ranges(ranges)
+        ret = []
+        for offset, size in ranges:
+            if hasattr(os, 'pread'):
+                ret.append(os.pread(dem_file.fileno(), size, offset))
+            else:
+                with self.file_lock:
+                    dem_file.seek(offset)
+                    ret.append(dem_file.read(size))
+        return ret
+
+    def block_key(self, block):
+        """
+        Get key of block number ``block`` in block caches. Includes path and
+        generation of DEM file, so changed files will not use stale blocks.
+        """
+        return '{}@{}:{}'.format(self.dem_path, self.dem_generation, block)
+
+    def read_blocks(self, ranges):
+        """
+        Read byte ranges through the block caches. Ranges are expanded to whole
+        blocks of ``block_size``, blocks are looked up in each of 
+        ``block_caches`` in turn and any still missing are read from file 
+        (contiguous missing blocks in a single range) and stored in all caches.
+
+        ranges : list of (int,int) tuples, ``(offset, size)`` byte ranges
+
+        Returns list of strings, the data read for each range.
+
+        """
+        self.ensure_active() # block keys and sizes need generation and size of DEM file
+        blocks = set()
+        for offset, size in ranges:
+            blocks.update(xrange(offset // self.block_size, (offset + size - 1) // self.block_size + 1))
+        blocks = sorted(blocks)
+
+        block_data = {}
+        missing = [self.block_key(block) for block in blocks]
+        for i, block_cache in enumerate(self.block_caches):
+            found = block_cache.get_multi(missing)
+            for key, data in found.iteritems():
+                block_data[key] = data
+                for upper_block_cache in self.block_caches[:i]:
+                    upper_block_cache.set_multi({key: data}) # promote to faster caches
+            missing = [key for key in missing if key not in found]
+
+        if missing:
+            missing = set(missing)
+            read_blocks = [block for block in blocks if self.block_key(block) in missing]
+            read_spans, _ = coalesce_ranges([(block * self.block_size, self.block_size) for block in read_blocks], 0)
+            read_spans = [(offset, min(size, self.dem_file_size - offset)) for offset, size in read_spans]
+            read_mapping = {}
+            for (offset, size), data in izip(read_spans, self.read_file_ranges(read_spans)):
+                for block_offset in xrange(0, size, self.block_size):
+                    key = self.block_key((offset + block_offset) // self.block_size)
+                    read_mapping[key] = data[block_offset:block_offset + self.block_size]
+            for block_cache in self.block_caches:
+                block_cache.set_multi(read_mapping)
+            block_data.update(read_mapping)
+            logging.debug('Blocks read: %i of %i from file', len(read_mapping), len(blocks))
+
+        ret = []
+        for offset, size in ranges:
+            first_block = offset // self.block_size
+            last_block = (offset + size - 1) // self.block_size
+            data = ''.join(block_data[self.block_key(block)] for block in xrange(first_block, last_block + 1))
+            offset_in_data = offset - first_block * self.block_size
+            data = data[offset_in_data:offset_in_data + size]
+            assert len(data) == size
+            ret.append(data)
+        return ret
+
+    def get_values(self, xs, ys):
+        """
+        Get heights of points ``xs[i],ys[i]`` from this DEM, reading all
+        points together with ``read_ranges``. Each span of nearby pixels is
+        read once and decoded as an array.
+        Fast version. Does not check bounds.
+        Expected that caller (``DEMSet``) will have handled these.
+
+        xs, ys : arrays of integers
+
+        Returns array of floats.
+
+        """
+        pixels = (xs - self.image_x0) + (ys - self.image_y0) * self.image_width
+        unique_pixels, inverse = np.unique(pixels, return_inverse=True)
+
+        # split sorted pixels into spans wherever gap is too large to read through
+        breaks = np.nonzero(np.diff(unique_pixels) > self.max_range_gap / 4 + 1)[0] + 1
+        span_starts = np.concatenate(([0], breaks))
+        span_ends = np.concatenate((breaks, [len(unique_pixels)]))
+        span_first_pixels = unique_pixels[span_starts]
+        span_last_pixels = unique_pixels[span_ends - 1]
+        ranges = [(self.data_offset + int(first_pixel) * 4, int(last_pixel - first_pixel + 1) * 4)
+                  for first_pixel, last_pixel in izip(span_first_pixels, span_last_pixels)]
+
+        unique_values = np.empty(len(unique_pixels))
+        for span_start, span_end, first_pixel, data in izip(span_starts, span_ends, span_first_pixels, self.read_ranges(ranges)):
+            span_values = np.frombuffer(data, '<f4')
+            unique_values[span_start:span_end] = span_values[unique_pixels[span_start:span_end] - first_pixel]
+        return unique_values[inverse]
+
     def get_value(self, x, y):
         """
         Get height of point ``x,y`` from this DEM.
-        Fast version. Does not check bounds or check that file is opened.
+        Fast version. Does not check bounds.
         Expected that caller (``DEMSet``) will have handled these.
 
         x, y : number, integers
@@ -115,14 +376,85 @@ class DEMReader:
         if not self.image_y0 <= y <= self.image_yn: raise IndexError("out of DEM bounds")
         offset = self.data_offset + ((x-self.image_x0) + (y-self.image_y0) * self.image_width) * 4
 
-        if self.dem_file is None:
-            assert False
-            self.activate()
-
-        packedr = self.buffered_read(offset, 4)
+        packed = self.buffered_read(offset, 4)
         return struct.unpack('<f', packed)[0]
 
 
+class PixelMemo:
+    """
+    Memo of DEM pixel values looked up through ``DEMSet.get_values`` during
+    a single request. Consecutive lookups of a request often share pixels
+    (e.g. corners of samples on consecutive legs or chunks of a path), which
+    are then found here rather than located, read and decoded again.
+
+    Holds the pixels of the most recent lookups, up to ``max_pixels``; when
+    full, only the pixels of the latest lookup are kept. Out-of-range pixels
+    are never memoized, so bounds are always checked by the ``DEMSet``.
+    Not thread-safe, each request should use its own memo (see 
+    ``DEMSet.pixel_memo``).
+    """
+
+    key_stride = 1 << 32 # pixel key = y * key_stride + x
+
+    def __init__(self, max_pixels=65536):
+        """
+        Arguments:
+
+            max_pixels : int
+                maximum number of pixels held
+
+        """
+        self.max_pixels = max_pixels
+        self.keys = np.empty(0, np.int64) # sorted
+        self.values = np.empty(0)
+
+    def get_values(self, DEM_set, xs, ys, raise_exception = True):
+        """
+        Get heights of points ``xs[i],ys[i]``, reading pixels not in memo
+        with ``DEM_set.read_values``.
+
+        DEM_set : DEMSet
+        xs, ys : arrays of integers
+        raise_exception : boolean, see ``DEMSet.get_values``
+
+        Returns array of floats.
+
+        """
+        xs = np.asarray(xs, np.int64)
+        ys = np.asarray(ys, np.int64)
+        unique_keys, unique_index, inverse = np.unique(ys * self.key_stride + xs, 
+                                                       return_index=True, return_inverse=True)
+        unique_values = np.empty(len(unique_keys))
+        if len(self.keys) > 0:
+            memo_index = np.minimum(np.searchsorted(self.keys, unique_keys), len(self.keys) - 1)
+            found = self.keys[memo_index] == unique_keys
+            unique_values[found] = self.values[memo_index[found]]
+        else:
+            found = np.zeros(len(unique_keys), bool)
+        missing = ~found
+        if missing.any():
+            missing_index = unique_index[missing]
+            unique_values[missing] = DEM_set.read_values(xs[missing_index], ys[missing_index], raise_exception)
+            self.store(unique_keys[missing], unique_values[missing], unique_keys, unique_values)
+        return unique_values[inverse]
+
+    def store(self, new_keys, new_values, latest_keys, latest_values):
+        """
+        Add pixels ``new_keys`` to memo, or if memo would exceed 
+        ``max_pixels``, replace memo with pixels of latest lookup.
+        """
+        valid = ~np.isnan(new_values)
+        if len(self.keys) + valid.sum() <= self.max_pixels:
+            keys = np.concatenate((self.keys, new_keys[valid]))
+            values = np.concatenate((self.values, new_values[valid]))
+            order = np.argsort(keys)
+            self.keys, self.values = keys[order], values[order]
+        else:
+            valid = ~np.isnan(latest_values)
+            if valid.sum() > self.max_pixels: valid[:] = False
+            self.keys, self.values = latest_keys[valid], latest_values[valid]
+
+
 class DEMSet:
     set0_E = 1012007.5 # central coordinate of top-left pixel in DEM set
     set0_N = 6233992.5
@@ -133,12 +465,41 @@ class DEMSet:
     max_active_readers = 10
     DEM_reader_grid_resolution = 200
 
+    interpolation_methods = ('nearest', 'bilinear', 'bicubic')
+        #: methods for ``interpolate_DEMxy_many``, in increasing order of pixels read per point
+
     DEM_list_path = "geotiff summary 1000x1000 no overlap.txt"
 
-    def __init__(self):
+    def __init__(self, block_caches=None):
         self.active_reader_deque = deque()
         self.DEM_grid = []
+        if block_caches is None: block_caches = self.default_block_caches()
+        self.block_caches = block_caches
+        self.request_local = threading.local() #: holds pixel_memo of request in current thread
         self.read_list()
+        self.index_grid()
+
+    @staticmethod
+    def default_block_caches():
+        """
+        Get block caches for readers of cloud storage DEMs, as configured by
+        environment variables (see ``disk_cache_dir`` and ``shared_cache``).
+        Caches are ordered fastest first: the instance's memory cache (see 
+        ``memory_cache_size``), its disk cache, then the cache shared between
+        instances.
+        """
+        block_caches = []
+        if memory_cache_size:
+            block_caches.append(LocalBlockCache(memory_cache_size))
+        if disk_cache_dir:
+            block_caches.append(DiskBlockCache(disk_cache_dir, disk_cache_size))
+        if shared_cache == 'memcache':
+            block_caches.append(MemcacheBlockCache())
+        elif shared_cache == 'local':
+            block_caches.append(LocalBlockCache(shared_cache_size))
+        elif shared_cache:
+            raise ValueError("Unknown DEM_SHARED_CACHE: " + shared_cache)
+        return block_caches
 
     def read_list(self):
         """
@@ -166,7 +527,9 @@ class DEMSet:
               field_value = int(field_value)
             value_dict[field_name] = field_value
 
-          DEM_reader = DEMReader(value_dict, cloud = False if is_devserver else True)
+          cloud = use_cloud
+          DEM_reader = DEMReader(value_dict, cloud = cloud, block_caches = self.block_caches if cloud else (),
+                                 active_readers = self.active_reader_deque)
           image_grid_x0 = DEM_reader.image_x0/self.DEM_reader_grid_resolution
           image_grid_y0 = DEM_reader.image_y0/self.DEM_reader_grid_resolution
           image_grid_xn = DEM_reader.image_xn/self.DEM_reader_grid_resolution
@@ -189,6 +552,23 @@ class DEMSet:
 
         DEM_list.close()
 
+    def index_grid(self):
+        """
+        Build array of reader indices for the grid read by ``read_list``, for
+        looking up readers of arrays of points.
+        """
+        self.DEM_readers = [] #: list of all readers, indexed by DEM_grid_index
+        reader_indices = {}
+        self.DEM_grid_index = np.empty((len(self.DEM_grid), max(len(row) for row in self.DEM_grid)), np.int32)
+        self.DEM_grid_index.fill(-1) # -1 if no DEM for grid cell
+        for image_grid_y, DEM_grid_row in enumerate(self.DEM_grid):
+            for image_grid_x, DEM_reader in enumerate(DEM_grid_row):
+                if DEM_reader is None: continue
+                if DEM_reader not in reader_indices:
+                    reader_indices[DEM_reader] = len(self.DEM_readers)
+                    self.DEM_readers.append(DEM_reader)
+                self.DEM_grid_index[image_grid_y, image_grid_x] = reader_indices[DEM_reader]
+
     def get_value(self, x, y, raise_exception = True):
         """
         Get height of point ``x,y`` from this DEM set.
@@ -207,20 +587,11 @@ class DEMSet:
             DEM_reader = self.DEM_grid[image_grid_y][image_grid_x]
             if DEM_reader is not None:
                 assert(DEM_reader.within_bounds(x, y))
-                with DEM_reader.lock:
-                    # lock the reader so it can't be deactivated by other threads
-                    # until we are done with it
-                    if not DEM_reader.is_active():
-                        DEM_reader.activate()
-                        self.active_reader_deque.appendleft(DEM_reader) # store as an active reader
-                    ret = DEM_reader.get_value(x, y)
-                    assert ret != None
-                if len(self.active_reader_deque) > self.max_active_readers:
-                    oldest_reader = self.active_reader_deque.pop() # remove oldest if too many active readers
-                    with oldest_reader.lock:
-                        # lock to make sure we deactivate completely before other
-                        # threads try to use this again
-                        oldest_reader.deactivate()
+                # no lock needed, reader activates itself if needed and
+                # reads stay valid if deactivated by other threads meanwhile
+                ret = DEM_reader.get_value(x, y)
+                assert ret != None
+                self.trim_active_readers()
                 return ret
         except IndexError:
             pass
@@ -228,6 +599,108 @@ class DEMSet:
         if not raise_exception: return float('nan')
         raise IndexError("out of DEM bounds") # no DEMs contain this point
 
+    def trim_active_readers(self):
+        """
+        Deactivate oldest readers if more than ``max_active_readers`` are active.
+        """
+        while len(self.active_reader_deque) > self.max_active_readers:
+            try:
+                oldest_reader = self.active_reader_deque.pop() # remove oldest if too many active readers
+            except IndexError:
+                break # emptied by other threads
+            with oldest_reader.lock:
+                # lock to make sure we deactivate completely before other
+                # threads try to use this again
+                oldest_reader.deactivate()
+
+    @contextmanager
+    def pixel_memo(self, max_pixels=65536, memo=None):
+        """
+        Context manager that memoizes pixels looked up by ``get_values`` in 
+        the current thread until exit, see ``PixelMemo``. Use around the 
+        lookups of a single request, e.g.::
+
+            with demset.pixel_memo():
+                ...
+
+        or, for lookups of a request made in steps (e.g. chunks of a streamed
+        response), around each step with the memo of the first::
+
+            with demset.pixel_memo(memo=memo) as memo:
+                ...
+
+        Arguments:
+
+            max_pixels : int
+                maximum number of pixels held by a new memo
+            memo : PixelMemo
+                memo to use, or ``None`` for a new memo
+
+        """
+        previous_memo = getattr(self.request_local, 'pixel_memo', None)
+        self.request_local.pixel_memo = PixelMemo(max_pixels) if memo is None else memo
+        try:
+            yield self.request_local.pixel_memo
+        finally:
+            self.request_local.pixel_memo = previous_memo
+
+    def get_values(self, xs, ys, raise_exception = True):
+        """
+        Get heights of points ``xs[i],ys[i]`` from this DEM set, from the
+        pixel memo of the current request if there is one (see 
+        ``pixel_memo``), otherwise with ``read_values``.
+        If ``raise_exception`` is ``true``, 
+        raises ``IndexError`` if any point is out-of-range.
+        Otherwise, return ``nan`` for those points.
+
+        xs, ys : arrays of integers
+
+        Returns array of floats.
+
+        """
+        memo = getattr(self.request_local, 'pixel_memo', None)
+        if memo is None: return self.read_values(xs, ys, raise_exception)
+        return memo.get_values(self, xs, ys, raise_exception)
+
+    def read_values(self, xs, ys, raise_exception = True):
+        """
+        Read heights of points ``xs[i],ys[i]`` from this DEM set.
+        Points are grouped by DEM and each DEM is read once for all of its
+        points, so scattered points are looked up with few reads.
+        If ``raise_exception`` is ``true``, 
+        raises ``IndexError`` if any point is out-of-range.
+        Otherwise, return ``nan`` for those points.
+
+        xs, ys : arrays of integers
+
+        Returns array of floats.
+
+        """
+        xs = np.asarray(xs, np.int64)
+        ys = np.asarray(ys, np.int64)
+        image_grid_xs = xs // self.DEM_reader_grid_resolution
+        image_grid_ys = ys // self.DEM_reader_grid_resolution
+        grid_height, grid_width = self.DEM_grid_index.shape
+        in_grid = (image_grid_xs >= 0) & (image_grid_xs < grid_width) & (image_grid_ys >= 0) & (image_grid_ys < grid_height)
+        reader_indices = np.empty(len(xs), np.int32)
+        reader_indices.fill(-1)
+        reader_indices[in_grid] = self.DEM_grid_index[image_grid_ys[in_grid], image_grid_xs[in_grid]]
+        if raise_exception and (reader_indices < 0).any():
+            raise IndexError("out of DEM bounds") # no DEMs contain a point
+
+        ret = np.empty(len(xs))
+        ret.fill(float('nan'))
+        # group points by reader
+        order = np.argsort(reader_indices, kind='mergesort')
+        sorted_reader_indices = reader_indices[order]
+        breaks = np.nonzero(np.diff(sorted_reader_indices))[0] + 1
+        for points in np.split(order, breaks):
+            if len(points) == 0 or reader_indices[points[0]] < 0: continue
+            DEM_reader = self.DEM_readers[reader_indices[points[0]]]
+            ret[points] = DEM_reader.get_values(xs[points], ys[points])
+        self.trim_active_readers()
+        return ret
+
     def nearest_DEM(self, E, N):
         """
         Get height of nearest DEM point to ``E,N`` from this DEM set.
@@ -284,3 +757,263 @@ class DEMSet:
         dy2 = 1.0 - dy1
         return q11 * dx2 * dy2 + q21 * dx1 * dy2 + q12 * dx2 * dy1 + q22 * dx1 * dy1
 
+    def interpolate_DEM_many(self, Es, Ns, interpolation='bilinear'):
+        """
+        Get interpolated heights of points ``Es[i],Ns[i]`` from this DEM set.
+        Raises ``IndexError`` if any point is out-of-range.
+
+        Es, Ns: arrays of floats
+          map coordinates in grid units
+        interpolation: string
+          one of ``interpolation_methods``, see ``interpolate_DEMxy_many``
+        """
+
+        xs = (np.asarray(Es, float)-self.set0_E) / self.voxelE
+        ys = (np.asarray(Ns, float)-self.set0_N) / self.voxelN
+
+        return self.interpolate_DEMxy_many(xs, ys, interpolation)
+
+    def interpolate_DEMxy_many(self, xs, ys, interpolation='bilinear'):
+        """
+        Get interpolated heights of points ``xs[i],ys[i]`` from this DEM set.
+        Raises ``IndexError`` if any point is out-of-range, ``ValueError``
+        if ``interpolation`` is unknown.
+
+        xs, ys: arrays of floats
+          DEM coordinates in pixels
+        interpolation: string
+          ``nearest`` (1 pixel per point), ``bilinear`` (2x2 pixels) or 
+          ``bicubic`` (4x4 pixels)
+        """
+
+        if interpolation == 'nearest':
+            return self.nearest_DEMxy_many(xs, ys)
+        elif interpolation == 'bilinear':
+            return self.bilinear_DEMxy_many(xs, ys)
+        elif interpolation == 'bicubic':
+            return self.bicubic_DEMxy_many(xs, ys)
+        raise ValueError("unknown interpolation: {}".format(interpolation))
+
+    def nearest_DEMxy_many(self, xs, ys):
+        """
+        Get heights of nearest DEM points to ``xs[i],ys[i]`` from this DEM set.
+        Raises ``IndexError`` if any point is out-of-range.
+
+        xs, ys: arrays of floats
+          DEM coordinates in pixels
+        """
+
+        xs = np.asarray(xs, float)
+        ys = np.asarray(ys, float)
+        return self.get_values(np.floor(xs + 0.5).astype(np.int64), np.floor(ys + 0.5).astype(np.int64))
+
+    def bilinear_DEMxy_many(self, xs, ys):
+        """
+        Get bilinearly interpolated heights of points ``xs[i],ys[i]`` from 
+        this DEM set. All corner points are looked up together with 
+        ``get_values``.
+        Raises ``IndexError`` if any point is out-of-range.
+
+        xs, ys: arrays of floats
+          DEM coordinates in pixels
+        """
+
+        xs = np.asarray(xs, float)
+        ys = np.asarray(ys, float)
+        x1s = np.floor(xs).astype(np.int64) # get surrounding integer points of x,y
+        y1s = np.floor(ys).astype(np.int64)
+        x2s = x1s + 1
+        y2s = y1s + 1
+
+        q11, q21, q12, q22 = np.split(self.get_values( # lookup DEM
+            np.concatenate((x1s, x2s, x1s, x2s)), np.concatenate((y1s, y1s, y2s, y2s))), 4)
+
+        dx1 = xs - x1s # deltas for interpolation
+        dy1 = ys - y1s
+        dx2 = 1.0 - dx1
+        dy2 = 1.0 - dy1
+        return q11 * dx2 * dy2 + q21 * dx1 * dy2 + q12 * dx2 * dy1 + q22 * dx1 * dy1
+
+    @staticmethod
+    def cubic_weights(t):
+        """
+        Get weights of pixels -1, 0, 1, 2 for cubic convolution (Catmull-Rom,
+        Keys a=-0.5) at offsets ``t`` from pixel 0.
+
+        t: array of floats, 0 <= t < 1
+
+        Returns array of shape (4, len(t)).
+        """
+        return np.array((((-0.5 * t + 1.0) * t - 0.5) * t,
+                         (1.5 * t - 2.5) * t * t + 1.0,
+                         ((-1.5 * t + 2.0) * t + 0.5) * t,
+                         (0.5 * t - 0.5) * t * t))
+
+    def bicubic_DEMxy_many(self, xs, ys):
+        """
+        Get bicubically interpolated heights of points ``xs[i],ys[i]`` from 
+        this DEM set, by cubic convolution over the 4x4 pixels surrounding
+        each point. All pixels are looked up together with ``get_stencils``.
+        Points whose 4x4 pixels are not all available (e.g. at the edge of
+        the DEM set) are interpolated bilinearly.
+        Raises ``IndexError`` if any point is out-of-range.
+
+        xs, ys: arrays of floats
+          DEM coordinates in pixels
+        """
+
+        xs = np.asarray(xs, float)
+        ys = np.asarray(ys, float)
+        x1s, y1s, qs = self.get_stencils(xs, ys)
+        return self.stencil_elevations(xs, ys, x1s, y1s, qs, 'bicubic')
+
+    def interpolate_slope_DEM_many(self, Es, Ns, interpolation='bilinear'):
+        """
+        Get interpolated heights, slopes and aspects of points ``Es[i],Ns[i]``
+        from this DEM set, see ``interpolate_slope_DEMxy_many``.
+
+        Es, Ns: arrays of floats
+          map coordinates in grid units
+        interpolation: string
+          one of ``interpolation_methods``
+        """
+
+        xs = (np.asarray(Es, float)-self.set0_E) / self.voxelE
+        ys = (np.asarray(Ns, float)-self.set0_N) / self.voxelN
+
+        return self.interpolate_slope_DEMxy_many(xs, ys, interpolation)
+
+    def interpolate_slope_DEMxy_many(self, xs, ys, interpolation='bilinear'):
+        """
+        Get interpolated heights, slopes and aspects of points ``xs[i],ys[i]``
+        from this DEM set. Heights are interpolated as 
+        ``interpolate_DEMxy_many`` and slopes and aspects as 
+        ``stencil_slopes``, all from one lookup of the 4x4 pixels surrounding 
+        each point with ``get_stencils``.
+        Raises ``IndexError`` if any point is out-of-range, ``ValueError``
+        if ``interpolation`` is unknown.
+
+        xs, ys: arrays of floats
+          DEM coordinates in pixels
+        interpolation: string
+          one of ``interpolation_methods``
+
+        Returns (heights, slopes, aspects) tuple of arrays.
+        """
+
+        if interpolation not in self.interpolation_methods:
+            raise ValueError("unknown interpolation: {}".format(interpolation))
+        xs = np.asarray(xs, float)
+        ys = np.asarray(ys, float)
+        x1s, y1s, qs = self.get_stencils(xs, ys)
+        slopes, aspects = self.stencil_slopes(xs, ys, x1s, y1s, qs, interpolation)
+        return self.stencil_elevations(xs, ys, x1s, y1s, qs, interpolation), slopes, aspects
+
+    def get_stencils(self, xs, ys):
+        """
+        Get the 4x4 pixels surrounding points ``xs[i],ys[i]`` from this DEM 
+        set, all looked up together with ``get_values``. Pixels that are
+        out-of-range are ``nan``.
+
+        xs, ys: arrays of floats
+          DEM coordinates in pixels
+
+        Returns (x1s, y1s, qs) tuple, where ``x1s,y1s`` are integer points at
+        or before ``xs,ys`` and ``qs`` is an array indexed ``[j, i, point]`` 
+        for pixel ``x1s+i-1,y1s+j-1``.
+        """
+
+        x1s = np.floor(xs).astype(np.int64)
+        y1s = np.floor(ys).astype(np.int64)
+        offsets = np.arange(-1, 3)
+        stencil_xs = np.tile(x1s + offsets[:, np.newaxis], (4, 1, 1))
+        stencil_ys = np.repeat((y1s + offsets[:, np.newaxis])[:, np.newaxis, :], 4, axis=1)
+        qs = self.get_values(stencil_xs.ravel(), stencil_ys.ravel(), 
+                             raise_exception=False).reshape(stencil_xs.shape)
+        return x1s, y1s, qs
+
+    def stencil_elevations(self, xs, ys, x1s, y1s, qs, interpolation):
+        """
+        Interpolate heights of points ``xs[i],ys[i]`` from their 4x4 pixels, 
+        as given by ``get_stencils``. Bicubic interpolation falls back to 
+        bilinear for points whose 4x4 pixels are not all available.
+        Raises ``IndexError`` if pixels needed for any point are 
+        out-of-range.
+        """
+
+        dxs = xs - x1s
+        dys = ys - y1s
+        points = np.arange(len(xs))
+        if interpolation == 'nearest':
+            nearest_is = (np.floor(xs + 0.5) - x1s).astype(np.int64) + 1
+            nearest_js = (np.floor(ys + 0.5) - y1s).astype(np.int64) + 1
+            ret = qs[nearest_js, nearest_is, points]
+            incomplete = np.isnan(ret)
+            if incomplete.any():
+                # recheck pixels to raise IndexError if out-of-range
+                self.get_values(x1s[incomplete] + nearest_is[incomplete] - 1, y1s[incomplete] + nearest_js[incomplete] - 1)
+            return ret
+
+        if interpolation == 'bicubic':
+            ret = (self.cubic_weights(dys) * (self.cubic_weights(dxs) * qs).sum(axis=1)).sum(axis=0)
+            incomplete = np.isnan(ret)
+        else:
+            ret = np.empty(len(xs))
+            incomplete = np.ones(len(xs), bool)
+        if incomplete.any():
+            inner_qs = qs[1:3, 1:3, incomplete]
+            if np.isnan(inner_qs).any():
+                # recheck inner pixels to raise IndexError if out-of-range
+                inner_xs = x1s[incomplete]
+                inner_ys = y1s[incomplete]
+                self.get_values(np.concatenate((inner_xs, inner_xs + 1, inner_xs, inner_xs + 1)),
+                                np.concatenate((inner_ys, inner_ys, inner_ys + 1, inner_ys + 1)))
+            dx1 = dxs[incomplete]
+            dy1 = dys[incomplete]
+            dx2 = 1.0 - dx1
+            dy2 = 1.0 - dy1
+            ret[incomplete] = inner_qs[0, 0] * dx2 * dy2 + inner_qs[0, 1] * dx1 * dy2 + \
+                              inner_qs[1, 0] * dx2 * dy1 + inner_qs[1, 1] * dx1 * dy1
+        return ret
+
+    def stencil_slopes(self, xs, ys, x1s, y1s, qs, interpolation):
+        """
+        Get slopes and aspects at points ``xs[i],ys[i]`` from their 4x4 
+        pixels, as given by ``get_stencils``. Gradients are found by Horn's
+        method (3x3 Sobel-weighted differences) at each of the 2x2 pixels
+        surrounding the point, then taken from the nearest pixel for 
+        ``nearest`` interpolation or interpolated bilinearly otherwise.
+
+        Returns (slopes, aspects) tuple of arrays. Slopes are in degrees from
+        horizontal. Aspects are grid bearings of the downslope direction in
+        degrees clockwise from grid north. Both are ``nan`` where pixels are
+        not available, and aspects are ``nan`` where flat.
+        """
+
+        # gradients in pixel units, indexed [j, i, point] for pixel x1s+i,y1s+j
+        x_differences = qs[:, 2:] - qs[:, :-2]
+        gradient_xs = (x_differences[:-2] + 2.0 * x_differences[1:-1] + x_differences[2:]) / 8.0
+        y_differences = qs[2:] - qs[:-2]
+        gradient_ys = (y_differences[:, :-2] + 2.0 * y_differences[:, 1:-1] + y_differences[:, 2:]) / 8.0
+
+        if interpolation == 'nearest':
+            points = np.arange(len(xs))
+            nearest_is = (np.floor(xs + 0.5) - x1s).astype(np.int64)
+            nearest_js = (np.floor(ys + 0.5) - y1s).astype(np.int64)
+            gradient_x = gradient_xs[nearest_js, nearest_is, points]
+            gradient_y = gradient_ys[nearest_js, nearest_is, points]
+        else:
+            dx1 = xs - x1s
+            dy1 = ys - y1s
+            dx2 = 1.0 - dx1
+            dy2 = 1.0 - dy1
+            weights = np.array(((dx2 * dy2, dx1 * dy2), (dx2 * dy1, dx1 * dy1)))
+            gradient_x = (gradient_xs * weights).sum(axis=0).sum(axis=0)
+            gradient_y = (gradient_ys * weights).sum(axis=0).sum(axis=0)
+
+        dqdE = gradient_x / self.voxelE
+        dqdN = gradient_y / self.voxelN
+        slopes = np.degrees(np.arctan(np.hypot(dqdE, dqdN)))
+        aspects = np.degrees(np.arctan2(-dqdE, -dqdN)) % 360.0
+        aspects[(dqdE == 0.0) & (dqdN == 0.0)] = float('nan')
+        return slopes, aspects
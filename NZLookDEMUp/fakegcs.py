@@ -0,0 +1,317 @@
+# coding: utf-8
+
+"""
+FakeGCS module
+version 1
+Copyright (c) 2014-2016 Tet Woo Lee
+
+Local stand-in for Google Cloud Storage, for exercising and benchmarking
+the cloud read path of ``DEMReader`` without App Engine.
+
+Serves the files in a directory as the objects of a bucket over the subset of
+the GCS XML API used by the bundled ``cloudstorage`` package (HEAD and ranged
+GET of objects, including multi-range GET). Latency, bandwidth and errors can
+be injected, and request counts are available from ``/_stats``.
+
+Usage (serve tiles in ``nztmdem_1000x1000`` as bucket ``dem``):
+
+    python fakegcs.py --port 8090 --latency 0.05 --bandwidth 10e6 .
+
+then run the dev server with DEMs read through cloud storage:
+
+    dev_appserver.py --env_var DEM_CLOUD=1 --env_var BUCKET_NAME=dem \\
+        --env_var GCS_API_URL=http://localhost:8090 app.yaml
+
+"""
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import BaseHTTPServer
+import email.utils
+import hashlib
+import json
+import os
+import random
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+
+class FakeGCSStats:
+    """
+    Counts of requests handled by a ``FakeGCSServer``.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+    def reset(self):
+        with self.lock:
+            self.requests = 0 #: total requests
+            self.head_requests = 0
+            self.get_requests = 0
+            self.ranges = 0 #: total byte ranges requested by GET requests
+            self.multirange_requests = 0 #: GET requests with >1 byte range
+            self.errors = 0 #: injected errors
+            self.bytes_sent = 0 #: bytes of object content sent
+    def add(self, **counts):
+        with self.lock:
+            for name, count in counts.iteritems():
+                setattr(self, name, getattr(self, name) + count)
+    def as_dict(self):
+        with self.lock:
+            return dict((name, value) for name, value in vars(self).iteritems() if name != 'lock')
+
+class FakeGCSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server serving files in ``directory`` as GCS objects.
+
+    Arguments:
+
+        address : (string, int)
+            host and port to listen on
+        directory : string
+            directory containing objects, object ``/bucket/a/b`` is served from
+            ``directory/a/b`` (if ``bucket`` is ``None``, any bucket name is
+            accepted)
+        bucket : string
+            name of bucket to serve, or ``None``
+        latency : float
+            delay in seconds added before each response
+        jitter : float
+            maximum random delay in seconds added to ``latency``
+        bandwidth : float
+            bytes per second object content is sent at, or ``None`` for
+            unlimited
+        error_rate : float
+            fraction of requests (0-1) answered with ``error_status``
+        error_status : int
+            HTTP status of injected errors
+        multirange : boolean
+            whether to answer multi-range GET requests with a multipart
+            response; if ``False`` the whole object is returned instead
+        verbose : boolean
+            whether to log each request
+
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, directory, bucket=None, latency=0.0, jitter=0.0,
+                 bandwidth=None, error_rate=0.0, error_status=503, multirange=True, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeGCSRequestHandler)
+        self.directory = os.path.abspath(directory)
+        self.bucket = bucket
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.multirange = multirange
+        self.verbose = verbose
+        self.stats = FakeGCSStats()
+        self.etags = {} # file path: (mtime, size, etag)
+        self.etags_lock = threading.Lock()
+
+    def object_path(self, url_path):
+        """
+        Get path of file for object at ``url_path``, or ``None`` if not an
+        object in this bucket.
+        """
+        url_path = urllib.unquote(url_path)
+        if url_path.startswith('/_ah/gcs/'): url_path = url_path[len('/_ah/gcs'):] # dev server stub url
+        tokens = url_path.split('/', 2)
+        if len(tokens) < 3 or not tokens[2]: return None
+        bucket, object_name = tokens[1], tokens[2]
+        if self.bucket is not None and bucket != self.bucket: return None
+        file_path = os.path.normpath(os.path.join(self.directory, object_name))
+        if not file_path.startswith(self.directory + os.sep): return None # outside directory
+        if not os.path.isfile(file_path): return None
+        return file_path
+
+    def etag(self, file_path):
+        """
+        Get etag (md5 of content, as for GCS) of file, cached until file
+        changes.
+        """
+        file_stat = os.stat(file_path)
+        with self.etags_lock:
+            cached = self.etags.get(file_path)
+        if cached is not None and cached[:2] == (file_stat.st_mtime, file_stat.st_size):
+            return cached[2]
+        md5 = hashlib.md5()
+        with open(file_path, 'rb') as object_file:
+            for data in iter(lambda: object_file.read(1024 * 1024), ''):
+                md5.update(data)
+        etag = '"{}"'.format(md5.hexdigest())
+        with self.etags_lock:
+            self.etags[file_path] = (file_stat.st_mtime, file_stat.st_size, etag)
+        return etag
+
+class FakeGCSRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    multipart_boundary = 'fake_gcs_byteranges_boundary'
+
+    def log_message(self, format, *args):
+        if self.server.verbose: BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_HEAD(self):
+        self.handle_object(send_content=False)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/_stats':
+            if 'reset' in urlparse.parse_qs(url.query): self.server.stats.reset()
+            self.send_body(200, 'application/json', json.dumps(self.server.stats.as_dict(), indent=4, sort_keys=True))
+            return
+        self.handle_object(send_content=True)
+
+    def send_body(self, status, content_type, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers: self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD': self.wfile.write(body)
+
+    def send_content(self, data):
+        """
+        Send object content, limited to the server bandwidth.
+        """
+        self.server.stats.add(bytes_sent=len(data))
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(data)
+            return
+        chunk_size = 64 * 1024
+        start_time = time.time()
+        for offset in xrange(0, len(data), chunk_size):
+            self.wfile.write(data[offset:offset + chunk_size])
+            delay = start_time + (offset + chunk_size) / bandwidth - time.time()
+            if delay > 0: time.sleep(delay)
+
+    def parse_ranges(self, file_size):
+        """
+        Parse Range header into list of (first, last) inclusive byte
+        positions. Returns ``None`` if no Range header, or ``[]`` if no
+        range is satisfiable.
+        """
+        range_header = self.headers.get('range')
+        if range_header is None or not range_header.startswith('bytes='): return None
+        ranges = []
+        for range_spec in range_header[len('bytes='):].split(','):
+            first, _, last = range_spec.strip().partition('-')
+            if first == '': # suffix range, last n bytes
+                first, last = max(file_size - int(last), 0), file_size - 1
+            else:
+                first = int(first)
+                last = file_size - 1 if last == '' else min(int(last), file_size - 1)
+            if first <= last: ranges.append((first, last))
+        return ranges
+
+    def handle_object(self, send_content):
+        server = self.server
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay > 0: time.sleep(delay)
+        server.stats.add(requests=1, head_requests=0 if send_content else 1, get_requests=1 if send_content else 0)
+
+        if server.error_rate and random.random() < server.error_rate:
+            server.stats.add(errors=1)
+            self.send_body(server.error_status, 'text/plain', 'Injected error')
+            return
+
+        file_path = server.object_path(urlparse.urlparse(self.path).path)
+        if file_path is None:
+            self.send_body(404, 'text/plain', 'Not found')
+            return
+        file_stat = os.stat(file_path)
+        file_size = file_stat.st_size
+        headers = [('ETag', server.etag(file_path)),
+                   ('Last-Modified', email.utils.formatdate(file_stat.st_mtime, usegmt=True)),
+                   ('x-goog-stored-content-length', str(file_size)),
+                   ('Accept-Ranges', 'bytes')]
+
+        ranges = self.parse_ranges(file_size) if send_content else None
+        if ranges is not None and len(ranges) == 0:
+            self.send_body(416, 'text/plain', 'Requested range not satisfiable',
+                           [('Content-Range', 'bytes */{}'.format(file_size))])
+            return
+        if ranges is not None and len(ranges) > 1 and not server.multirange:
+            ranges = None # behave like a server without multi-range support, send whole object
+        if ranges is not None:
+            server.stats.add(ranges=len(ranges), multirange_requests=1 if len(ranges) > 1 else 0)
+
+        with open(file_path, 'rb') as object_file:
+            if ranges is None:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(file_size))
+                for name, value in headers: self.send_header(name, value)
+                self.end_headers()
+                if send_content: self.send_content(object_file.read())
+            elif len(ranges) == 1:
+                first, last = ranges[0]
+                object_file.seek(first)
+                data = object_file.read(last - first + 1)
+                self.send_response(206)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(first, last, file_size))
+                for name, value in headers: self.send_header(name, value)
+                self.end_headers()
+                self.send_content(data)
+            else:
+                parts = []
+                for first, last in ranges:
+                    object_file.seek(first)
+                    parts.append('--{}\r\nContent-Type: application/octet-stream\r\n'
+                                 'Content-Range: bytes {}-{}/{}\r\n\r\n'.format(
+                                 self.multipart_boundary, first, last, file_size))
+                    parts.append(object_file.read(last - first + 1))
+                    parts.append('\r\n')
+                parts.append('--{}--\r\n'.format(self.multipart_boundary))
+                body = ''.join(parts)
+                self.send_response(206)
+                self.send_header('Content-Type', 'multipart/byteranges; boundary=' + self.multipart_boundary)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers: self.send_header(name, value)
+                self.end_headers()
+                self.send_content(body)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a directory as a fake Google Cloud Storage bucket.")
+    parser.add_argument('directory', help="directory containing objects")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--bucket', default=None, help="only serve this bucket name (default: any)")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added before each response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="max random seconds added to latency")
+    parser.add_argument('--bandwidth', type=float, default=None, help="bytes/second for object content")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument('--error-status', type=int, default=503, help="HTTP status of failed requests")
+    parser.add_argument('--no-multirange', action='store_true', help="answer multi-range requests with whole object")
+    parser.add_argument('--verbose', action='store_true', help="log each request")
+    args = parser.parse_args()
+
+    server = FakeGCSServer((args.host, args.port), args.directory, bucket=args.bucket,
+                           latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth,
+                           error_rate=args.error_rate, error_status=args.error_status,
+                           multirange=not args.no_multirange, verbose=args.verbose)
+    print "Serving {} on http://{}:{}/".format(args.directory, args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print json.dumps(server.stats.as_dict(), indent=4, sort_keys=True)
@@ -22,8 +22,10 @@ Copyright (c) 2014-2016 Tet Woo Lee
 import os
 import csv
 import logging
+import math
+import numpy as np
 import webapp2
-from nztm2000 import NZTM2000
+from nztm2000 import projection_engines
 import deminterpolater
 import struct
 import traceback
@@ -31,8 +33,11 @@ import json
 import traceback
 import re
 from urlparse import urlparse
+from itertools import izip, chain
 
 is_debug = True
+NZTM2000 = projection_engines[os.environ.get('NZTM_ENGINE', 'redfearn')] # 'redfearn' (LINZ series), 'kruger' (most accurate) or 'grid' (fastest for arrays), see nztm2000
+projection_engines['grid'].grid_directory = os.environ.get('NZTM_GRID_DIR') # e.g. /tmp/nztm_grids, grids rebuilt per instance if not set
 
 class BaseHandler(webapp2.RequestHandler):
     pass
@@ -65,6 +70,8 @@ locations
 path, submodes:
     fixed # samples, ala google elevation, does not interpolate all original points in path
     fixed x distance, will interpolate all original points in path plus additional points every x distance
+    tolerance, will interpolate all original points in path plus fewest points to keep profile within tolerance (m)
+    stats, will return only ascent/descent, min/max elevation, grade and length of path
     'ideal' will return all significant elevation points in path
 
 output modes and input data type not linked
@@ -84,6 +91,52 @@ class ResponseType:
     BINARY = 'binary'
     CSV = 'csv'
 
+class BinaryFormat2:
+    """
+    Binary response format version 2 (``version=2``). A response is a 
+    sequence of blocks, each a header followed by an optional message and 
+    little-endian arrays of the block's points by column. The message and 
+    each column are padded to a multiple of 8 bytes, so columns can be 
+    viewed in place (e.g. numpy ``frombuffer``, JS typed arrays).
+
+    Header (24 bytes): magic ``NZDL``, version (uint16), flags (uint16), 
+    status (uint16, index in ``statuses``), is_last (uint16), count (uint32,
+    points in block) and message_length (uint32), then 4 bytes padding.
+
+    Columns, in order, as given by flags: lat, lng (float64, E, N if 
+    ``FLAG_NZTM``), distance (float64), elevation (float32), path_index 
+    (int32, -1 if none), slope, aspect (float32, nan if not available). With
+    ``FLAG_STATS``, a single column of stats (float64, in order of 
+    ``ProfileStats.fields``, nan if None) instead.
+
+    Results are streamed as they are generated. The last block has no points,
+    and gives the status of the whole response, with error message and 
+    traceback lines if not OK.
+    """
+    magic = 'NZDL'
+    version = 2
+    header = struct.Struct('<4sHHHHII4x')
+    FLAG_LATLNG = 1
+    FLAG_NZTM = 2
+    FLAG_DISTANCE = 4
+    FLAG_SLOPE = 8
+    FLAG_STATS = 16
+    statuses = ('OK', 'INVALID_REQUEST', 'OVER_QUERY_LIMIT', 'REQUEST_DENIED', 'UNKNOWN_ERROR')
+
+    @classmethod
+    def block(cls, flags, status, columns=(), is_last=False, message=''):
+        """
+        Encode block, with ``columns`` as arrays of the right types.
+        """
+        count = len(columns[0]) if columns else 0
+        status_index = cls.statuses.index(status) if status in cls.statuses else cls.statuses.index('UNKNOWN_ERROR')
+        parts = [cls.header.pack(cls.magic, cls.version, flags, status_index, is_last, count, len(message)),
+                 message, '\0' * (-len(message) % 8)]
+        for column in columns:
+            data = column.tostring()
+            parts += [data, '\0' * (-len(data) % 8)]
+        return ''.join(parts)
+
 class ElevationRequestHandler(webapp2.RequestHandler):
     def __init__(self, request, response):
         # Set self.request, self.response and self.app.
@@ -94,11 +147,28 @@ class ElevationRequestHandler(webapp2.RequestHandler):
         
         self.set_status_ok()
         self.response_type = None
-        self.latlngs = []
+        self.binary_version = 1
+        self.latlngs = [] # input points, (E,N) pairs if is_NZTM, or array of pairs
+        self.is_NZTM = False
         self.is_path = False
         self.samples = None
         self.stepsize = None
-        self.results = []
+        self.tolerance = None
+        self.interpolation = 'bilinear'
+        self.is_slope = False
+        self.is_stats = False
+        self.is_distance = False
+        self.hysteresis = 0.0
+        self.is_compact = False
+        self.is_columns = False
+        self.precision = None # decimal places of lat,lng, default depends on is_NZTM
+        self.elevation_precision = 2
+        self.stats = None
+        self.result_chunks = None # generator of chunks of results, see iter_result_chunks
+        self.first_results = None # first chunk of results, generated with the request
+        self.pixel_memo = None # memo of pixels looked up by this request, see next_result_chunk
+        self.path_distance = 0.0 # distance along path of last output point
+        self.path_EN = None # E, N of last output point
     def handle_exception(self, exception, debug):
         logging.warning(exception)
         if isinstance(exception, webapp2.HTTPException):
@@ -136,6 +206,7 @@ class ElevationRequestHandler(webapp2.RequestHandler):
         locations_str = self.request.get("locations", default_value=None)
         path_str = self.request.get("path", default_value=None)
         try:
+            self.process_crs_param()
             if locations_str is not None: 
                 latlngs_str = locations_str
                 self.is_path = False
@@ -149,7 +220,8 @@ class ElevationRequestHandler(webapp2.RequestHandler):
                 lat,lng = location.split(",")
                 lat = float(lat)
                 lng = float(lng)
-                if lat<-90.0 or lat>+90.0 or lng<-180.0 or lng>+180.0:
+                if self.is_NZTM: pass # E,N, range checked when looked up
+                elif lat<-90.0 or lat>+90.0 or lng<-180.0 or lng>+180.0:
                     raise ValueError("lat or lng out of range")
                 self.latlngs.append((lat,lng))
 
@@ -174,13 +246,42 @@ class ElevationRequestHandler(webapp2.RequestHandler):
 
     Parameters with POST:
         type=path | locations (default)
-        samples=number (optional, defaults to None)
-        stepsize=number (optional, defaults to None)
+        samples=number (optional, defaults to None, at most HardLimits.max_path_steps)
+        stepsize=number (optional, defaults to None, increased to give at most about
+            HardLimits.max_path_steps steps)
+        tolerance=number (optional, defaults to None, overrides stepsize)
+        crs=4326 (default) | 2193 (optional, input and output points as NZTM2000 
+            E,N instead of lat,lng, in metres or x1e2 as binary, csv headings E 
+            or easting and N or northing)
+        interpolation=nearest | bilinear (default) | bicubic (optional, nearest
+            and bicubic only with locations, samples or stepsize)
+        slope=1 (optional, also return slope and aspect in degrees of each result)
+        version=2 (optional, binary format version, see BinaryFormat2, defaults to 1)
+        stats=1 (optional, return statistics of path instead of results)
+        distance=1 (optional, return ground distance along path of each result instead
+            of lat,lng, which is only returned for original path points, or 
+            not at all as binary)
+        hysteresis=number (optional, defaults to 0, min change in elevation for ascent/descent stats)
+        compact=1 (optional, json without whitespace, numbers rounded as for csv 
+            and missing values null)
+        shape=columns (optional, compact json results as an object of arrays, 
+            one per field, instead of an array of objects)
+        precision=number (optional, decimal places of lat,lng or E,N in compact json)
+        elevation_precision=number (optional, decimal places of elevation in compact json)
+
+    Results are streamed as they are generated. 
+    Errors after the first results end the output with a trailer: for csv an error line 
+    (#status,message,traceback), for binary a record with all values -2**31 
+    followed by status, message and traceback lines as for an error response,
+    for json the status, error_message and traceback fields following 
+    the results, which are incomplete. Columns of compact json (shape=columns) 
+    are not streamed, but buffered until all results are generated.
     """
     def post(self):
         self.set_default_headers()
         self.process_request_path()
         try:
+            self.process_crs_param()
             if self.request.content_type=="application/octet-stream":
                 # read binary data
                 if self.request.content_length % 4 != 0:
@@ -189,12 +290,10 @@ class ElevationRequestHandler(webapp2.RequestHandler):
                 if num_packed_ints % 2 != 0:
                      raise ValueError("Expected pairs of input values, got %i."%num_packed_ints)
 
-                unpacked_ints = struct.unpack('!%ii'%num_packed_ints, self.request.body)
-
-                it = iter(unpacked_ints)
-                for lat in it:
-                    lng = next(it)
-                    self.latlngs.append((lat*1.0e-7,lng*1.0e-7))
+                # pairs of big-endian 32-bit ints, decoded together
+                records = np.frombuffer(self.request.body, np.dtype([('lat','>i4'),('lng','>i4')]))
+                scale = 1.0e-2 if self.is_NZTM else 1.0e-7
+                self.latlngs = np.column_stack((records['lat']*scale, records['lng']*scale))
             elif self.request.content_type == "multipart/form-data":
                 # read CSV data
                 if self.request.POST.get("fileupload")=='':
@@ -216,13 +315,15 @@ class ElevationRequestHandler(webapp2.RequestHandler):
                     # assume have headings, look for right columns
                     csv_reader = csv.DictReader(csv_data.splitlines())
                     lngname = latname = None
+                    if self.is_NZTM: latnames, lngnames = ('E','easting'), ('N','northing')
+                    else: latnames, lngnames = ('latitude','lat'), ('longitude','lng')
                     for fieldname in csv_reader.fieldnames:
-                      if latname is None and (fieldname=='latitude' or fieldname=='lat'):
+                      if latname is None and fieldname in latnames:
                         latname = fieldname
-                      if lngname is None and (fieldname=='longitude' or fieldname=='lng'):
+                      if lngname is None and fieldname in lngnames:
                         lngname = fieldname
                     if lngname is None or latname is None: 
-                        raise Exception('Invalid CSV file, no lat/latitude or lng/longitude headings')
+                        raise Exception('Invalid CSV file, no {}/{} or {}/{} headings'.format(latnames[1],latnames[0],lngnames[1],lngnames[0]))
                     for row in csv_reader:
                         latlng = (float(row[latname]), float(row[lngname]))
                         self.latlngs.append(latlng)
@@ -248,6 +349,7 @@ class ElevationRequestHandler(webapp2.RequestHandler):
     def process_request_path(self):
         if self.request.path=="/elevation/binary":
             self.response_type = ResponseType.BINARY;
+            self.binary_version = 2 if self.request.get("version")=="2" else 1
         elif self.request.path=="/elevation/json":
             self.response_type = ResponseType.JSON;
         elif self.request.path=="/elevation/csv":
@@ -268,67 +370,222 @@ class ElevationRequestHandler(webapp2.RequestHandler):
         else:
             # no other requests specified
             self.abort(404)
+    def process_crs_param(self):
+        # coordinate system of input and output points, 4326 (WGS84 lat,lng) or 2193 (NZTM2000 E,N)
+        crs_str = self.request.get("crs", default_value="4326")
+        if crs_str.upper().startswith("EPSG:"): crs_str = crs_str[5:]
+        if crs_str not in ('4326', '2193'): raise ValueError("unknown crs "+crs_str)
+        self.is_NZTM = crs_str == '2193'
     def process_default_params(self):
         samples_str = self.request.get("samples")
         stepsize_str = self.request.get("stepsize")
         if samples_str != '':
             self.samples = int(samples_str)
             if self.samples == -1: self.samples = None
+            else: self.samples = min(self.samples, deminterpolater.HardLimits.max_path_steps)
         else: self.samples = None
 
         if stepsize_str != '':
             self.stepsize = float(stepsize_str)
             if self.stepsize <= 0: self.stepsize = None
         else: self.stepsize = None
+
+        tolerance_str = self.request.get("tolerance")
+        if tolerance_str != '':
+            self.tolerance = float(tolerance_str)
+            if self.tolerance < 0: self.tolerance = None
+        else: self.tolerance = None
+
+        self.interpolation = self.request.get("interpolation", default_value="bilinear")
+
+        self.is_slope = self.request.get("slope") not in ('', '0', 'false')
+        self.is_stats = self.request.get("stats") not in ('', '0', 'false')
+        self.is_distance = self.request.get("distance") not in ('', '0', 'false')
+        hysteresis_str = self.request.get("hysteresis")
+        if hysteresis_str != '':
+            self.hysteresis = max(float(hysteresis_str), 0.0)
+        else: self.hysteresis = 0.0
+
+        self.is_columns = self.request.get("shape") == "columns"
+        self.is_compact = self.is_columns or self.request.get("compact") not in ('', '0', 'false')
+        precision_str = self.request.get("precision")
+        if precision_str != '':
+            self.precision = min(max(int(precision_str), 0), 15)
+        else: self.precision = None
+        elevation_precision_str = self.request.get("elevation_precision")
+        if elevation_precision_str != '':
+            self.elevation_precision = min(max(int(elevation_precision_str), 0), 15)
+        else: self.elevation_precision = 2
     def generate_result(self):
+        # calculate stats, or start generating results, which continues in chunks from 
+        # next_results as the response is written
         try:
-            if self.is_path:
-                if self.samples is not None:
-                    path = [NZTM2000.latlng_to_NZTM(*latlng) for latlng in self.latlngs]
-                    track = deminterpolater.interpolate_path_bysamples(path, samples=self.samples)
-                    for j,point in enumerate(track):
-                        E, N, elevation = point
-                        if j==0:
-                            path_index = 0
-                        elif j==len(track)-1:
-                            path_index = len(self.latlngs)-1
-                        else: path_index = None
-                        lat,lng = NZTM2000.NZTM_to_latlng(E,N)
-                        self.results.append((lat,lng,elevation,path_index))
-                else:
-                    latlng2 = None
-                    for i, latlng in enumerate(self.latlngs):
-                        latlng1 = latlng2
-                        latlng2 = latlng
-                        if latlng1 is not None:
-                            point1 = NZTM2000.latlng_to_NZTM(*latlng1)
-                            point2 = NZTM2000.latlng_to_NZTM(*latlng2)
-                            if self.stepsize is None:
-                                track = deminterpolater.interpolate_line_smart(point1[0], point1[1], point2[0], point2[1])
-                            else:
-                                track = deminterpolater.interpolate_line_bysteps(point1[0], point1[1], point2[0], point2[1], stepsize=self.stepsize)
-                            for j,point in enumerate(track):
-                                E, N, elevation = point
-                                if j==0:
-                                    if i>1: continue
-                                    path_index = i-1
-                                elif j==len(track)-1:
-                                    path_index = i
-                                else: path_index = None
-                                lat,lng = NZTM2000.NZTM_to_latlng(E,N)
-                                self.results.append((lat,lng,elevation,path_index))
-
+            if self.is_stats:
+                if not self.is_path: raise ValueError("stats only available for paths")
+                if self.interpolation != 'bilinear': raise ValueError("stats only available with bilinear interpolation")
+                path = np.column_stack(self.latlngs_to_NZTM())
+                with deminterpolater.demset.pixel_memo(): # reuse pixels between lookups of this request
+                    self.stats = deminterpolater.path_stats(path, hysteresis=self.hysteresis)
             else:
-                for i,latlng in enumerate(self.latlngs):
-                    lat,lng = latlng
-                    point1 = NZTM2000.latlng_to_NZTM(lat,lng)
-                    elevation = deminterpolater.demset.interpolate_DEM(*point1)
-                    self.results.append((lat,lng,elevation,i))
+                # generate first chunk now, so errors in parameters or first lookups give an error response
+                self.result_chunks = self.iter_result_chunks()
+                self.first_results = self.next_result_chunk()
             self.set_status_ok()
         except (ValueError,IndexError) as e:
-            # can get here if NZTM2000 out of range, or no DEM for coordinates
-            tb = traceback.format_exc()
-            self.set_status_error("INVALID_REQUEST","Error looking up DEM: "+str(e),tb)
+            self.set_status_lookup_error(e)
+    def set_status_lookup_error(self, exception):
+        # can get here if NZTM2000 out of range, or no DEM for coordinates
+        tb = traceback.format_exc()
+        self.set_status_error("INVALID_REQUEST","Error looking up DEM: "+str(exception),tb)
+    def next_result_chunk(self):
+        # generate next chunk of results, None if no more. The pixel memo of this request is only
+        # set while generating, and generators of results have no cleanup pending between chunks,
+        # so nothing is left set on this thread, or uncollectable (python 2 can't collect paused
+        # generators with cleanup pending in reference cycles, as with this handler), if the 
+        # response is paused between chunks or not read to the end
+        if self.result_chunks is None: return None
+        try:
+            with deminterpolater.demset.pixel_memo(memo=self.pixel_memo) as pixel_memo:
+                self.pixel_memo = pixel_memo # reuse pixels between lookups of this request
+                return next(self.result_chunks)
+        except StopIteration:
+            self.close_results()
+            return None
+    def close_results(self):
+        # stop generating results, releasing generators of results
+        if self.result_chunks is not None:
+            self.result_chunks.close()
+            self.result_chunks = None
+    def next_results(self):
+        # next chunk of results, the first generated with the request, None if no more
+        if self.first_results is not None:
+            results, self.first_results = self.first_results, None
+            return results
+        return self.next_result_chunk()
+    def iter_result_chunks(self):
+        # generate results in chunks, each a (lat,lng,elevation,path_index,slope,aspect,distance) tuple of
+        # arrays, see iter_rows for missing values, step by step with next_result_chunk
+        if self.is_distance and not self.is_path:
+            raise ValueError("distance only available for paths")
+        elif self.is_path:
+            if self.samples is not None:
+                path = np.column_stack(self.latlngs_to_NZTM())
+                track = deminterpolater.iter_path_bysamples(path, samples=self.samples, interpolation=self.interpolation, slope=self.is_slope)
+                # samples are evenly spaced along path, so may cut corners at path points
+                sample_distance = deminterpolater.ground_distances(*path.T).sum() / (max(self.samples, 2)-1)
+                result_chunks = self.iter_track(track, 0, len(self.latlngs)-1, sample_distance=sample_distance)
+            elif self.stepsize is None or self.tolerance is not None:
+                if self.interpolation != 'bilinear': raise ValueError("smart and tolerance paths only available with bilinear interpolation")
+                path = np.column_stack(self.latlngs_to_NZTM())
+                if len(path) < 2:
+                    result_chunks = [] # no legs, so no results, as for stepsize
+                else:
+                    if self.tolerance is not None:
+                        track = deminterpolater.iter_path_bytolerance(path, tolerance=self.tolerance, slope=self.is_slope)
+                    else:
+                        track = deminterpolater.iter_path_smart(path, slope=self.is_slope)
+                    result_chunks = self.iter_indexed_track(track)
+            else:
+                Es, Ns = self.latlngs_to_NZTM()
+                # at most about HardLimits.max_path_steps steps along whole path
+                stepsize = max(self.stepsize, deminterpolater.ground_distances(Es, Ns).sum() / deminterpolater.HardLimits.max_path_steps)
+                result_chunks = chain.from_iterable(
+                    self.iter_track(deminterpolater.iter_line_bysteps(Es[i-1], Ns[i-1], Es[i], Ns[i], stepsize=stepsize, interpolation=self.interpolation, slope=self.is_slope), 
+                                    i-1, i, skip_first=i>1)
+                    for i in xrange(1, len(self.latlngs)))
+            latlngs = np.array(self.latlngs, float).reshape(-1, 2)
+            for results in result_chunks:
+                if self.is_distance:
+                    # lat,lng only of original path points, as input
+                    lats, lngs, elevations, path_indices = results[:4]
+                    is_vertex = path_indices >= 0
+                    lats[is_vertex], lngs[is_vertex] = latlngs[path_indices[is_vertex]].T
+                yield results
+
+        else:
+            Es, Ns = self.latlngs_to_NZTM()
+            # look up all points together
+            if self.is_slope:
+                elevations, slopes, aspects = deminterpolater.demset.interpolate_slope_DEM_many(Es, Ns, self.interpolation)
+            else:
+                elevations = deminterpolater.demset.interpolate_DEM_many(Es, Ns, self.interpolation)
+                slopes = aspects = None
+            latlngs = np.array(self.latlngs, float).reshape(-1, 2)
+            yield (latlngs[:,0], latlngs[:,1], elevations, np.arange(len(elevations)), slopes, aspects, None)
+    def iter_track(self, track, first_path_index, last_path_index, skip_first=False, sample_distance=None):
+        # results of chunks from a streaming interpolator, setting path_index of first and last points
+        # if sample_distance given, points are this distance apart along path
+        first = True
+        sample = 0
+        held = None # last chunk, held back to set path_index of its last point
+        for chunk in track:
+            Es, Ns, elevations = chunk[:3]
+            slopes, aspects = chunk[3:] if self.is_slope else (None, None)
+            if self.is_distance and sample_distance is not None:
+                distances = (sample + np.arange(len(Es))) * sample_distance
+                lats = np.empty(len(Es))
+                lats.fill(np.nan)
+                lngs = lats.copy()
+            else: lats, lngs, distances = self.chunk_locations(Es, Ns)
+            sample += len(Es)
+            path_indices = -np.ones(len(Es), int)
+            results = (lats, lngs, elevations, path_indices, slopes, aspects, distances)
+            if first:
+                first = False
+                path_indices[0] = first_path_index
+                if skip_first: results = tuple(None if values is None else values[1:] for values in results)
+            if len(results[2]) == 0: continue
+            if held: yield held
+            held = results
+        held[3][-1] = last_path_index
+        yield held
+    def iter_indexed_track(self, track):
+        # results of chunks from a streaming interpolator that gives path_index of each point, -1 if none
+        for chunk in track:
+            Es, Ns, elevations, path_indices = chunk[:4]
+            slopes, aspects = chunk[4:] if self.is_slope else (None, None)
+            lats, lngs, distances = self.chunk_locations(Es, Ns)
+            yield (lats, lngs, elevations, np.asarray(path_indices, int), slopes, aspects, distances)
+    def chunk_locations(self, Es, Ns):
+        # returns lat, lng and distance along path of chunk of output points in path order, 
+        # lat, lng nan if is_distance (not projected), else distance None
+        if not self.is_distance:
+            lats, lngs = self.NZTM_to_latlngs(Es, Ns)
+            return lats, lngs, None
+        if self.path_EN is None: self.path_EN = (Es[0], Ns[0])
+        distances = self.path_distance + np.cumsum(deminterpolater.ground_distances(
+            np.concatenate(([self.path_EN[0]], Es)), np.concatenate(([self.path_EN[1]], Ns))))
+        self.path_distance = distances[-1]
+        self.path_EN = (Es[-1], Ns[-1])
+        lats = np.empty(len(Es))
+        lats.fill(np.nan)
+        return lats, lats.copy(), distances
+    def latlngs_to_NZTM(self):
+        # project all input points together, returns E, N arrays
+        latlngs = np.array(self.latlngs, float).reshape(-1, 2)
+        if self.is_NZTM:
+            valid = np.isfinite(latlngs).all(axis=1)
+            if not valid.all():
+                raise ValueError("E,N not finite at point {}".format(np.nonzero(~valid)[0][0]))
+            return latlngs[:,0], latlngs[:,1]
+        Es, Ns, valid = NZTM2000.latlng_to_NZTM_many(latlngs[:,0], latlngs[:,1])
+        if not valid.all():
+            raise ValueError("lat,lng out of range for NZTM2000 at point {}".format(np.nonzero(~valid)[0][0]))
+        return Es, Ns
+    def NZTM_to_latlngs(self, Es, Ns):
+        # project chunk of output points together, returns lat, lng arrays
+        if self.is_NZTM: return Es, Ns
+        lats, lngs, valid = NZTM2000.NZTM_to_latlng_many(Es, Ns)
+        if not valid.all(): raise ValueError("E,N out of range for NZTM2000")
+        return lats, lngs
+    def iter_rows(self, results):
+        # iterate over rows of chunk of results, as (lat,lng,elevation,path_index,slope,aspect,distance),
+        # with lat,lng, path_index, slope, aspect and distance None if not in chunk or nan (-1 for path_index)
+        lats, lngs, elevations, path_indices, slopes, aspects, distances = results
+        none_if_nan = lambda values: [None]*len(elevations) if values is None else [None if math.isnan(value) else value for value in values.tolist()]
+        return izip(none_if_nan(lats), none_if_nan(lngs), elevations.tolist(), 
+                    [None if path_index < 0 else path_index for path_index in path_indices.tolist()],
+                    none_if_nan(slopes), none_if_nan(aspects), none_if_nan(distances))
     def process_response(self):
         if self.response_type == ResponseType.BINARY:
             return self.process_response_binary()
@@ -339,66 +596,269 @@ class ElevationRequestHandler(webapp2.RequestHandler):
         else:
             raise Exception("Unknown response type")
         
+    def iter_response(self, encode_chunk, encode_error, encode_end=None):
+        # encode chunks of results as they are generated, for streaming response, ending with
+        # encoded error as trailer if generating results fails, else encode_end if given.
+        # No exception handlers are pending while paused between chunks, see next_result_chunk
+        while True:
+            encoded, is_error = self.encode_next_results(encode_chunk, encode_error)
+            if encoded is None: break
+            yield encoded
+            if is_error: return
+        if encode_end is not None: yield encode_end()
+    def encode_next_results(self, encode_chunk, encode_error):
+        # encode next chunk of results, returns (encoded, is_error), encoded None if no more results,
+        # or encoded error if generating or encoding results fails
+        try:
+            results = self.next_results()
+            return (None if results is None else encode_chunk(results)), False
+        except Exception as e:
+            self.close_results()
+            logging.warning(e)
+            if isinstance(e, (ValueError,IndexError)):
+                self.set_status_lookup_error(e)
+            else:
+                self.set_status_error("UNKNOWN_ERROR",str(e),traceback.format_exc())
+            return encode_error(), True
+
+    def binary_error(self):
+        return "{}\n{}\n{}\n".format(self.status, self.error_message or '', self.error_traceback or '')
     def process_response_binary(self):
+        if self.binary_version == 2:
+            return self.process_response_binary_v2()
         if self.is_error:
             self.response.headers['Content-Type'] = 'text/plain'  
-            self.response.out.write(self.status)
-            self.response.out.write("\n")
-            if self.error_message: self.response.out.write(self.error_message)
-            self.response.out.write("\n")
-            if self.error_traceback: self.response.out.write(self.error_traceback)
-            self.response.out.write("\n")
+            self.response.out.write(self.binary_error())
+        elif self.stats is not None:
+            self.response.headers['Content-Type'] = 'application/octet-stream'  
+            # stats as doubles, in order of ProfileStats.fields, nan if None
+            stats = [self.stats[field] for field in deminterpolater.ProfileStats.fields]
+            self.response.write(struct.pack("!%id"%len(stats), *[float('nan') if value is None else value for value in stats]))
         else:
             self.response.headers['Content-Type'] = 'application/octet-stream'  
-            for result in self.results:
-                lat,lng,elevation,path_index = result
-                if path_index is None: path_index = -1
-                self.response.write(struct.pack("!4i",lat*1e7,lng*1e7,elevation*1e3,path_index))
+            scale = 1e2 if self.is_NZTM else 1e7 # E,N in cm, lat,lng in 1e-7 degrees
+            # records of big-endian 32-bit ints, distance in cm instead of lat,lng if is_distance
+            fields = [('distance','>i4')] if self.is_distance else [('lat','>i4'),('lng','>i4')]
+            fields += [('elevation','>i4'),('path_index','>i4')]
+            if self.is_slope: fields += [('slope','>i4'),('aspect','>i4')]
+            record_dtype = np.dtype(fields)
+            def encode_chunk(results):
+                lats, lngs, elevations, path_indices, slopes, aspects, distances = results
+                records = np.empty(len(elevations), record_dtype)
+                if self.is_distance:
+                    records['distance'] = distances*1e2
+                else:
+                    records['lat'] = lats*scale
+                    records['lng'] = lngs*scale
+                records['elevation'] = elevations*1e3
+                records['path_index'] = path_indices # -1 if none
+                if self.is_slope:
+                    # slope and aspect x1e3, -1 if not available
+                    records['slope'] = np.where(np.isnan(slopes), -1.0, slopes*1e3)
+                    records['aspect'] = np.where(np.isnan(aspects), -1.0, aspects*1e3)
+                return records.tostring()
+            def encode_error():
+                # record of all -2**31, then error as text
+                record = np.empty(1, record_dtype)
+                record.view('>i4')[:] = -2**31
+                return record.tostring() + self.binary_error()
+            self.response.app_iter = self.iter_response(encode_chunk, encode_error)
+        #logging.debug(self.response)
+        return self.response
+    def process_response_binary_v2(self):
+        self.response.headers['Content-Type'] = 'application/octet-stream'  
+        if self.is_error: flags = 0
+        elif self.stats is not None: flags = BinaryFormat2.FLAG_STATS
+        else:
+            flags = ((BinaryFormat2.FLAG_DISTANCE if self.is_distance else BinaryFormat2.FLAG_LATLNG) |
+                     (BinaryFormat2.FLAG_NZTM if self.is_NZTM else 0) | (BinaryFormat2.FLAG_SLOPE if self.is_slope else 0))
+        def encode_end():
+            # last block, with status and error message and traceback lines if not OK
+            message = "{}\n{}\n".format(self.error_message or '', self.error_traceback or '') if self.is_error else ''
+            return BinaryFormat2.block(flags, self.status, is_last=True, message=message)
+        if self.is_error:
+            self.response.write(encode_end())
+        elif self.stats is not None:
+            stats = [self.stats[field] for field in deminterpolater.ProfileStats.fields]
+            stats = np.array([float('nan') if value is None else value for value in stats], '<f8')
+            self.response.write(BinaryFormat2.block(flags, self.status, (stats,)) + encode_end())
+        else:
+            def encode_chunk(results):
+                lats, lngs, elevations, path_indices, slopes, aspects, distances = results
+                if self.is_distance: columns = [np.asarray(distances, '<f8')]
+                else: columns = [np.asarray(lats, '<f8'), np.asarray(lngs, '<f8')]
+                columns += [np.asarray(elevations, '<f4'), np.asarray(path_indices, '<i4')]
+                if self.is_slope: columns += [np.asarray(slopes, '<f4'), np.asarray(aspects, '<f4')]
+                return BinaryFormat2.block(flags, self.status, columns)
+            self.response.app_iter = self.iter_response(encode_chunk, encode_end, encode_end)
         #logging.debug(self.response)
         return self.response
-        
             
+    def json_result(self, result):
+        # object of a result row, see iter_rows
+        lat,lng,elevation,path_index,slope,aspect,distance = result
+        outresult = {}
+        outresult["elevation"] = elevation
+        if lat is None: pass # distance only
+        elif self.is_NZTM: outresult["location"] = {"E":lat,"N":lng}
+        else: outresult["location"] = {"lat":lat,"lng":lng}
+        if self.is_distance:
+            outresult["distance"] = distance
+        if path_index is not None:
+            outresult["path_index"] = path_index
+        if self.is_slope:
+            outresult["slope"] = slope
+            outresult["aspect"] = aspect
+        return outresult
     def process_response_json(self):
+        if not self.is_error and self.stats is None:
+            if self.is_compact: return self.process_response_json_compact()
+            return self.process_response_json_results()
         response_dict = {
             'status': self.status}
         if self.error_message is not None: 
             response_dict['error_message'] = self.error_message
         if self.error_traceback is not None: 
             response_dict['traceback'] = self.error_traceback
-        outresults = []
-        for result in self.results:
-            lat,lng,elevation,path_index = result
-            outresult = {}
-            outresult["elevation"] = elevation
-            outresult["location"] = {"lat":lat,"lng":lng}
-            if path_index is not None:
-                outresult["path_index"] = path_index
-            outresults.append(outresult)
-        response_dict['results'] = outresults
+        if self.stats is not None:
+            response_dict['stats'] = self.stats
+        else:
+            response_dict['results'] = []
         
         self.response.headers['Content-Type'] = 'application/json'   
-        self.response.out.write(json.dumps(response_dict, indent=4, sort_keys=True))                
+        if self.is_compact:
+            self.response.out.write(json.dumps(response_dict, separators=(',',':'), sort_keys=True))
+        else:
+            self.response.out.write(json.dumps(response_dict, indent=4, sort_keys=True))                
         #logging.debug(self.response)
         return self.response
+    def process_response_json_results(self):
+        # stream results formatted as by json.dumps of whole response, indented and with sorted
+        # keys, so status fields follow results, and errors generating results can be reported
+        self.response.headers['Content-Type'] = 'application/json'
+        is_first = [True] # whether next result is first, separated from previous results otherwise
+        def encode_chunk(results):
+            outresults = [self.json_result(result) for result in self.iter_rows(results)]
+            if not outresults: return ''
+            # objects of list, indented as within response
+            encoded = '    '+json.dumps(outresults, indent=4, sort_keys=True)[2:-2].replace('\n', '\n    ')
+            if is_first[0]:
+                is_first[0] = False
+                return '\n'+encoded
+            return ', \n'+encoded
+        def encode_end():
+            return ('], \n    ' if is_first[0] else '\n    ], \n    ')+self.json_error(is_indented=True)
+        app_iter = chain(['{\n    "results": ['], self.iter_response(encode_chunk, encode_end, encode_end))
+        self.response.app_iter = app_iter
+        return self.response
+    def json_error(self, is_indented=False):
+        # status fields ending json response, following results
+        fields = [('status', self.status)]
+        if self.error_message is not None: fields.append(('error_message', self.error_message))
+        if self.error_traceback is not None: fields.append(('traceback', self.error_traceback))
+        if is_indented: return ', \n    '.join('"{}": {}'.format(name, json.dumps(value)) for name, value in fields)+'\n}'
+        return ','.join('"{}":{}'.format(name, json.dumps(value)) for name, value in fields)+'}'
+    def json_columns(self, results):
+        # encode chunk of results as (name, values) pairs, with values a list of json numbers
+        # rounded as requested, null if missing, in order of fields of results
+        lats, lngs, elevations, path_indices, slopes, aspects, distances = results
+        def encode(values, precision):
+            if values is None: return []
+            value_format = '%.{}f'.format(precision)
+            values = values.tolist()
+            return [value_format % value if value == value else 'null' for value in values]
+        latlng_precision = self.precision
+        if latlng_precision is None: latlng_precision = 2 if self.is_NZTM else 7
+        names = ('E','N') if self.is_NZTM else ('lat','lng')
+        columns = []
+        if self.is_slope: columns.append(('aspect', encode(aspects, 1)))
+        if self.is_distance: columns.append(('distance', encode(distances, 2)))
+        columns.append(('elevation', encode(elevations, self.elevation_precision)))
+        columns.append((names[0], encode(lats, latlng_precision)))
+        columns.append((names[1], encode(lngs, latlng_precision)))
+        columns.append(('path_index', ['null' if path_index < 0 else str(path_index) 
+                                       for path_index in path_indices.tolist()]))
+        if self.is_slope: columns.append(('slope', encode(slopes, 2)))
+        return columns
+    def process_response_json_compact(self):
+        # encode results straight from chunks of results, without building objects for
+        # each result, streaming as for csv, status fields follow results so errors
+        # generating results can be reported
+        self.response.headers['Content-Type'] = 'application/json'
+        if self.is_columns:
+            # each column is only complete once all results are generated, so columns are
+            # buffered and written at the end, not streamed
+            column_chunks = [] # encoded chunks of each column
+            def encode_chunk(results):
+                for index, (name, values) in enumerate(self.json_columns(results)):
+                    if index == len(column_chunks): column_chunks.append((name, []))
+                    if values: column_chunks[index][1].append(','.join(values))
+                return ''
+            def encode_end():
+                return ','.join('"{}":[{}]'.format(name, ','.join(chunks)) 
+                                for name, chunks in column_chunks)+'},'+self.json_error()
+            def encode_error():
+                return '},'+self.json_error()
+            app_iter = chain(['{"results":{'], self.iter_response(encode_chunk, encode_error, encode_end))
+        else:
+            is_first = [True] # whether next result is first, separated from previous results otherwise
+            def encode_chunk(results):
+                columns = self.json_columns(results)
+                if len(columns[0][1]) == 0: return ''
+                # one result object per row, location nested as for other json responses, location
+                # and path_index omitted if missing as for other json responses, so these follow
+                # elevation with their own separators
+                names = [name for name, values in columns]
+                location_index = names.index('E' if self.is_NZTM else 'lat')
+                locations = ['' if lat == 'null' else ',"location":{{"{}":{},"{}":{}}}'.format(names[location_index], lat, 
+                                                                                             names[location_index+1], lng)
+                             for lat, lng in izip(columns[location_index][1], columns[location_index+1][1])]
+                path_indices = ['' if path_index == 'null' else ',"path_index":'+path_index 
+                                for path_index in columns[location_index+2][1]]
+                columns[location_index:location_index+3] = [('location', locations), ('path_index', path_indices)]
+                row_format = '{'+''.join('%s' if name in ('location', 'path_index') else ('' if index == 0 else ',')+'"{}":%s'.format(name)
+                                         for index, (name, values) in enumerate(columns))+'}'
+                encoded = ','.join([row_format % row for row in izip(*[values for name, values in columns])])
+                if is_first[0]: 
+                    is_first[0] = False
+                    return encoded
+                return ','+encoded
+            def encode_error():
+                return '],'+self.json_error()
+            app_iter = chain(['{"results":['], self.iter_response(encode_chunk, encode_error, encode_error))
+        self.response.app_iter = app_iter
+        return self.response
     
+    def csv_error(self):
+        return "#{},{},{}\n".format(self.status, self.error_message or '', 
+                                    self.error_traceback.replace("\n","   ") if self.error_traceback else '')
     def process_response_csv(self):
         self.response.headers['Content-Type'] = 'text/plain'  
         if self.is_error:
-            self.response.out.write("#")
-            self.response.out.write(self.status)
-            self.response.out.write(",")
-            if self.error_message: self.response.out.write(self.error_message)
-            self.response.out.write(",")
-            if self.error_traceback: self.response.out.write(self.error_traceback.replace("\n","   "))
-            self.response.out.write("\n")
+            self.response.out.write(self.csv_error())
+        elif self.stats is not None:
+            fields = deminterpolater.ProfileStats.fields
+            self.response.write(",".join(fields)+"\n")
+            self.response.write(",".join('' if self.stats[field] is None else repr(self.stats[field]) for field in fields)+"\n")
         else:
-            self.response.headers['Content-Type'] = 'text/plain'
-            self.response.write("lat,lng,elevation{}\n".format(',path_index' if self.is_path else ''))
-            for result in self.results:
-                lat,lng,elevation,path_index = result
-                if path_index is None: path_index = ""
-                self.response.write("{:.7f},{:.7f},{:.2f}{}\n".format(lat,lng,elevation, 
-                    ',{}'.format(path_index) if self.is_path else ''))
+            header = "{}{},elevation{}{}\n".format('E,N' if self.is_NZTM else 'lat,lng',
+                                                  ',distance' if self.is_distance else '',
+                                                  ',path_index' if self.is_path else '',
+                                                  ',slope,aspect' if self.is_slope else '')
+            latlng_format = "{:.2f},{:.2f}" if self.is_NZTM else "{:.7f},{:.7f}"
+            def encode_chunk(results):
+                lines = []
+                for result in self.iter_rows(results):
+                    lat,lng,elevation,path_index,slope,aspect,distance = result
+                    if path_index is None: path_index = ""
+                    latlng = ',' if lat is None else latlng_format.format(lat,lng)
+                    if self.is_distance: latlng += ',{:.2f}'.format(distance)
+                    lines.append("{},{:.2f}{}{}\n".format(latlng,elevation, 
+                        ',{}'.format(path_index) if self.is_path else '',
+                        ',{},{}'.format('' if slope is None else '{:.2f}'.format(slope),
+                                        '' if aspect is None else '{:.1f}'.format(aspect)) if self.is_slope else ''))
+                return ''.join(lines)
+            self.response.app_iter = chain([header], self.iter_response(encode_chunk, self.csv_error))
         #logging.debug(self.response)
         return self.response
 
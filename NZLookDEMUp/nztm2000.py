@@ -19,7 +19,11 @@ Copyright (c) 2014-2016 Tet Woo Lee
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import logging
 import math
+import os
+import threading
+import numpy as np
 
 class NZTM2000:
     """
@@ -235,6 +239,176 @@ class NZTM2000:
 
         return (phi,lmb)
 
+    @classmethod
+    def latlng_to_NZTM_many(cls, phi, lmb):
+        """
+        Convert arrays of geographic lat, lng (NZGD2000 or WGS84) to NZTM2000 
+        map coordinates, as ``latlng_to_NZTM``. Points out of range do not 
+        raise ``ValueError``, but are marked in the returned mask and have 
+        ``nan`` coordinates.
+
+        Parameters:
+
+          phi : array of numbers
+            Latitudes of computation points, in degrees
+          lmb : array of numbers
+            Longitudes of computation points, in degrees
+
+        Returns:
+          out : (array, array, array)
+            tuple of (E, N, valid) where E are eastings and N are northings of
+            computation points and valid is False for points out of range
+
+        """
+
+        phi = np.asarray(phi, float)
+        lmb = np.asarray(lmb, float)
+
+        # WGS84 Bounds: 166.3300, -47.4000, 178.6000, -34.0000
+        with np.errstate(invalid='ignore'): # nan is out of range
+            valid = (lmb>=166.3300) & (lmb<=178.6000) & (phi>=-47.4000) & (phi<=-34.0000)
+
+        phi = phi * (math.pi/180.0) # convert to radians
+        lmb = lmb * (math.pi/180.0)
+
+        # Geographic to Transverse Mercator projection
+
+        # calculate main variables
+        sin_phi = np.sin(phi)
+        sin_phi2 = sin_phi*sin_phi
+        m = cls.a * (cls.A0*phi - cls.A2*np.sin(2.0*phi) + cls.A4*np.sin(4.0*phi) - cls.A6*np.sin(6.0*phi) )
+        nu = cls.a / np.sqrt(1.0 - cls.e2*sin_phi2)
+        psi = (1.0 - cls.e2*sin_phi2) / (1.0-cls.e2) # nu/rho
+        cos_phi = np.cos(phi)
+        t = sin_phi/cos_phi
+        omega = lmb - cls.lmb0
+
+        # pre-calculate higher order variables
+        omega2 = omega*omega
+        omega4 = omega2*omega2
+        omega6 = omega4*omega2
+        omega8 = omega6*omega2
+        cos_phi2 = cos_phi*cos_phi
+        cos_phi3 = cos_phi2*cos_phi
+        cos_phi4 = cos_phi3*cos_phi
+        cos_phi5 = cos_phi4*cos_phi
+        cos_phi6 = cos_phi5*cos_phi
+        cos_phi7 = cos_phi6*cos_phi
+        psi2 = psi*psi
+        psi3 = psi2*psi
+        psi4 = psi3*psi
+        t2 = t*t
+        t4 = t2*t2
+        t6 = t4*t2
+
+        N_term1 = omega2/2.0*nu*sin_phi*cos_phi
+        N_term2 = omega4/24.0*nu*sin_phi*cos_phi3*(4.0*psi2+psi-t2)
+        N_term3 = omega6/720.0*nu*sin_phi*cos_phi5*(8.0*psi4*(11.0 - 24.0*t2) - 28.0*psi3*(1.0 - 6.0*t2) + psi2*(1.0 - 32.0*t2) - psi*(2.0*t2) + t4)
+        N_term4 = omega8/40320.0*nu*sin_phi*cos_phi7*(1385- 3111*t2 + 543*t4 - t6)
+
+        E_term1 = omega2/6.0*cos_phi2*(psi-t2)
+        E_term2 = omega4/120.0*cos_phi4*(4.0*psi3*(1.0 - 6.0*t2) + psi2*(1.0 + 8.0*t2) - psi*2*t2 + t4)
+        E_term3 = omega6/5040.0*cos_phi6*(61.0 - 479.0*t2 + 179.0*t4 - t6)
+
+        N = cls.N0 + cls.k0*(m-cls.m0+N_term1+N_term2+N_term3+N_term4)
+        E = cls.E0 + cls.k0*nu*omega*cos_phi*(1.0 + E_term1 + E_term2 + E_term3)
+
+        E[~valid] = np.nan
+        N[~valid] = np.nan
+        return (E,N,valid)
+
+    @classmethod
+    def NZTM_to_latlng_many(cls, E, N):
+        """
+        Convert arrays of NZTM2000 map coordinates to geographic lat, lng 
+        (NZGD2000 or WGS84), as ``NZTM_to_latlng``. Points out of range do 
+        not raise ``ValueError``, but are marked in the returned mask and have
+        ``nan`` coordinates.
+
+        Parameters:
+
+          E : array of numbers
+            Eastings of computation points
+          N : array of numbers
+            Northings of computation points
+
+        Returns:
+
+          out : (array, array, array)
+            tuple of (phi,lmb,valid) where phi are latitudes and lmb are 
+            longitudes of computation points (in degrees) and valid is False
+            for points out of range
+        """
+
+        E = np.asarray(E, float)
+        N = np.asarray(N, float)
+
+        # Projected Bounds: 983515.7211, 4728776.8709, 2117458.3527, 6223676.2306
+        with np.errstate(invalid='ignore'): # nan is out of range
+            valid = (E>=983515) & (E<=2117459) & (N>=4728776) & (N<=6223677)
+
+        # Transverse Mercator projection to geographic
+
+        # calculate main variables
+        N_ = N - cls.N0
+        m_ = cls.m0 + N_/cls.k0
+        n = (cls.a-cls.b)/(cls.a+cls.b)
+
+        # pre-calculate higher order variables
+        n2 = n*n
+        n3 = n2*n
+        n4 = n3*n
+
+        # more variables
+        G = cls.a*(1.0-n)*(1.0-n2)*(1.0 + 9.0*n2/4.0 + 225.0*n4/64.0)*(math.pi/180.0)
+        sigma = m_*((math.pi/180.0)/G)
+        phi_ = sigma + (3.0*n/2.0 - 27.0*n3/32.0)*np.sin(2.0*sigma) + (21.0*n2/16.0 - 55.0*n4/32.0)*np.sin(4.0*sigma) + 151.0*n3/96.0*np.sin(6.0*sigma)+1097.0*n4/512.0*np.sin(8.0*sigma)
+        sin_phi_ = np.sin(phi_)
+        cos_phi_ = np.cos(phi_)
+        sin_phi_2 = sin_phi_*sin_phi_
+        nu_ = cls.a / np.sqrt(1.0 - cls.e2*sin_phi_2)
+        psi_ = (1.0 - cls.e2*sin_phi_2) / (1.0-cls.e2) # nu_/rho_
+        rho_ = nu_/psi_
+        t_ = sin_phi_/cos_phi_
+        E_ = E - cls.E0
+        x = E_/(cls.k0*nu_)
+
+        # pre-calculate higher order variables
+        x2 = x*x
+        x3 = x2*x
+        x5 = x3*x2
+        x7 = x5*x2
+        psi_2=psi_*psi_
+        psi_3=psi_2*psi_
+        psi_4=psi_3*psi_
+        t_2 = t_*t_
+        t_4 = t_2*t_2
+        t_6 = t_4*t_2
+
+        phi_tk0rho = t_/(cls.k0*rho_) # used in all terms
+
+        phi_term1 = phi_tk0rho * E_*x/2.0
+        phi_term2 = phi_tk0rho * E_*x3/24.0 * (-4.0*psi_2 + 9.0*psi_*(1.0-t_2) + 12.0*t_2)
+        phi_term3 = phi_tk0rho * E_*x5/720.0 * (8.0*psi_4*(11.0 - 24*t_2) - 12*psi_3*(21.0 - 71.0*t_2) + 15*psi_2*(15.0 - 98.0*t_2 + 15*t_4) + 180.0*psi_*(5*t_2 - 3*t_4) + 360.0*t_4)
+        phi_term4 = phi_tk0rho * E_*x7/40320.0 * (1385.0 - 3633.0*t_2 + 4095.0*t_4 + 1575.0*t_6)
+
+        phi = phi_ - phi_term1 + phi_term2 - phi_term3 + phi_term4
+        sec_phi_ = 1.0/cos_phi_
+
+        lmb_term1 = x * sec_phi_
+        lmb_term2 = x3 * sec_phi_ / 6.0 * (psi_ + 2*t_2)
+        lmb_term3 = x5 * sec_phi_ / 120.0 * (-4.0*psi_3*(1.0 - 6.0*t_2) + psi_2*(9.0 - 68.0*t_2) + 72.0*psi_*t_2 + 24.0*t_4)
+        lmb_term4 = x7 * sec_phi_ / 5040.0 * (61.0 + 662.0*t_2 + 1320*t_4 + 720*t_6)
+
+        lmb = cls.lmb0 + lmb_term1 - lmb_term2 + lmb_term3 - lmb_term4
+
+        phi = phi * (180.0/math.pi)
+        lmb = lmb * (180.0/math.pi)
+
+        phi[~valid] = np.nan
+        lmb[~valid] = np.nan
+        return (phi,lmb,valid)
+
     @classmethod
     def latlng_k(cls, phi, lmb):
         """
@@ -351,7 +525,579 @@ class NZTM2000:
 
         return k
 
+    @classmethod
+    def NZTM_k_many(cls, E, N):
+        """
+        Obtain point scale factors from arrays of NZTM2000 map coordinates, 
+        as ``NZTM_k``. Points out of range do not raise ``ValueError``, but 
+        are marked in the returned mask and have ``nan`` scale factor.
+
+        Parameters:
+
+          E : array of numbers
+            Eastings of computation points
+          N : array of numbers
+            Northings of computation points
+
+        Returns:
+          out : (array, array)
+            tuple of (k, valid) where k are point scale factors and valid is
+            False for points out of range
+
+        """
+
+        E = np.asarray(E, float)
+        N = np.asarray(N, float)
+
+        # Projected Bounds: 983515.7211, 4728776.8709, 2117458.3527, 6223676.2306
+        with np.errstate(invalid='ignore'): # nan is out of range
+            valid = (E>=983515) & (E<=2117459) & (N>=4728776) & (N<=6223677)
+
+        # calculate main variables
+        N_ = N - cls.N0
+        m_ = cls.m0 + N_/cls.k0
+        n = (cls.a-cls.b)/(cls.a+cls.b)
+
+        # pre-calculate higher order variables
+        n2 = n*n
+        n3 = n2*n
+        n4 = n3*n
+
+        # more variables
+        G = cls.a*(1.0-n)*(1.0-n2)*(1.0 + 9.0*n2/4.0 + 225.0*n4/64.0)*(math.pi/180.0)
+        sigma = m_/G*(math.pi/180.0)
+        phi_ = sigma + (3.0*n/2.0 - 27.0*n3/32.0)*np.sin(2.0*sigma) + (21.0*n2/16.0 - 55.0*n4/32.0)*np.sin(4.0*sigma) + 151.0*n3/96.0*np.sin(6.0*sigma)+1097.0*n4/512.0*np.sin(8.0*sigma)
+        sin_phi_ = np.sin(phi_)
+        sin_phi_2 = sin_phi_*sin_phi_
+        one_e2_sin_phi_2 = 1.0 - cls.e2*sin_phi_2
+        rho_nu_ = cls.a*cls.a * (1.0-cls.e2) / (one_e2_sin_phi_2*one_e2_sin_phi_2) # rho_*nu_
+        psi_ = one_e2_sin_phi_2 / (1.0-cls.e2) # nu_/rho_
+        t_ = np.tan(phi_)
+        E_ = E - cls.E0
+        y = (E_*E_)/(cls.k0*cls.k0*rho_nu_)
+
+        # pre-calculate higher order variables
+        y2 = y*y
+        y3 = y*y2
+        t_2 = t_*t_
+
+        term1 = y/2
+        term2 = y2/24 * (4*psi_ * (1 - 6*t_2) - 3 * (1 - 16*t_2) - (24*t_2/psi_))
+        term3 = y3/720
+
+        k = cls.k0 * (1 + term1 + term2 + term3)
+
+        k[~valid] = np.nan
+        return (k,valid)
+
+class ScalarFunctions:
+    """
+    Math functions for scalar use of ``NZTM2000Kruger``.
+    """
+    sin = staticmethod(math.sin)
+    cos = staticmethod(math.cos)
+    exp = staticmethod(math.exp)
+    atan2 = staticmethod(math.atan2)
+    asinh = staticmethod(math.asinh)
+    hypot = staticmethod(math.hypot)
+
+class ArrayFunctions:
+    """
+    Math functions for vectorized use of ``NZTM2000Kruger``.
+    """
+    sin = np.sin
+    cos = np.cos
+    exp = np.exp
+    atan2 = np.arctan2
+    asinh = np.arcsinh
+    hypot = np.hypot
+
+class NZTM2000Kruger(NZTM2000):
+    """
+    Converts lat/lng to New Zealand Transverse Mercator 2000 map coordinates,
+    with the same API as ``NZTM2000`` but using the Krüger n-series to 6th
+    order instead of the LINZ (Redfearn) series.
+    Formula source: Poder & Engsager, as implemented in PROJ ``etmerc``; see
+    also Karney (2011) Transverse Mercator with an accuracy of a few 
+    nanometers, J. Geodesy 85:475-485.
+
+    Geodetic latitude is converted to conformal (Gaussian) latitude and the
+    spherical transverse Mercator coordinates are corrected to the ellipsoid
+    by trigonometric series in n, all summed with Clenshaw recurrences from
+    precomputed coefficients. The inverse uses the same forms, so needs no
+    footpoint latitude, and both directions are accurate to well under a 
+    millimetre over the whole of the NZTM2000 bounds. Trigonometric and 
+    hyperbolic functions of intermediate angles are found algebraically 
+    where possible, so each direction takes 9 transcendental calls.
+
+    This engine is for accuracy, not speed: the round trip is exact to a few
+    nanometres, against a few millimetres for the LINZ series of 
+    ``NZTM2000``. Scalar conversions are faster than ``NZTM2000``, but array
+    conversions are slightly slower. For faster array conversions use 
+    ``NZTM2000Grid``, which interpolates this series.
+
+    Point scale factors (``latlng_k``, ``NZTM_k``) are as ``NZTM2000``.
+    """
+
+    n = NZTM2000.f/(2.0-NZTM2000.f) # third flattening
+    n2 = n*n
+    n3 = n2*n
+    n4 = n3*n
+    n5 = n4*n
+    n6 = n5*n
+
+    # geodetic to Gaussian latitude
+    cbg = (n*(-2.0 + n*(2.0/3.0 + n*(4.0/3.0 + n*(-82.0/45.0 + n*(32.0/45.0 + n*(4642.0/4725.0)))))),
+           n2*(5.0/3.0 + n*(-16.0/15.0 + n*(-13.0/9.0 + n*(904.0/315.0 + n*(-1522.0/945.0))))),
+           n3*(-26.0/15.0 + n*(34.0/21.0 + n*(8.0/5.0 + n*(-12686.0/2835.0)))),
+           n4*(1237.0/630.0 + n*(-12.0/5.0 + n*(-24832.0/14175.0))),
+           n5*(-734.0/315.0 + n*(109598.0/31185.0)),
+           n6*(444337.0/155925.0))
+    # Gaussian to geodetic latitude
+    cgb = (n*(2.0 + n*(-2.0/3.0 + n*(-2.0 + n*(116.0/45.0 + n*(26.0/45.0 + n*(-2854.0/675.0)))))),
+           n2*(7.0/3.0 + n*(-8.0/5.0 + n*(-227.0/45.0 + n*(2704.0/315.0 + n*(2323.0/945.0))))),
+           n3*(56.0/15.0 + n*(-136.0/35.0 + n*(-1262.0/105.0 + n*(73814.0/2835.0)))),
+           n4*(4279.0/630.0 + n*(-332.0/35.0 + n*(-399572.0/14175.0))),
+           n5*(4174.0/315.0 + n*(-144838.0/6237.0)),
+           n6*(601676.0/22275.0))
+    # spherical to ellipsoidal normalised N, E
+    gtu = (n*(0.5 + n*(-2.0/3.0 + n*(5.0/16.0 + n*(41.0/180.0 + n*(-127.0/288.0 + n*(7891.0/37800.0)))))),
+           n2*(13.0/48.0 + n*(-3.0/5.0 + n*(557.0/1440.0 + n*(281.0/630.0 + n*(-1983433.0/1935360.0))))),
+           n3*(61.0/240.0 + n*(-103.0/140.0 + n*(15061.0/26880.0 + n*(167603.0/181440.0)))),
+           n4*(49561.0/161280.0 + n*(-179.0/168.0 + n*(6601661.0/7257600.0))),
+           n5*(34729.0/80640.0 + n*(-3418889.0/1995840.0)),
+           n6*(212378941.0/319334400.0))
+    # ellipsoidal to spherical normalised N, E
+    utg = (n*(-0.5 + n*(2.0/3.0 + n*(-37.0/96.0 + n*(1.0/360.0 + n*(81.0/512.0 + n*(-96199.0/604800.0)))))),
+           n2*(-1.0/48.0 + n*(-1.0/15.0 + n*(437.0/1440.0 + n*(-46.0/105.0 + n*(1118711.0/3870720.0))))),
+           n3*(-17.0/480.0 + n*(37.0/840.0 + n*(209.0/4480.0 + n*(-5569.0/90720.0)))),
+           n4*(-4397.0/161280.0 + n*(11.0/504.0 + n*(830251.0/7257600.0))),
+           n5*(-4583.0/161280.0 + n*(108847.0/3991680.0)),
+           n6*(-20648693.0/638668800.0))
+
+    Qn = NZTM2000.k0*NZTM2000.a/(1.0+n) * (1.0 + n2*(1.0/4.0 + n2*(1.0/64.0 + n2/256.0))) # scaled meridian quadrant / (pi/2)
+    # origin latitude phi0 is on equator, so its northing is 0
+
+    @staticmethod
+    def clenshaw_sin(coefficients, angle, cos_2angle, sin_2angle):
+        """
+        Sum ``angle + sum(coefficients[j-1]*sin(2*j*angle))`` by Clenshaw 
+        recurrence, given ``cos(2*angle)`` and ``sin(2*angle)``.
+        """
+        two_cos = 2.0*cos_2angle
+        h1 = h2 = 0.0
+        for coefficient in reversed(coefficients):
+            h1, h2 = coefficient + two_cos*h1 - h2, h1
+        return angle + h1*sin_2angle
+
+    @staticmethod
+    def clenshaw_sin_complex(coefficients, sin_r, cos_r, sinh_i, cosh_i):
+        """
+        Sum ``sum(coefficients[j-1]*sin(j*(r + i*i)))`` by complex Clenshaw 
+        recurrence, in real arithmetic, given ``sin(r)``, ``cos(r)``, 
+        ``sinh(i)`` and ``cosh(i)``.
+
+        Returns (real, imaginary) tuple.
+        """
+        # 2*cos of complex argument
+        r = 2.0*cos_r*cosh_i
+        i = -2.0*sin_r*sinh_i
+        hr = hr1 = hi = hi1 = 0.0
+        for coefficient in reversed(coefficients):
+            hr, hr1, hi, hi1 = -hr1 + r*hr - i*hi + coefficient, hr, -hi1 + i*hr + r*hi, hi
+        # sin of complex argument
+        r = sin_r*cosh_i
+        i = cos_r*sinh_i
+        return (r*hr - i*hi, r*hi + i*hr)
+
+    @classmethod
+    def forward(cls, phi, lmb, f):
+        """
+        Project lat, lng (radians) to E, N. ``f`` gives math functions, 
+        ``ScalarFunctions`` or ``ArrayFunctions``.
+        """
+        # geodetic to Gaussian latitude
+        sin_phi = f.sin(phi)
+        cos_phi = f.cos(phi)
+        Cn = cls.clenshaw_sin(cls.cbg, phi, cos_phi*cos_phi - sin_phi*sin_phi, 2.0*sin_phi*cos_phi)
+        Ce = lmb - cls.lmb0
+        # Gaussian lat, lng to complementary spherical lat and normalised E
+        sin_Cn = f.sin(Cn)
+        cos_Cn = f.cos(Cn)
+        sin_Ce = f.sin(Ce)
+        cos_Ce = f.cos(Ce)
+        cos_Cn_cos_Ce = cos_Cn*cos_Ce
+        inv_denom = 1.0/f.hypot(sin_Cn, cos_Cn_cos_Ce) # also cosh(Ce) below
+        Cn = f.atan2(sin_Cn, cos_Cn_cos_Ce)
+        sinh_Ce = sin_Ce*cos_Cn*inv_denom # tan of spherical E angle
+        Ce = f.asinh(sinh_Ce)
+        # spherical to ellipsoidal normalised N, E
+        sin_Cn = sin_Cn*inv_denom
+        cos_Cn = cos_Cn_cos_Ce*inv_denom
+        dCn, dCe = cls.clenshaw_sin_complex(cls.gtu, 2.0*sin_Cn*cos_Cn, cos_Cn*cos_Cn - sin_Cn*sin_Cn,
+                                            2.0*sinh_Ce*inv_denom, 1.0 + 2.0*sinh_Ce*sinh_Ce)
+        N = cls.N0 + cls.Qn*(Cn + dCn)
+        E = cls.E0 + cls.Qn*(Ce + dCe)
+        return (E,N)
+
+    @classmethod
+    def inverse(cls, E, N, f):
+        """
+        Project E, N to lat, lng (radians). ``f`` gives math functions, 
+        ``ScalarFunctions`` or ``ArrayFunctions``.
+        """
+        # normalise N, E
+        Cn = (N - cls.N0)/cls.Qn
+        Ce = (E - cls.E0)/cls.Qn
+        # ellipsoidal to spherical normalised N, E
+        exp_2Ce = f.exp(2.0*Ce)
+        dCn, dCe = cls.clenshaw_sin_complex(cls.utg, f.sin(2.0*Cn), f.cos(2.0*Cn),
+                                            0.5*(exp_2Ce - 1.0/exp_2Ce), 0.5*(exp_2Ce + 1.0/exp_2Ce))
+        Cn = Cn + dCn
+        exp_Ce = f.exp(Ce + dCe)
+        sinh_Ce = 0.5*(exp_Ce - 1.0/exp_Ce)
+        cosh_Ce = 0.5*(exp_Ce + 1.0/exp_Ce)
+        # complementary spherical lat to Gaussian lat, lng
+        sin_Cn = f.sin(Cn)
+        cos_Cn = f.cos(Cn)
+        lmb = cls.lmb0 + f.atan2(sinh_Ce, cos_Cn)
+        denom = f.hypot(sinh_Ce, cos_Cn)
+        Cn = f.atan2(sin_Cn, denom)
+        # Gaussian to geodetic latitude
+        sin_Cn = sin_Cn/cosh_Ce
+        cos_Cn = denom/cosh_Ce
+        phi = cls.clenshaw_sin(cls.cgb, Cn, cos_Cn*cos_Cn - sin_Cn*sin_Cn, 2.0*sin_Cn*cos_Cn)
+        return (phi,lmb)
+
+    @classmethod
+    def latlng_to_NZTM(cls, phi, lmb):
+        """
+        Convert geographic lat, lng (NZGD2000 or WGS84) to NZTM2000 map 
+        coordinates, see ``NZTM2000.latlng_to_NZTM``.
+        """
+
+        # WGS84 Bounds: 166.3300, -47.4000, 178.6000, -34.0000
+        if lmb<166.3300 or lmb>178.6000: raise ValueError("longitude out of range for NZTM2000")
+        if phi<-47.4000 or phi>-34.0000: raise ValueError("latitude out of range for NZTM2000")
+
+        return cls.forward(phi * (math.pi/180.0), lmb * (math.pi/180.0), ScalarFunctions)
+
+    @classmethod
+    def NZTM_to_latlng(cls, E, N):
+        """
+        Convert NZTM2000 map coordinates to geographic lat, lng (NZGD2000 or
+        WGS84), see ``NZTM2000.NZTM_to_latlng``.
+        """
+
+        # Projected Bounds: 983515.7211, 4728776.8709, 2117458.3527, 6223676.2306
+        if E<983515 or E>2117459: raise ValueError("E out of range for NZTM2000")
+        if N<4728776 or N>6223677: raise ValueError("N out of range for NZTM2000")
+
+        phi, lmb = cls.inverse(E, N, ScalarFunctions)
+        return (phi * (180.0/math.pi), lmb * (180.0/math.pi))
+
+    @classmethod
+    def latlng_to_NZTM_many(cls, phi, lmb):
+        """
+        Convert arrays of geographic lat, lng (NZGD2000 or WGS84) to NZTM2000 
+        map coordinates, see ``NZTM2000.latlng_to_NZTM_many``.
+        """
+
+        phi = np.asarray(phi, float)
+        lmb = np.asarray(lmb, float)
+
+        # WGS84 Bounds: 166.3300, -47.4000, 178.6000, -34.0000
+        with np.errstate(invalid='ignore'): # nan is out of range
+            valid = (lmb>=166.3300) & (lmb<=178.6000) & (phi>=-47.4000) & (phi<=-34.0000)
+
+        E, N = cls.forward(phi * (math.pi/180.0), lmb * (math.pi/180.0), ArrayFunctions)
+        E[~valid] = np.nan
+        N[~valid] = np.nan
+        return (E,N,valid)
+
+    @classmethod
+    def NZTM_to_latlng_many(cls, E, N):
+        """
+        Convert arrays of NZTM2000 map coordinates to geographic lat, lng 
+        (NZGD2000 or WGS84), see ``NZTM2000.NZTM_to_latlng_many``.
+        """
+
+        E = np.asarray(E, float)
+        N = np.asarray(N, float)
+
+        # Projected Bounds: 983515.7211, 4728776.8709, 2117458.3527, 6223676.2306
+        with np.errstate(invalid='ignore'): # nan is out of range
+            valid = (E>=983515) & (E<=2117459) & (N>=4728776) & (N<=6223677)
+
+        phi, lmb = cls.inverse(E, N, ArrayFunctions)
+        phi = phi * (180.0/math.pi)
+        lmb = lmb * (180.0/math.pi)
+        phi[~valid] = np.nan
+        lmb[~valid] = np.nan
+        return (phi,lmb,valid)
+
+class TaylorGrid:
+    """
+    Regular grid of 2nd order Taylor expansions of a smooth mapping of
+    (x, y) to (X, Y), evaluated at the nearest grid node. For each node the
+    value and first and second derivatives (in grid units) of both outputs
+    are stored, coefficient-major, so evaluation of many points takes 12
+    gathers and a few multiply-adds per point. Error is of 3rd order in the
+    grid step.
+    """
+
+    version = 1 # increment if stored coefficients change
+
+    def __init__(self, x0, y0, step, shape, coefficients):
+        """
+        Arguments:
+
+            x0, y0 : number
+                coordinates of node [0,0]
+            step : number
+                grid step, in units of x and y
+            shape : (int, int)
+                number of nodes in y, x
+            coefficients : array (12, shape[0]*shape[1])
+                X then Y value, d/du, d/dv, d2/du2/2, d2/dudv, d2/dv2/2, 
+                where u, v are x, y offsets from node in grid units
+
+        """
+        self.x0 = x0
+        self.y0 = y0
+        self.step = step
+        self.shape = shape
+        self.coefficients = coefficients
+
+    @classmethod
+    def build(cls, function, x0, y0, step, shape, delta=0.05):
+        """
+        Build grid by evaluating ``function`` (taking and returning arrays
+        x, y and X, Y) at each node, with derivatives by central 
+        differences ``delta`` grid units either side of node.
+        """
+        ys, xs = np.mgrid[0:shape[0], 0:shape[1]]
+        xs = x0 + xs.ravel()*step
+        ys = y0 + ys.ravel()*step
+        d = delta*step
+        values = dict(((a, b), function(xs + a*d, ys + b*d)) for a in (-1, 0, 1) for b in (-1, 0, 1))
+        coefficients = np.empty((12, xs.size))
+        for output in (0, 1):
+            value = lambda a, b: values[a, b][output]
+            c0 = value(0, 0)
+            coefficients[output*6:output*6+6] = (
+                c0,
+                (value(1, 0) - value(-1, 0))/(2.0*delta),
+                (value(0, 1) - value(0, -1))/(2.0*delta),
+                (value(1, 0) - 2.0*c0 + value(-1, 0))/(2.0*delta*delta),
+                (value(1, 1) - value(1, -1) - value(-1, 1) + value(-1, -1))/(4.0*delta*delta),
+                (value(0, 1) - 2.0*c0 + value(0, -1))/(2.0*delta*delta))
+        return cls(x0, y0, step, shape, coefficients)
+
+    def evaluate(self, xs, ys):
+        """
+        Evaluate mapping at arrays of points ``xs``, ``ys``, which should be
+        within the grid. Returns (X, Y) tuple of arrays.
+        """
+        with np.errstate(invalid='ignore'): # nan input gives garbage node, clipped below
+            x = (xs - self.x0)*(1.0/self.step)
+            y = (ys - self.y0)*(1.0/self.step)
+            i = np.clip(x + 0.5, 0, self.shape[1] - 1).astype(np.intp) # nearest node
+            j = np.clip(y + 0.5, 0, self.shape[0] - 1).astype(np.intp)
+        u = x - i
+        v = y - j
+        node = j*self.shape[1] + i
+        c = [coefficient.take(node, mode='clip') for coefficient in self.coefficients]
+        X = c[0] + u*(c[1] + u*c[3] + v*c[4]) + v*(c[2] + v*c[5])
+        Y = c[6] + u*(c[7] + u*c[9] + v*c[10]) + v*(c[8] + v*c[11])
+        return (X,Y)
+
+    def file_name(self, name):
+        return 'nztm2000_{}_v{}_{!r}.npy'.format(name, self.version, self.step)
+
+    def save(self, directory, name):
+        """
+        Save coefficients to ``directory``, as numpy ``.npy`` file.
+        """
+        if not os.path.isdir(directory): os.makedirs(directory)
+        file_path = os.path.join(directory, self.file_name(name))
+        temp_path = '{}.{}.tmp'.format(file_path, threading.current_thread().ident)
+        with open(temp_path, 'wb') as grid_file:
+            np.save(grid_file, self.coefficients)
+        os.rename(temp_path, file_path) # atomic, so readers never see partial grids
+
+    def load(self, directory, name):
+        """
+        Replace coefficients with those saved in ``directory``, memory 
+        mapped read-only. Returns False if not saved or of wrong size.
+        """
+        file_path = os.path.join(directory, self.file_name(name))
+        if not os.path.exists(file_path): return False
+        coefficients = np.load(file_path, mmap_mode='r')
+        if coefficients.shape != (12, self.shape[0]*self.shape[1]): return False
+        self.coefficients = np.asarray(coefficients) # plain array view of memory map
+        return True
+
+class NZTM2000Grid(NZTM2000Kruger):
+    """
+    Converts lat/lng to New Zealand Transverse Mercator 2000 map coordinates,
+    with the same API as ``NZTM2000Kruger``, but with the array conversions
+    (``latlng_to_NZTM_many``, ``NZTM_to_latlng_many``) interpolated from 
+    precomputed grids of the Krüger series (see ``TaylorGrid``), so needing 
+    no transcendental calls. Scalar conversions use the series directly.
+
+    Grids cover the WGS84 and projected bounds respectively with a margin of
+    one step. They are built on first use, and their interpolation error 
+    checked against the series at cell corners and edge midpoints (the 
+    furthest points from the nodes), raising ``RuntimeError`` if more than 
+    ``max_error``, 0.5 mm so well within 1 mm. At the default steps this is 
+    about 0.24 mm forward and 0.33 mm inverse. If ``grid_directory`` is set, grids are saved there and later
+    memory mapped from there instead of being rebuilt; if it cannot be 
+    written, a warning is logged and grids are kept in memory only.
+    """
+
+    latlng_step = 0.05 # degrees, 6.5 MB grid
+    NZTM_step = 4000.0 # metres, 10 MB grid
+    max_error = 5e-4 # metres
+    grid_directory = None # directory to save grids, not saved if None
+
+    grids = {} # name: TaylorGrid, shared by all instances
+    grids_lock = threading.Lock()
+
+    @classmethod
+    def forward_degrees(cls, lmb, phi):
+        E, N = cls.forward(phi * (math.pi/180.0), lmb * (math.pi/180.0), ArrayFunctions)
+        return (E,N)
+
+    @classmethod
+    def inverse_degrees(cls, E, N):
+        phi, lmb = cls.inverse(E, N, ArrayFunctions)
+        return (phi * (180.0/math.pi), lmb * (180.0/math.pi))
+
+    @classmethod
+    def get_grid(cls, name):
+        """
+        Get 'forward' (lng, lat to E, N) or 'inverse' (E, N to lat, lng) 
+        grid, loading or building it if needed.
+        """
+        grid = cls.grids.get(name)
+        if grid is not None: return grid
+        with cls.grids_lock:
+            grid = cls.grids.get(name)
+            if grid is not None: return grid
+            if name == 'forward':
+                step = cls.latlng_step
+                x0, y0, x1, y1 = 166.3300, -47.4000, 178.6000, -34.0000 # WGS84 Bounds
+                function = cls.forward_degrees
+            else:
+                step = cls.NZTM_step
+                x0, y0, x1, y1 = 983515.0, 4728776.0, 2117459.0, 6223677.0 # Projected Bounds
+                function = cls.inverse_degrees
+            shape = (int(math.ceil((y1 - y0)/step)) + 3, int(math.ceil((x1 - x0)/step)) + 3)
+            grid = TaylorGrid(x0 - step, y0 - step, step, shape, None)
+            try:
+                is_loaded = cls.grid_directory is not None and grid.load(cls.grid_directory, name)
+            except (IOError, OSError, ValueError) as e:
+                logging.warning("Loading NZTM2000 %s grid from %s failed: %s", name, cls.grid_directory, e)
+                is_loaded = False
+            if not is_loaded:
+                grid = TaylorGrid.build(function, grid.x0, grid.y0, step, shape)
+                cls.check_grid(grid, name, function)
+                if cls.grid_directory is not None:
+                    try:
+                        grid.save(cls.grid_directory, name)
+                    except (IOError, OSError) as e:
+                        logging.warning("Saving NZTM2000 %s grid to %s failed: %s", name, cls.grid_directory, e)
+            cls.grids[name] = grid
+            return grid
+
+    @classmethod
+    def check_grid(cls, grid, name, function):
+        """
+        Check interpolation error of ``grid`` against ``function`` at 
+        furthest points from nodes is within ``max_error``.
+        """
+        ys, xs = np.mgrid[0:grid.shape[0] - 1, 0:grid.shape[1] - 1]
+        xs = grid.x0 + xs.ravel()*grid.step
+        ys = grid.y0 + ys.ravel()*grid.step
+        half_step = 0.5*grid.step
+        error = 0.0
+        for x, y in ((xs + half_step, ys + half_step), (xs + half_step, ys), (xs, ys + half_step)):
+            X, Y = grid.evaluate(x, y)
+            X_series, Y_series = function(x, y)
+            if name == 'forward':
+                errors = np.hypot(X - X_series, Y - Y_series)
+            else:
+                errors = np.hypot((X - X_series) * (math.pi/180.0), 
+                                  (Y - Y_series) * (math.pi/180.0) * np.cos(X_series * (math.pi/180.0))) * cls.a
+            error = max(error, errors.max())
+        if error > cls.max_error:
+            raise RuntimeError("NZTM2000 {} grid error {:.2e} m exceeds {:.2e} m".format(name, error, cls.max_error))
+
+    @classmethod
+    def latlng_to_NZTM_many(cls, phi, lmb):
+        """
+        Convert arrays of geographic lat, lng (NZGD2000 or WGS84) to NZTM2000 
+        map coordinates, see ``NZTM2000.latlng_to_NZTM_many``.
+        """
+
+        phi = np.asarray(phi, float)
+        lmb = np.asarray(lmb, float)
+
+        # WGS84 Bounds: 166.3300, -47.4000, 178.6000, -34.0000
+        with np.errstate(invalid='ignore'): # nan is out of range
+            valid = (lmb>=166.3300) & (lmb<=178.6000) & (phi>=-47.4000) & (phi<=-34.0000)
+
+        E, N = cls.get_grid('forward').evaluate(lmb, phi)
+        E[~valid] = np.nan
+        N[~valid] = np.nan
+        return (E,N,valid)
+
+    @classmethod
+    def NZTM_to_latlng_many(cls, E, N):
+        """
+        Convert arrays of NZTM2000 map coordinates to geographic lat, lng 
+        (NZGD2000 or WGS84), see ``NZTM2000.NZTM_to_latlng_many``.
+        """
+
+        E = np.asarray(E, float)
+        N = np.asarray(N, float)
+
+        # Projected Bounds: 983515.7211, 4728776.8709, 2117458.3527, 6223676.2306
+        with np.errstate(invalid='ignore'): # nan is out of range
+            valid = (E>=983515) & (E<=2117459) & (N>=4728776) & (N<=6223677)
+
+        phi, lmb = cls.get_grid('inverse').evaluate(E, N)
+        phi[~valid] = np.nan
+        lmb[~valid] = np.nan
+        return (phi,lmb,valid)
+
+projection_engines = {'redfearn': NZTM2000, 'kruger': NZTM2000Kruger, 'grid': NZTM2000Grid}
+    #: interchangeable projection classes, by name
+
 if __name__ == "__main__":
+    # compare projection engines over full WGS84 bounds
+    import timeit
+    random_state = np.random.RandomState(0)
+    phis = random_state.uniform(-47.4, -34.0, 100000)
+    lmbs = random_state.uniform(166.33, 178.6, 100000)
+    # keep points also within projected bounds (excludes far north near central meridian)
+    within_bounds = NZTM2000.NZTM_to_latlng_many(*NZTM2000.latlng_to_NZTM_many(phis, lmbs)[:2])[2]
+    phis = phis[within_bounds]
+    lmbs = lmbs[within_bounds]
+    for engine_name, engine in sorted(projection_engines.items()):
+        Es, Ns, valid = engine.latlng_to_NZTM_many(phis, lmbs)
+        phis_, lmbs_, valid_ = engine.NZTM_to_latlng_many(Es, Ns)
+        error_N = np.abs(phis_ - phis) * (math.pi/180.0) * NZTM2000.a
+        error_E = np.abs(lmbs_ - lmbs) * (math.pi/180.0) * NZTM2000.a * np.cos(phis * (math.pi/180.0))
+        print "%s: round trip error max %.2e m (N) %.2e m (E)"%(engine_name, error_N.max(), error_E.max())
+        scalar_time = timeit.timeit(lambda: [engine.NZTM_to_latlng(*engine.latlng_to_NZTM(phi, lmb)) for phi, lmb in zip(phis[:10000], lmbs[:10000])], number=1)
+        array_time = timeit.timeit(lambda: engine.NZTM_to_latlng_many(*engine.latlng_to_NZTM_many(phis, lmbs)[:2]), number=1)
+        print "%s: round trip %.2f us/point scalar, %.3f us/point array"%(engine_name, scalar_time/10000*1e6, array_time/len(phis)*1e6)
+    E_redfearn, N_redfearn, valid = NZTM2000.latlng_to_NZTM_many(phis, lmbs)
+    E_kruger, N_kruger, valid = NZTM2000Kruger.latlng_to_NZTM_many(phis, lmbs)
+    print "forward difference max %.2e m (E) %.2e m (N)"%(np.abs(E_kruger - E_redfearn).max(), np.abs(N_kruger - N_redfearn).max())
+
 
     print "%.2f mE    %.2f mN"%NZTM2000.latlng_to_NZTM(-36.884391, 174.749642)
     # expect 1755918.47 mE    5916523.26 mN (NZ Map Reference Converter; http://www.linz.govt.nz/geodetic/software-downloads#nzmapconv)
@@ -33,6 +33,56 @@ nztwlee.demlookup.ElevationService.prototype.convertElevationStatusCode = functi
     }
 };
 
+nztwlee.demlookup.ElevationService.prototype.parseBinaryResponse = function(buffer) {
+    // parse binary format version 2 response, see BinaryFormat2 in nzlookdemup.py
+    // returns {status, error_message, results[]} 
+    var statuses = ['OK', 'INVALID_REQUEST', 'OVER_QUERY_LIMIT', 'REQUEST_DENIED', 'UNKNOWN_ERROR'];
+    var view = new DataView(buffer);
+    var results = [];
+    var offset = 0;
+    var padded = function(length) { return Math.ceil(length/8)*8; };
+    while (offset + 24 <= buffer.byteLength) {
+        var magic = String.fromCharCode.apply(null, new Uint8Array(buffer, offset, 4));
+        if (magic !== 'NZDL' || view.getUint16(offset+4, true) !== 2) break;
+        var flags = view.getUint16(offset+6, true);
+        var status = this.convertElevationStatusCode(statuses[view.getUint16(offset+8, true)]);
+        var isLast = view.getUint16(offset+10, true);
+        var count = view.getUint32(offset+12, true);
+        var messageLength = view.getUint32(offset+16, true);
+        var message = String.fromCharCode.apply(null, new Uint8Array(buffer, offset+24, messageLength));
+        offset += 24 + padded(messageLength);
+        // columns are viewed in place
+        var column = function(ArrayType) {
+            var values = new ArrayType(buffer, offset, count);
+            offset += padded(count*ArrayType.BYTES_PER_ELEMENT);
+            return values;
+        };
+        if (flags & 16) { // stats, not requested
+            column(Float64Array);
+        } else if (count > 0) {
+            var lats, lngs, distances, slopes, aspects;
+            if (flags & 1) { lats = column(Float64Array); lngs = column(Float64Array); }
+            if (flags & 4) distances = column(Float64Array);
+            var elevations = column(Float32Array);
+            var pathIndices = column(Int32Array);
+            if (flags & 8) { slopes = column(Float32Array); aspects = column(Float32Array); }
+            for (var i = 0; i < count; i++) {
+                var result = {elevation:elevations[i]};
+                if (lats) result.location = new google.maps.LatLng(lats[i],lngs[i]);
+                if (distances) result.distance = distances[i];
+                if (pathIndices[i]>=0) result.pathIndex = pathIndices[i]; // otherwise undefined
+                if (slopes) {
+                    if (!isNaN(slopes[i])) result.slope = slopes[i]; // otherwise undefined
+                    if (!isNaN(aspects[i])) result.aspect = aspects[i];
+                }
+                results.push(result);
+            }
+        }
+        if (isLast) return {status:status, error_message:message.split('\n')[0], results:results};
+    }
+    return {status:nztwlee.demlookup.ElevationStatus.UNKNOWN_ERROR, error_message:'Invalid or truncated response', results:[]};
+};
+
 nztwlee.demlookup.ElevationService.prototype.getElevationForLocations = function(request, callback) {
     this.sendElevationRequest(false,request,callback);
 };
@@ -65,58 +115,22 @@ nztwlee.demlookup.ElevationService.prototype.sendElevationRequest = function(isp
         callbackError(nztwlee.demlookup.ElevationStatus.UNKNOWN_ERROR,'XMLHttpRequest error: '+e);
     };
 
-    xhr.onreadystatechange = function() {
-//        console.log("onrsc");
-//        console.log(xhr.readyState);
-//        console.log(xhr.status);
-//        console.log(xhr.getResponseHeader('content-type'));
-        if (xhr.readyState === 2) { // HEADERS_RECEIVED
-            if (xhr.getResponseHeader('content-type')==="application/octet-stream") {
-                xhr.responseType = "arraybuffer";
-            }
-        }
-    };
-
     xhr.onload = function() {
             //console.log("onload");
             //console.log(xhr.readyState);
             //console.log(xhr.status);
-            //console.log(xhr.getResponseHeader('content-type'));
             if (xhr.readyState === 4) { // DONE
                     if (xhr.status === 200) { // SUCCESS
-                        if (xhr.responseType==="arraybuffer") {
-                            // got binary data: OK response
-                            var respBuffer = xhr.response;
-                            if (!respBuffer) {
-                                callbackError(nztwlee.demlookup.ElevationStatus.UNKNOWN_ERROR,'Invalid response buffer');
-                            }
-                            var respView = new DataView(respBuffer);
-                            var parsedData = [];
-                            for (var i = 0; i < respBuffer.byteLength; i += 16) {
-                                
-                                var lat = respView.getInt32(i)*1.0e-7;
-                                var lng = respView.getInt32(i+4)*1.0e-7;
-                                var q = respView.getInt32(i+8)*1.0e-3;
-                                var index = respView.getInt32(i+12);
-                                var latLng = new google.maps.LatLng(lat,lng);
-                                var result = {location:latLng, elevation:q};
-                                if (index>=0) result.pathIndex = index; // otherwise undefined
-                                parsedData.push(result);
-                                //latLng.height = q;
-                                //latLng.index = index;
-                                //console.log(i,lat,lng,q,index);
-                                //parsedData.push(latLng);
-                            }
-                            callback(parsedData,nztwlee.demlookup.ElevationStatus.OK);
-                                    
+                        var respBuffer = xhr.response;
+                        if (!respBuffer) {
+                            callbackError(nztwlee.demlookup.ElevationStatus.UNKNOWN_ERROR,'Invalid response buffer');
+                            return;
+                        }
+                        var parsed = self.parseBinaryResponse(respBuffer);
+                        if (parsed.status === nztwlee.demlookup.ElevationStatus.OK) {
+                            callback(parsed.results,parsed.status);
                         } else {
-                            // non-binary data: error
-                            responseStrings = xhr.responseText.split('\n');
-                            var elevationStatus = self.convertElevationStatusCode(responseStrings[0]);
-                            var error_message = responseStrings[1];
-                            var traceback = responseStrings[2];
-                            callbackError(elevationStatus,error_message);
-                            
+                            callbackError(parsed.status,parsed.error_message);
                         }
                     } else {
                         callbackError(nztwlee.demlookup.ElevationStatus.UNKNOWN_ERROR,'XMLHttpRequest failure');
@@ -127,6 +141,7 @@ nztwlee.demlookup.ElevationService.prototype.sendElevationRequest = function(isp
     // set up request
     //var url = "http://localhost:9080/elevation/binary";
     var url = "https://nz-twlee-demlookup.appspot.com/elevation/binary";
+    url = url + "?version=2";
 
     var pointArray;
     if (ispath) {
@@ -134,7 +149,7 @@ nztwlee.demlookup.ElevationService.prototype.sendElevationRequest = function(isp
             callbackError(nztwlee.demlookup.ElevationStatus.INVALID_REQUEST,
                           'Request object does not contain an path array');
         }
-        url = url + "?type=path";
+        url = url + "&type=path";
         if (request.samples) url = url + "&samples=" + request.samples;
         else if (request.stepsize) url = url + "&stepsize=" + request.stepsize;
         pointArray = request.path;
@@ -143,10 +158,13 @@ nztwlee.demlookup.ElevationService.prototype.sendElevationRequest = function(isp
             callbackError(nztwlee.demlookup.ElevationStatus.INVALID_REQUEST,
                           'Request object does not contain an array of locations');
         }
-        url = url + "?type=locations";
+        url = url + "&type=locations";
         pointArray = request.locations;
     }
     
+    if (request.interpolation) url = url + "&interpolation=" + request.interpolation;
+    if (request.slope) url = url + "&slope=1";
+
     if (pointArray.length<1) {
             callbackError(nztwlee.demlookup.ElevationStatus.INVALID_REQUEST,
                           'Request object contains no coordinates');
@@ -188,6 +206,7 @@ nztwlee.demlookup.ElevationService.prototype.sendElevationRequest = function(isp
     // send request
     xhr.open("POST", url, true);
     xhr.timeout = 30000;
+    xhr.responseType = "arraybuffer";
     xhr.setRequestHeader("Content-Type", "application/octet-stream");
     xhr.send(reqBuffer);
 
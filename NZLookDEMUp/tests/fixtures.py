@@ -0,0 +1,155 @@
+# coding: utf-8
+
+"""
+Test fixtures
+Copyright (c) 2014-2016 Tet Woo Lee
+
+Small synthetic DEM sets, read locally or from a fake cloud storage bucket 
+serving them (see ``fakegcs``), for tests. Tests need the App Engine SDK on the path and are
+run from the application directory with:
+
+    python -m unittest discover -s tests -t .
+
+"""
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+os.environ.setdefault('SERVER_SOFTWARE', 'Development/2.0') # cloudstorage uses local_api_url
+os.environ.setdefault('BUCKET_NAME', 'dem') # before demset is imported
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+from google.appengine.ext import testbed
+
+import deminterpolater
+import demset
+import fakegcs
+
+bucket = os.environ['BUCKET_NAME']
+
+def make_dem_directory(directory, heights=None, tiles_x=2, tiles_y=2, tile_size=400, data_offset=100):
+    """
+    Write a synthetic DEM set to ``directory``, with the list file and
+    ``nztmdem_1000x1000`` tiles laid out as expected by ``DEMSet``.
+
+    Arguments:
+
+        directory : string
+            directory to write to, existing DEM set is replaced
+        heights : function
+            function of integer arrays ``xs, ys`` giving heights to store, or 
+            ``None`` for default
+        tiles_x, tiles_y : int
+            number of tiles across and down
+        tile_size : int
+            width and height of each tile in pixels, multiple of 
+            ``DEMSet.DEM_reader_grid_resolution``
+        data_offset : int
+            offset of pixel data in each tile file
+
+    Return:
+
+        ``heights``, or default function if ``None``.
+
+    """
+    if heights is None: 
+        heights = lambda xs, ys: (100.0*np.sin(xs/37.0)*np.cos(ys/53.0) + 0.1*xs - 0.05*ys).astype('<f4')
+    if not os.path.isdir(os.path.join(directory, 'nztmdem_1000x1000')):
+        os.mkdir(os.path.join(directory, 'nztmdem_1000x1000'))
+    rows = ["path\timage_width\timage_height\timage_x0\timage_y0\timage_xn\timage_yn\tdata_offset\timage_E0\timage_N0"]
+    for tile_y in range(tiles_y):
+        for tile_x in range(tiles_x):
+            x0, y0 = tile_x*tile_size, tile_y*tile_size
+            xs, ys = np.meshgrid(np.arange(x0, x0 + tile_size), np.arange(y0, y0 + tile_size))
+            path = 'tile{}{}.tif'.format(tile_x, tile_y)
+            with open(os.path.join(directory, 'nztmdem_1000x1000', path), 'wb') as tile_file:
+                tile_file.write('\0'*data_offset)
+                tile_file.write(np.asarray(heights(xs, ys), '<f4').tostring())
+            rows.append('\t'.join(str(field) for field in (path, tile_size, tile_size, x0, y0, 
+                        x0 + tile_size - 1, y0 + tile_size - 1, data_offset, 1012000.0 + x0*15.0, 6234000.0 - y0*15.0)))
+    with open(os.path.join(directory, 'geotiff summary 1000x1000 no overlap.txt'), 'w') as list_file:
+        list_file.write('\n'.join(rows) + '\n')
+    return heights
+
+class FakeGCSTestCase(unittest.TestCase):
+    """
+    Test case with App Engine service stubs and a ``fakegcs`` server serving 
+    a temporary directory ``self.directory`` as the bucket ``bucket``. Tests 
+    run with the temporary directory as current directory.
+    """
+    multirange = True #: whether fake server answers multi-range requests with multipart responses
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_urlfetch_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+
+        self.directory = tempfile.mkdtemp()
+        self.server = fakegcs.FakeGCSServer(('localhost', 0), self.directory, bucket=bucket,
+                                            multirange=self.multirange)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.saved_api_url = os.environ.get('GCS_API_URL')
+        os.environ['GCS_API_URL'] = 'http://localhost:{}'.format(self.server.server_address[1])
+        self.saved_directory = os.getcwd()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.saved_directory)
+        if self.saved_api_url is None: del os.environ['GCS_API_URL']
+        else: os.environ['GCS_API_URL'] = self.saved_api_url
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+        self.testbed.deactivate()
+
+class LocalDEMTestCase(unittest.TestCase):
+    """
+    Test case with a synthetic DEM set (see ``make_dem_directory``) in a 
+    temporary directory ``self.directory``, read locally through 
+    ``deminterpolater.demset``, with heights given by ``self.heights``. Tests
+    run with the temporary directory as current directory.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.heights = make_dem_directory(self.directory)
+        self.saved_directory = os.getcwd()
+        os.chdir(self.directory)
+        self.saved_use_cloud = demset.use_cloud
+        demset.use_cloud = False
+        self.saved_demset = deminterpolater.demset
+        deminterpolater.demset = demset.DEMSet(block_caches=[])
+
+    def tearDown(self):
+        deminterpolater.demset = self.saved_demset
+        demset.use_cloud = self.saved_use_cloud
+        os.chdir(self.saved_directory)
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def pixel_to_NZTM(xs, ys):
+        """
+        Get NZTM2000 ``Es, Ns`` of DEM pixel coordinates ``xs, ys``.
+        """
+        return (deminterpolater.set0_E + np.asarray(xs) * deminterpolater.voxelE, 
+                deminterpolater.set0_N + np.asarray(ys) * deminterpolater.voxelN)
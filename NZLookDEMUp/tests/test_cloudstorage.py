@@ -0,0 +1,116 @@
+# coding: utf-8
+
+"""
+Tests of multi-range reads of bundled cloudstorage package, against fakegcs
+Copyright (c) 2014-2016 Tet Woo Lee
+"""
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from tests import fixtures
+
+import os
+import random
+import unittest
+
+import numpy as np
+
+import cloudstorage
+from cloudstorage import errors, storage_api
+
+class ReadRangesTest(fixtures.FakeGCSTestCase):
+    object_size = 300000
+
+    def setUp(self):
+        fixtures.FakeGCSTestCase.setUp(self)
+        self.data = np.random.RandomState(0).randint(0, 256, self.object_size).astype(np.uint8).tostring()
+        # include boundary of fake server in content, parts must be read by length
+        boundary = '\r\n--' + fixtures.fakegcs.FakeGCSRequestHandler.multipart_boundary + '\r\n'
+        self.data = self.data[:1000] + boundary + self.data[1000 + len(boundary):]
+        with open(os.path.join(self.directory, 'object'), 'wb') as object_file:
+            object_file.write(self.data)
+        self.object_file = cloudstorage.open('/{}/object'.format(fixtures.bucket), 'r', read_buffer_size=4096)
+        self.server.stats.reset()
+
+    def tearDown(self):
+        self.object_file.close()
+        fixtures.FakeGCSTestCase.tearDown(self)
+
+    def check_ranges(self, ranges):
+        self.assertEqual(self.object_file.read_ranges(ranges), [self.data[start:start + size] for start, size in ranges])
+
+    def test_scattered_ranges(self):
+        random_state = random.Random(1)
+        starts = sorted(random_state.sample(xrange(0, self.object_size - 100, 100), 200))
+        ranges = [(start, random_state.randint(1, 100)) for start in starts]
+        self.check_ranges(ranges)
+        # split into requests of at most MAX_RANGES_PER_REQUEST ranges
+        requests = -(-len(ranges) // storage_api.ReadBuffer.MAX_RANGES_PER_REQUEST)
+        if self.multirange:
+            self.assertEqual(self.server.stats.multirange_requests, requests)
+        else:
+            self.assertEqual(self.server.stats.multirange_requests, 0)
+
+    def test_single_range(self):
+        self.check_ranges([(12345, 6789)])
+        self.assertEqual(self.server.stats.get_requests, 1)
+
+    def test_adjacent_ranges(self):
+        self.check_ranges([(0, 10), (10, 10), (990, 100), (self.object_size - 5, 5)])
+
+    def test_range_past_end(self):
+        # range truncated by server is not covered by response, read with its own request
+        self.check_ranges([(100, 50), (self.object_size - 10, 20)])
+
+    def test_unsatisfiable_range(self):
+        self.assertRaises(errors.InvalidRange, self.object_file.read_ranges, 
+                          [(100, 50), (self.object_size + 10, 20)])
+
+    def test_read_unchanged(self):
+        # read_ranges does not move the offset of sequential reads
+        self.object_file.seek(500)
+        self.check_ranges([(10, 10), (100000, 10)])
+        self.assertEqual(self.object_file.read(100), self.data[500:600])
+
+class ReadRangesWholeObjectTest(ReadRangesTest):
+    """
+    Server that answers multi-range requests with the whole object.
+    """
+    multirange = False
+
+    def test_fallback(self):
+        # after a whole object response, ranges are requested one at a time
+        self.check_ranges([(10, 10), (200000, 10)])
+        self.assertEqual(self.server.stats.get_requests, 1)
+        self.server.stats.reset()
+        self.check_ranges([(10, 10), (200000, 10)])
+        self.assertEqual(self.server.stats.get_requests, 2)
+        self.assertEqual(self.server.stats.bytes_sent, 20)
+
+class ParseTest(unittest.TestCase):
+    def test_parse_content_range(self):
+        self.assertEqual(storage_api._parse_content_range('bytes 100-199/1000'), 100)
+        self.assertEqual(storage_api._parse_content_range(None), 0)
+
+    def test_parse_multipart_byteranges(self):
+        content = ('--abc\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes 0-4/100\r\n\r\n'
+                   '--abc\r\n--abc\r\nContent-Range: bytes 50-51/100\r\n\r\nxy\r\n--abc--\r\n')
+        self.assertEqual(storage_api._parse_multipart_byteranges('multipart/byteranges; boundary="abc"', content),
+                         [(0, '--abc'), (50, 'xy')])
+        self.assertRaises(ValueError, storage_api._parse_multipart_byteranges, 'multipart/byteranges', content)
+        self.assertRaises(ValueError, storage_api._parse_multipart_byteranges, 
+                          'multipart/byteranges; boundary=abc', '--abc\r\nContent-Range: bytes 0-4/100')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+# coding: utf-8
+
+"""
+Tests of deminterpolater module
+Copyright (c) 2014-2016 Tet Woo Lee
+"""
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from tests import fixtures
+
+import unittest
+
+import numpy as np
+
+import deminterpolater
+from nztm2000 import NZTM2000
+
+class GroundDistancesTest(unittest.TestCase):
+    def test_scale_factor(self):
+        # short segments are grid length divided by point scale factor
+        Es = np.array([1600000.0, 1600100.0, 1900000.0, 1900000.0])
+        Ns = np.array([5500000.0, 5500000.0, 5500000.0, 5500100.0])
+        distances = deminterpolater.ground_distances(Es, Ns)
+        self.assertAlmostEqual(distances[0], 100.0/NZTM2000.NZTM_k(1600050.0, 5500000.0), 6)
+        self.assertAlmostEqual(distances[2], 100.0/NZTM2000.NZTM_k(1900000.0, 5500050.0), 6)
+
+    def test_north_of_projected_bounds(self):
+        # DEM set extends north of NZTM2000 projected bounds (N 6223677)
+        Ns = np.array([6223000.0, 6223500.0, deminterpolater.set0_N])
+        Es = np.array([1700000.0, 1700000.0, 1700000.0])
+        distances = deminterpolater.ground_distances(Es, Ns)
+        self.assertTrue(np.isfinite(distances).all())
+        self.assertAlmostEqual(distances[1]/np.diff(Ns)[1], distances[0]/np.diff(Ns)[0], 6)
+
+class PathSamplesTest(fixtures.LocalDEMTestCase):
+    def test_single_point(self):
+        # all samples at point, as for path of single leg of no length
+        E, N = self.pixel_to_NZTM(100, 200)
+        Es, Ns, elevations = deminterpolater.interpolate_path_bysamples([(E, N)], samples=3)
+        np.testing.assert_array_equal(Es, [E]*3)
+        np.testing.assert_array_equal(Ns, [N]*3)
+        np.testing.assert_allclose(elevations, [self.heights(100, 200)]*3, rtol=1e-6)
+
+class SmartLineTest(fixtures.LocalDEMTestCase):
+    # profiles of interpolate_line_smart on fixture DEM as output by original
+    # implementation, as (x0, y0, x1, y1) pixel line, min_grade_delta,
+    # force_minmax, (E, N, elevation) points
+    expected_profiles = [
+        ((10.3, 20.7, 31.9, 12.2), 0.01, True, [
+            (1012162.0, 6233682.0, 25.40236488342285),
+            (1012352.5, 6233756.965277778, 57.21103605341028),
+            (1012457.5, 6233798.284722222, 72.68437293723777),
+            (1012486.0, 6233809.5, 76.49797637939453),
+        ]),
+        ((10.3, 20.7, 31.9, 12.2), 0.05, False, [
+            (1012162.0, 6233682.0, 25.40236488342285),
+            (1012486.0, 6233809.5, 76.49797637939453),
+        ]),
+        ((50.5, 60.0, 50.6, 80.0), 0.01, True, [
+            (1012765.0, 6233092.5, 43.626861572265625),
+            (1012766.5, 6232792.5, 7.065655517578126),
+            (1012766.5, 6232792.5, 7.065655517578126),
+        ]),
+        ((200.2, 200.3, 200.7, 200.6), 0.01, True, [
+            (1015010.5, 6230988.0, 71.53545623779299),
+            (1015018.0, 6230983.5, 70.60920669555667),
+        ]),
+        ((395.5, 10.5, 405.2, 14.1), 0.0, True, [
+            (1017940.0, 6233835.0, -54.4403772354126),
+            (1017947.5, 6233832.216494845, -54.73326305507385),
+            (1017960.2083333334, 6233827.5, -55.17028337054783),
+            (1017962.5, 6233826.649484536, -55.247027485641006),
+            (1017977.5, 6233821.082474227, -55.67921868550409),
+            (1017992.5, 6233815.5154639175, -56.040158871522884),
+            (1018000.625, 6233812.5, -56.19721666971843),
+            (1018007.5, 6233809.948453608, -56.32394271535972),
+            (1018022.5, 6233804.381443299, -56.52937039640761),
+            (1018037.5, 6233798.81443299, -56.66328650405727),
+            (1018041.0416666666, 6233797.5, -56.67813380559285),
+            (1018052.5, 6233793.24742268, -56.71603566592501),
+            (1018067.5, 6233787.680412371, -56.6944194479087),
+            (1018081.4583333334, 6233782.5, -56.608111116621224),
+            (1018082.5, 6233782.113402062, -56.600764795676945),
+            (1018085.5, 6233781.0, -56.56551429748535),
+        ]),
+        ((60.0, 60.0, 60.0, 60.0), 0.01, True, [
+            (1012907.5, 6233092.5, 45.4233283996582),
+            (1012907.5, 6233092.5, 45.4233283996582),
+        ]),
+    ]
+
+    def test_expected_profiles(self):
+        # output must stay identical to original implementation
+        for (x0, y0, x1, y1), min_grade_delta, force_minmax, expected in self.expected_profiles:
+            E0, N0 = self.pixel_to_NZTM(x0, y0)
+            E1, N1 = self.pixel_to_NZTM(x1, y1)
+            profile = deminterpolater.interpolate_line_smart(E0, N0, E1, N1, min_grade_delta, force_minmax)
+            np.testing.assert_array_equal(np.column_stack(profile), expected)
+
+class PathToleranceTest(fixtures.LocalDEMTestCase):
+    def profile(self, chunks):
+        # distance along path and elevation of points of chunks
+        Es, Ns, qs, path_indices = [np.concatenate(columns) for columns in zip(*chunks)]
+        return np.concatenate(([0.0], np.hypot(np.diff(Es), np.diff(Ns)).cumsum())), qs, path_indices
+
+    def test_within_tolerance(self):
+        # simplified profile stays within tolerance of full resolution profile,
+        # with small chunk_size so points held are simplified before end of leg
+        path = zip(*self.pixel_to_NZTM(np.array([5.5, 700.2, 790.7, 20.1]), np.array([5.3, 100.6, 780.4, 790.9])))
+        full_dist, full_qs, full_path_indices = self.profile(deminterpolater.iter_path_smart(path, min_grade_delta=0))
+        for tolerance in (0.5, 5.0):
+            dist, qs, path_indices = self.profile(deminterpolater.iter_path_bytolerance(path, tolerance, chunk_size=16))
+            self.assertEqual(list(path_indices[path_indices >= 0]), [0, 1, 2, 3])
+            self.assertAlmostEqual(dist[-1], full_dist[-1], 6)
+            self.assertLess(len(qs), len(full_qs) // 4)
+            error = np.abs(np.interp(full_dist, dist, qs) - full_qs)
+            self.assertLessEqual(error.max(), tolerance + 1e-6)
+
+class ProfileStatsTest(unittest.TestCase):
+    def profile_stats(self, qs, hysteresis=0.0, chunk=None):
+        stats = deminterpolater.ProfileStats(hysteresis)
+        qs = np.asarray(qs, float)
+        xs = np.arange(len(qs), dtype=float)
+        ys = np.zeros(len(qs))
+        chunk = chunk or len(qs)
+        for i in range(0, len(qs), chunk):
+            stats.add(xs[i:i+chunk], ys[i:i+chunk], qs[i:i+chunk])
+        return stats.result()
+
+    def test_no_hysteresis(self):
+        result = self.profile_stats([100, 105, 105, 102, 110, 90])
+        self.assertAlmostEqual(result['ascent'], 13.0)
+        self.assertAlmostEqual(result['descent'], 23.0)
+        self.assertEqual(result['min_elevation'], 90.0)
+        self.assertEqual(result['max_elevation'], 110.0)
+
+    def test_hysteresis(self):
+        # dip at start and rise at end are less than hysteresis, drop at end is
+        # counted to end of profile
+        result = self.profile_stats([100, 95, 120, 115, 130, 125], hysteresis=10.0)
+        self.assertAlmostEqual(result['ascent'], 30.0)
+        self.assertAlmostEqual(result['descent'], 5.0)
+        result = self.profile_stats([100, 80, 85, 75, 78], hysteresis=10.0)
+        self.assertAlmostEqual(result['ascent'], 3.0)
+        self.assertAlmostEqual(result['descent'], 25.0)
+
+    def test_within_hysteresis(self):
+        # never leaves hysteresis band around first elevation
+        result = self.profile_stats([100, 103, 97, 101], hysteresis=10.0)
+        self.assertAlmostEqual(result['ascent'], 1.0)
+        self.assertAlmostEqual(result['descent'], 0.0)
+        result = self.profile_stats([100], hysteresis=10.0)
+        self.assertEqual((result['ascent'], result['descent']), (0.0, 0.0))
+
+    def test_net_change(self):
+        qs = np.random.RandomState(1).normal(0.0, 5.0, 1000).cumsum()
+        for hysteresis in (0.0, 2.0, 20.0):
+            result = self.profile_stats(qs, hysteresis)
+            self.assertAlmostEqual(result['ascent'] - result['descent'], qs[-1] - qs[0], 6)
+            # result independent of chunks points are added in
+            for chunk in (1, 7, 100):
+                chunked = self.profile_stats(qs, hysteresis, chunk)
+                for field in deminterpolater.ProfileStats.fields:
+                    self.assertAlmostEqual(chunked[field], result[field], 6)
+
+    def test_repeated_result(self):
+        stats = deminterpolater.ProfileStats(10.0)
+        stats.add(np.arange(3.0), np.zeros(3), np.array([100.0, 120.0, 115.0]))
+        self.assertEqual(stats.result(), stats.result())
+        stats.add(np.arange(3.0, 4.0), np.zeros(1), np.array([112.0]))
+        self.assertAlmostEqual(stats.result()['ascent'], 20.0)
+        self.assertAlmostEqual(stats.result()['descent'], 8.0)
+
+if __name__ == '__main__':
+    unittest.main()
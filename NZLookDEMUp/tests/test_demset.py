@@ -0,0 +1,193 @@
+# coding: utf-8
+
+"""
+Tests of demset module
+Copyright (c) 2014-2016 Tet Woo Lee
+"""
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from tests import fixtures
+
+import unittest
+
+import numpy as np
+
+import deminterpolater
+import demset
+from tilecache import LocalBlockCache, MemcacheBlockCache
+
+class CloudDEMSetTest(fixtures.FakeGCSTestCase):
+    def setUp(self):
+        fixtures.FakeGCSTestCase.setUp(self)
+        self.heights = fixtures.make_dem_directory(self.directory)
+        self.saved_use_cloud = demset.use_cloud
+        demset.use_cloud = True
+        random_state = np.random.RandomState(0)
+        self.xs = random_state.randint(0, 800, 500)
+        self.ys = random_state.randint(0, 800, 500)
+
+    def tearDown(self):
+        demset.use_cloud = self.saved_use_cloud
+        fixtures.FakeGCSTestCase.tearDown(self)
+
+    def check_values(self, DEM_set):
+        np.testing.assert_array_equal(DEM_set.get_values(self.xs, self.ys), self.heights(self.xs, self.ys))
+        self.assertEqual(DEM_set.get_value(int(self.xs[0]), int(self.ys[0])), self.heights(self.xs[0], self.ys[0]))
+
+    def test_get_values(self):
+        self.check_values(demset.DEMSet(block_caches=[]))
+
+    def test_get_values_block_caches(self):
+        # first lookups read blocks of readers that are not yet active
+        self.check_values(demset.DEMSet(block_caches=[LocalBlockCache(16 * 1024 * 1024), MemcacheBlockCache()]))
+        # blocks now in memcache, shared with new readers
+        self.server.stats.reset()
+        self.check_values(demset.DEMSet(block_caches=[MemcacheBlockCache()]))
+        self.assertEqual(self.server.stats.multirange_requests, 0)
+
+    def test_default_block_caches(self):
+        # blocks read are kept in memory by default, repeated lookups are not read again
+        DEM_set = demset.DEMSet()
+        self.assertIsInstance(DEM_set.block_caches[0], LocalBlockCache)
+        self.check_values(DEM_set)
+        requests = self.server.stats.get_requests
+        for repeat in range(3):
+            self.check_values(DEM_set)
+        self.assertEqual(self.server.stats.get_requests, requests)
+
+    def test_changed_file(self):
+        # blocks cached for old file contents are not used after file changes
+        block_cache = LocalBlockCache(16 * 1024 * 1024)
+        self.check_values(demset.DEMSet(block_caches=[block_cache]))
+        heights = self.heights
+        self.heights = lambda xs, ys: heights(xs, ys) + 1
+        fixtures.make_dem_directory(self.directory, heights=self.heights)
+        self.check_values(demset.DEMSet(block_caches=[block_cache]))
+
+    def test_deactivated_while_reading(self):
+        # window read while another thread deactivates the reader is returned
+        # but not kept as the buffer
+        DEM_set = demset.DEMSet(block_caches=[])
+        x, y = int(self.xs[0]), int(self.ys[0])
+        DEM_reader = DEM_set.DEM_grid[y/DEM_set.DEM_reader_grid_resolution][x/DEM_set.DEM_reader_grid_resolution]
+        read_file_ranges = DEM_reader.read_file_ranges
+        def read_file_ranges_deactivate(ranges):
+            data = read_file_ranges(ranges)
+            with DEM_reader.lock:
+                DEM_reader.deactivate()
+            return data
+        DEM_reader.read_file_ranges = read_file_ranges_deactivate
+        self.assertEqual(DEM_reader.get_value(x, y), self.heights(x, y))
+        self.assertFalse(DEM_reader.is_active())
+        self.assertIsNone(DEM_reader.window)
+        del DEM_reader.read_file_ranges
+        self.assertEqual(DEM_reader.get_value(x, y), self.heights(x, y))
+        self.assertIsNotNone(DEM_reader.window)
+
+class LocalDEMSetTest(fixtures.LocalDEMTestCase):
+    def test_get_values(self):
+        DEM_set = deminterpolater.demset
+        random_state = np.random.RandomState(0)
+        xs = random_state.randint(0, 800, 500)
+        ys = random_state.randint(0, 800, 500)
+        np.testing.assert_array_equal(DEM_set.get_values(xs, ys), self.heights(xs, ys))
+        # tiles fit in buffer, so are read once and repeated lookups are served from buffer
+        file_reads = []
+        for DEM_reader in DEM_set.DEM_readers:
+            self.assertIsNotNone(DEM_reader.window)
+            DEM_reader.read_file_ranges = lambda ranges: file_reads.append(ranges)
+        np.testing.assert_array_equal(DEM_set.get_values(xs, ys), self.heights(xs, ys))
+        self.assertEqual(file_reads, [])
+
+class PixelMemoTest(fixtures.LocalDEMTestCase):
+    def setUp(self):
+        super(PixelMemoTest, self).setUp()
+        # count pixels read from DEM set, not found in memo
+        self.DEM_set = deminterpolater.demset
+        self.pixels_read = []
+        read_values = self.DEM_set.read_values
+        def read_values_counted(xs, ys, raise_exception=True):
+            self.pixels_read.append(len(xs))
+            return read_values(xs, ys, raise_exception)
+        self.DEM_set.read_values = read_values_counted
+
+    def test_get_values(self):
+        memo = demset.PixelMemo()
+        random_state = np.random.RandomState(0)
+        xs = random_state.randint(0, 50, 500)
+        ys = random_state.randint(0, 50, 500)
+        np.testing.assert_array_equal(memo.get_values(self.DEM_set, xs, ys), self.DEM_set.read_values(xs, ys))
+        unique = len(set(zip(xs, ys)))
+        self.assertEqual(self.pixels_read, [unique, 500])
+        # repeated and overlapping lookups read only new pixels
+        del self.pixels_read[:]
+        np.testing.assert_array_equal(memo.get_values(self.DEM_set, ys[::-1], xs[::-1]), self.heights(ys[::-1], xs[::-1]))
+        np.testing.assert_array_equal(memo.get_values(self.DEM_set, xs[:10]+100, ys[:10]), self.heights(xs[:10]+100, ys[:10]))
+        self.assertEqual(self.pixels_read, [len(set(zip(ys, xs)) - set(zip(xs, ys))), len(set(zip(xs[:10], ys[:10])))])
+        self.assertEqual(len(memo.keys), len(set(zip(xs, ys)) | set(zip(ys, xs))) + len(set(zip(xs[:10], ys[:10]))))
+
+    def test_max_pixels(self):
+        # when full, only pixels of latest lookup are kept
+        memo = demset.PixelMemo(max_pixels=10)
+        memo.get_values(self.DEM_set, np.arange(8), np.zeros(8))
+        memo.get_values(self.DEM_set, np.arange(5), np.ones(5))
+        np.testing.assert_array_equal(memo.keys, np.arange(5) + memo.key_stride)
+        np.testing.assert_array_equal(memo.values, self.heights(np.arange(5), np.ones(5)))
+        memo.get_values(self.DEM_set, np.arange(8), np.zeros(8))
+        self.assertEqual(self.pixels_read, [8, 5, 8])
+        # latest lookup larger than memo, none kept
+        memo.get_values(self.DEM_set, np.arange(11), np.zeros(11))
+        self.assertEqual(len(memo.keys), 0)
+
+    def test_missing_pixels(self):
+        # out-of-range and nan pixels are read again each time
+        memo = demset.PixelMemo()
+        xs, ys = np.array([-1, 10, 900, 20]), np.array([5, 10, 5, 20])
+        for i in range(2):
+            values = memo.get_values(self.DEM_set, xs, ys, raise_exception=False)
+            self.assertTrue(np.isnan(values[[0, 2]]).all())
+            np.testing.assert_array_equal(values[[1, 3]], self.heights(xs[[1, 3]], ys[[1, 3]]))
+        self.assertEqual(self.pixels_read, [4, 2])
+        with self.assertRaises(IndexError):
+            memo.get_values(self.DEM_set, xs, ys)
+        read_values = self.DEM_set.read_values
+        self.DEM_set.read_values = lambda xs, ys, raise_exception=True: np.where(xs == 30, np.nan, read_values(xs, ys))
+        self.assertTrue(np.isnan(memo.get_values(self.DEM_set, [30, 31], [30, 30])[0]))
+        self.assertEqual(sorted(memo.keys % memo.key_stride), [10, 20, 31])
+
+    def test_pixel_memo(self):
+        # memo used by get_values within pixel_memo, and previous memo restored on exit
+        request_local = self.DEM_set.request_local
+        self.assertIsNone(getattr(request_local, 'pixel_memo', None))
+        with self.DEM_set.pixel_memo() as memo:
+            self.assertIs(request_local.pixel_memo, memo)
+            self.DEM_set.get_values([1, 2], [3, 4])
+            self.assertEqual(len(memo.keys), 2)
+            with self.DEM_set.pixel_memo(memo=demset.PixelMemo()) as inner_memo:
+                self.assertIs(request_local.pixel_memo, inner_memo)
+            self.assertIs(request_local.pixel_memo, memo)
+        self.assertIsNone(request_local.pixel_memo)
+        # memo reused, and restored after exception
+        with self.assertRaises(IndexError):
+            with self.DEM_set.pixel_memo(memo=memo) as reused_memo:
+                self.assertIs(reused_memo, memo)
+                self.DEM_set.get_values([1, 2, -1], [3, 4, 5])
+        self.assertIsNone(request_local.pixel_memo)
+        self.assertEqual(self.pixels_read, [2, 1])
+        self.DEM_set.get_values([1, 2], [3, 4])
+        self.assertEqual(self.pixels_read, [2, 1, 2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+# coding: utf-8
+
+"""
+Tests of elevation request handler
+Copyright (c) 2014-2016 Tet Woo Lee
+"""
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from tests import fixtures
+
+import gc
+import json
+import unittest
+
+import numpy as np
+import webapp2
+
+import deminterpolater
+import nzlookdemup
+
+class HandlerTestCase(fixtures.LocalDEMTestCase):
+    def request(self, url):
+        return webapp2.Request.blank(url, headers={'Origin': 'http://localhost'})
+
+    def get(self, url):
+        return self.request(url).get_response(nzlookdemup.application)
+
+    def start_get(self, url):
+        # start response to GET request, returns response body iterable, not yet read
+        return nzlookdemup.application(self.request(url).environ, lambda status, headers, exc_info=None: None)
+
+    def path_NZTM(self, xs, ys):
+        # path or locations parameter of DEM pixels, as NZTM2000 E,N
+        return '|'.join('{:.2f},{:.2f}'.format(E, N) for E, N in zip(*self.pixel_to_NZTM(xs, ys)))
+
+class StreamingTest(HandlerTestCase):
+    def test_unfinished_response(self):
+        # responses not read to the end leave no pixel memo set on this thread,
+        # and nothing uncollectable
+        gc.collect()
+        garbage = len(gc.garbage)
+        for output in ('binary?', 'binary?version=2&', 'csv?', 'json?', 'json?compact=1&'):
+            app_iter = self.start_get('/elevation/{}crs=2193&path={}&stepsize=1'.format(output,
+                                                                                      self.path_NZTM([10, 790], [10, 790])))
+            chunks = iter(app_iter)
+            next(chunks)
+            next(chunks)
+            self.assertIsNone(getattr(deminterpolater.demset.request_local, 'pixel_memo', None))
+            if hasattr(app_iter, 'close'): app_iter.close() # as for client disconnect
+            del app_iter, chunks
+        gc.collect()
+        self.assertEqual(len(gc.garbage), garbage)
+
+class BinaryTest(HandlerTestCase):
+    def read_blocks(self, body):
+        # blocks of version 2 response as (header, message, columns), checking padding
+        format = nzlookdemup.BinaryFormat2
+        blocks = []
+        offset = 0
+        def read_padded(length):
+            data = body[offset:offset+length]
+            padding = body[offset+length:offset+length+(-length % 8)]
+            self.assertEqual((len(data), padding), (length, '\0' * (-length % 8)))
+            return data, offset+length+len(padding)
+        while offset < len(body):
+            self.assertFalse(blocks and blocks[-1][0][4], 'block after last block')
+            header = format.header.unpack_from(body, offset)
+            self.assertEqual(header[:2], (format.magic, format.version))
+            magic, version, flags, status, is_last, count, message_length = header
+            offset += format.header.size
+            message, offset = read_padded(message_length)
+            if flags & format.FLAG_STATS: dtypes = ['<f8']
+            else:
+                dtypes = ['<f8'] if flags & format.FLAG_DISTANCE else ['<f8', '<f8']
+                dtypes += ['<f4', '<i4'] + (['<f4', '<f4'] if flags & format.FLAG_SLOPE else [])
+            columns = []
+            if count:
+                for dtype in dtypes:
+                    data, offset = read_padded(count * np.dtype(dtype).itemsize)
+                    columns.append(np.frombuffer(data, dtype))
+            blocks.append((header, message, columns))
+        self.assertTrue(blocks[-1][0][4], 'no last block')
+        return blocks
+
+    def test_binary_v2(self):
+        # long paths over several blocks, and odd counts, so float32 and int32 columns are padded
+        counts = []
+        for path in (self.path_NZTM([10, 790, 790], [10, 790, 10]), self.path_NZTM([100, 201, 300], [100, 300, 302])):
+            for params in ('&stepsize=1', '&stepsize=1&slope=1', '&samples=7&distance=1'):
+                url = '/elevation/{}?crs=2193&path={}{}'
+                response = self.get(url.format('binary', path, params+'&version=2'))
+                self.assertEqual(response.content_type, 'application/octet-stream')
+                blocks = self.read_blocks(response.body)
+                counts.append([header[5] for header, message, columns in blocks[:-1]])
+                expected = json.loads(self.get(url.format('json', path, params)).body)['results']
+                (magic, version, flags, status, is_last, count, message_length), message, columns = blocks[-1]
+                self.assertEqual((status, count, message), (0, 0, ''))
+                format = nzlookdemup.BinaryFormat2
+                self.assertEqual(flags, (format.FLAG_DISTANCE if 'distance' in params else format.FLAG_LATLNG) | 
+                                 format.FLAG_NZTM | (format.FLAG_SLOPE if 'slope' in params else 0))
+                columns = [np.concatenate(column) for column in zip(*[columns for header, message, columns in blocks[:-1]])]
+                if 'distance' in params:
+                    np.testing.assert_allclose(columns.pop(0), [row['distance'] for row in expected])
+                else:
+                    np.testing.assert_allclose(columns.pop(0), [row['location']['E'] for row in expected])
+                    np.testing.assert_allclose(columns.pop(0), [row['location']['N'] for row in expected])
+                np.testing.assert_allclose(columns[0], [row['elevation'] for row in expected], rtol=1e-6)
+                np.testing.assert_array_equal(columns[1], [row.get('path_index', -1) for row in expected])
+                if 'slope' in params:
+                    np.testing.assert_allclose(columns[2], [row['slope'] for row in expected], rtol=1e-5)
+        self.assertGreater(max(len(block_counts) for block_counts in counts), 1)
+        self.assertTrue(any(count % 2 for block_counts in counts for count in block_counts))
+
+    def test_binary_v2_error(self):
+        # error after first results in last block, after them
+        path = self.path_NZTM([10, 790, 900], [10, 790, 790])
+        blocks = self.read_blocks(self.get('/elevation/binary?version=2&crs=2193&path={}&stepsize=1'.format(path)).body)
+        self.assertGreater(blocks[0][0][5], 0)
+        (magic, version, flags, status, is_last, count, message_length), message, columns = blocks[-1]
+        self.assertEqual(nzlookdemup.BinaryFormat2.statuses[status], 'INVALID_REQUEST')
+        self.assertIn('out of DEM bounds', message)
+        # error before any results, only block
+        blocks = self.read_blocks(self.get('/elevation/binary?version=2&crs=2193&locations={}'.format(path)).body)
+        self.assertEqual([header[3:6] for header, message, columns in blocks], [(1, 1, 0)])
+        blocks = self.read_blocks(self.get('/elevation/binary?version=2&crs=2193&path=x').body)
+        self.assertEqual([header[3:6] for header, message, columns in blocks], [(1, 1, 0)])
+
+    def test_binary_v1(self):
+        # records of big-endian int32 E, N (cm), elevation (mm), path_index
+        path = self.path_NZTM([10, 790, 790], [10, 790, 10])
+        body = self.get('/elevation/binary?crs=2193&path={}&stepsize=1'.format(path)).body
+        records = np.frombuffer(body, '>i4').reshape(-1, 4)
+        expected = json.loads(self.get('/elevation/json?crs=2193&path={}&stepsize=1'.format(path)).body)['results']
+        self.assertEqual(len(records), len(expected))
+        np.testing.assert_allclose(records[:, 0], [row['location']['E']*1e2 for row in expected], atol=1)
+        np.testing.assert_allclose(records[:, 2], [row['elevation']*1e3 for row in expected], atol=1)
+        np.testing.assert_array_equal(records[:, 3], [row.get('path_index', -1) for row in expected])
+        # error after first results, as record of all -2**31 then error as text
+        path = self.path_NZTM([10, 790, 900], [10, 790, 790])
+        body = self.get('/elevation/binary?crs=2193&path={}&stepsize=1'.format(path)).body
+        error_offset = body.index(np.array([-2**31]*4, '>i4').tostring())
+        self.assertGreater(error_offset, 0)
+        self.assertEqual(error_offset % 16, 0)
+        status, message = body[error_offset+16:].split('\n')[:2]
+        self.assertEqual(status, 'INVALID_REQUEST')
+        self.assertIn('out of DEM bounds', message)
+
+class CsvTest(HandlerTestCase):
+    def test_csv(self):
+        path = self.path_NZTM([10, 790, 790], [10, 790, 10])
+        lines = self.get('/elevation/csv?crs=2193&path={}&stepsize=1&slope=1'.format(path)).body.splitlines()
+        expected = json.loads(self.get('/elevation/json?crs=2193&path={}&stepsize=1'.format(path)).body)['results']
+        self.assertEqual(lines[0], 'E,N,elevation,path_index,slope,aspect')
+        self.assertEqual(len(lines), len(expected)+1)
+        self.assertEqual([line for line in lines if line.startswith('#')], [])
+        for line, row in zip(lines[1:], expected):
+            E, N, elevation, path_index = line.split(',')[:4]
+            self.assertEqual(float(elevation), round(row['elevation'], 2))
+            self.assertEqual(path_index, str(row.get('path_index', '')))
+        # error after first results, as #status trailer
+        path = self.path_NZTM([10, 790, 900], [10, 790, 790])
+        lines = self.get('/elevation/csv?crs=2193&path={}&stepsize=1'.format(path)).body.splitlines()
+        self.assertGreater(len(lines), 2)
+        self.assertTrue(lines[-1].startswith('#INVALID_REQUEST,'), lines[-1])
+        self.assertIn('out of DEM bounds', lines[-1])
+        self.assertEqual([line for line in lines[:-1] if line.startswith('#')], [])
+
+class JsonTest(HandlerTestCase):
+    def test_streamed_json(self):
+        # long results are streamed, formatted as for whole response
+        path = self.path_NZTM([10, 790, 790], [10, 790, 10])
+        response = self.get('/elevation/json?crs=2193&path={}&stepsize=1'.format(path))
+        self.assertEqual(response.content_type, 'application/json')
+        result = json.loads(response.body)
+        self.assertEqual(result['status'], 'OK')
+        self.assertGreater(len(result['results']), 20000)
+        self.assertEqual(response.body, json.dumps(result, indent=4, sort_keys=True))
+        self.assertEqual([result['path_index'] for result in result['results'] if 'path_index' in result], [0, 1, 2])
+        # point of path outside DEM set, error after first results follows them
+        path = self.path_NZTM([10, 790, 900], [10, 790, 790])
+        result = json.loads(self.get('/elevation/json?crs=2193&path={}&stepsize=1'.format(path)).body)
+        self.assertEqual(result['status'], 'INVALID_REQUEST')
+        self.assertIn('out of DEM bounds', result['error_message'])
+        self.assertGreater(len(result['results']), 0)
+        # error before any results
+        result = json.loads(self.get('/elevation/json?crs=2193&locations={}'.format(path)).body)
+        self.assertEqual((result['status'], result['results']), ('INVALID_REQUEST', []))
+
+    def test_compact_json(self):
+        # same results as json, rounded, without whitespace
+        path = self.path_NZTM([10, 790, 790], [10, 790, 10])
+        for params in ('', '&slope=1', '&distance=1', '&samples=9&distance=1'):
+            url = '/elevation/json?crs=2193&path={}&stepsize=50{}'.format(path, params)
+            expected = json.loads(self.get(url).body)
+            body = self.get(url + '&compact=1').body
+            self.assertNotIn(' ', body)
+            result = json.loads(body)
+            self.assertEqual(result['status'], 'OK')
+            self.assertEqual(len(result['results']), len(expected['results']))
+            for row, expected_row in zip(result['results'], expected['results']):
+                self.assertEqual(sorted(row), sorted(expected_row))
+                self.assertEqual(row.get('path_index'), expected_row.get('path_index'))
+                self.assertAlmostEqual(row['elevation'], expected_row['elevation'], 2)
+                if 'location' in row:
+                    self.assertAlmostEqual(row['location']['E'], expected_row['location']['E'], 2)
+                    self.assertAlmostEqual(row['location']['N'], expected_row['location']['N'], 2)
+                if 'slope' in row:
+                    self.assertAlmostEqual(row['slope'], expected_row['slope'], 2)
+            # columns of same results
+            columns = json.loads(self.get(url + '&shape=columns').body)
+            self.assertEqual(columns['status'], 'OK')
+            for name, values in columns['results'].items():
+                self.assertEqual(len(values), len(result['results']), name)
+            self.assertEqual(columns['results']['elevation'], [row['elevation'] for row in result['results']])
+            self.assertEqual(columns['results']['path_index'], [row.get('path_index') for row in result['results']])
+
+    def test_compact_json_precision(self):
+        locations = self.path_NZTM([100, 200], [100, 300])
+        body = self.get('/elevation/json?crs=2193&locations={}&compact=1&precision=0&elevation_precision=0'.format(locations)).body
+        E, N = self.pixel_to_NZTM(200, 300)
+        self.assertIn('{{"elevation":{:.0f},"location":{{"E":{:.0f},"N":{:.0f}}},"path_index":1}}'.format(
+                      float(self.heights(200, 300)), E, N), body)
+        # error after first results follows them
+        path = self.path_NZTM([10, 790, 900], [10, 790, 790])
+        for params in ('&compact=1', '&shape=columns'):
+            result = json.loads(self.get('/elevation/json?crs=2193&path={}&stepsize=1{}'.format(path, params)).body)
+            self.assertEqual(result['status'], 'INVALID_REQUEST')
+
+class PathTest(HandlerTestCase):
+    def test_single_point(self):
+        # no legs, so no results, except all samples at the point
+        path = self.path_NZTM([100], [200])
+        for mode in ('', '&tolerance=1', '&stepsize=100', '&distance=1'):
+            result = json.loads(self.get('/elevation/json?crs=2193&path={}{}'.format(path, mode)).body)
+            self.assertEqual((result['status'], result['results']), ('OK', []), mode)
+        result = json.loads(self.get('/elevation/json?crs=2193&path={}&samples=3'.format(path)).body)
+        self.assertEqual(result['status'], 'OK')
+        self.assertEqual([result.get('path_index') for result in result['results']], [0, None, 0])
+
+if __name__ == '__main__':
+    unittest.main()
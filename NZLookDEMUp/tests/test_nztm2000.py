@@ -0,0 +1,189 @@
+# coding: utf-8
+
+"""
+Tests of nztm2000 module
+Copyright (c) 2014-2016 Tet Woo Lee
+"""
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from nztm2000 import NZTM2000, NZTM2000Kruger, NZTM2000Grid, TaylorGrid
+
+# (lat, lng, E, N), from NZ Map Reference Converter (LINZ) and the EPSG:2193 bounds
+control_points = [(-36.884391, 174.749642, 1755918.47, 5916523.26),
+                  (-47.4000, 166.3300, 1096802.28, 4728776.87),
+                  (-34.0000, 178.6000, 2117458.35, 6223676.23),
+                  (-34.0000, 166.3300, 983515.72, 6217723.72)]
+control_tolerance = 0.01 # metres, E, N of control points are rounded to 0.01 m
+
+def random_points(count=20000):
+    """
+    Random lat, lng arrays within WGS84 bounds that are also within 
+    projected bounds.
+    """
+    random_state = np.random.RandomState(0)
+    phis = random_state.uniform(-47.4, -34.0, count)
+    lmbs = random_state.uniform(166.33, 178.6, count)
+    within_bounds = NZTM2000.NZTM_to_latlng_many(*NZTM2000.latlng_to_NZTM_many(phis, lmbs)[:2])[2]
+    return phis[within_bounds], lmbs[within_bounds]
+
+def latlng_distances(phis0, lmbs0, phis1, lmbs1):
+    """
+    Approximate distances in metres between arrays of lat, lng points a few
+    metres or less apart.
+    """
+    dN = (phis1 - phis0) * (math.pi/180.0) * NZTM2000.a
+    dE = (lmbs1 - lmbs0) * (math.pi/180.0) * NZTM2000.a * np.cos(phis0 * (math.pi/180.0))
+    return np.hypot(dE, dN)
+
+class ProjectionTest(unittest.TestCase):
+    engine = NZTM2000Kruger
+    round_trip_tolerance = 1e-6 # metres
+    array_tolerance = 1e-6 # metres, of array conversions against scalar
+
+    def test_control_points(self):
+        for phi, lmb, E, N in control_points:
+            E_, N_ = self.engine.latlng_to_NZTM(phi, lmb)
+            self.assertLess(math.hypot(E_ - E, N_ - N), control_tolerance)
+            phi_, lmb_ = self.engine.NZTM_to_latlng(E, N)
+            self.assertLess(latlng_distances(phi, lmb, phi_, lmb_), control_tolerance)
+            Es, Ns, valid = self.engine.latlng_to_NZTM_many([phi], [lmb])
+            self.assertTrue(valid.all())
+            self.assertLess(math.hypot(Es[0] - E, Ns[0] - N), control_tolerance)
+
+    def test_round_trip(self):
+        phis, lmbs = random_points()
+        Es, Ns, valid = self.engine.latlng_to_NZTM_many(phis, lmbs)
+        self.assertTrue(valid.all())
+        phis_, lmbs_, valid = self.engine.NZTM_to_latlng_many(Es, Ns)
+        self.assertTrue(valid.all())
+        self.assertLess(latlng_distances(phis, lmbs, phis_, lmbs_).max(), self.round_trip_tolerance)
+        for phi, lmb in zip(phis[:100], lmbs[:100]):
+            phi_, lmb_ = self.engine.NZTM_to_latlng(*self.engine.latlng_to_NZTM(phi, lmb))
+            self.assertLess(latlng_distances(phi, lmb, phi_, lmb_), self.round_trip_tolerance)
+
+    def test_scalar_matches_array(self):
+        phis, lmbs = random_points(200)
+        Es, Ns, valid = self.engine.latlng_to_NZTM_many(phis, lmbs)
+        for phi, lmb, E, N in zip(phis, lmbs, Es, Ns):
+            E_, N_ = self.engine.latlng_to_NZTM(phi, lmb)
+            self.assertLess(math.hypot(E_ - E, N_ - N), self.array_tolerance)
+
+    def test_out_of_range(self):
+        self.assertRaises(ValueError, self.engine.latlng_to_NZTM, -30.0, 174.0)
+        self.assertRaises(ValueError, self.engine.NZTM_to_latlng, 1600000.0, 7000000.0)
+        Es, Ns, valid = self.engine.latlng_to_NZTM_many([-30.0, -40.0, np.nan], [174.0, 174.0, 174.0])
+        self.assertEqual(valid.tolist(), [False, True, False])
+        self.assertTrue(np.isnan(Es[0]) and np.isnan(Ns[2]))
+        phis, lmbs, valid = self.engine.NZTM_to_latlng_many([1600000.0, 1600000.0], [7000000.0, 5500000.0])
+        self.assertEqual(valid.tolist(), [False, True])
+
+class RedfearnProjectionTest(ProjectionTest):
+    engine = NZTM2000
+    round_trip_tolerance = 3e-3 # metres, LINZ series inverse is less accurate
+
+class GridProjectionTest(ProjectionTest):
+    engine = NZTM2000Grid
+    round_trip_tolerance = 2*NZTM2000Grid.max_error
+    array_tolerance = NZTM2000Grid.max_error # scalar conversions use series
+
+class TaylorGridTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_quadratic(self):
+        # 2nd order expansion is exact for quadratic mappings
+        function = lambda xs, ys: (3.0 + 2.0*xs - ys + 0.5*xs*xs + xs*ys, -1.0 + xs + 4.0*ys - 0.25*ys*ys)
+        grid = TaylorGrid.build(function, -5.0, 10.0, 2.0, (6, 8))
+        random_state = np.random.RandomState(0)
+        xs = random_state.uniform(-5.0, 9.0, 1000)
+        ys = random_state.uniform(10.0, 20.0, 1000)
+        for values, expected in zip(grid.evaluate(xs, ys), function(xs, ys)):
+            np.testing.assert_allclose(values, expected, rtol=0, atol=1e-9)
+
+    def test_save_load(self):
+        grid = TaylorGrid.build(NZTM2000Grid.forward_degrees, 174.0, -37.0, 0.1, (5, 7))
+        grid.save(self.directory, 'test')
+        loaded = TaylorGrid(grid.x0, grid.y0, grid.step, grid.shape, None)
+        self.assertTrue(loaded.load(self.directory, 'test'))
+        self.assertTrue(isinstance(loaded.coefficients.base, np.memmap))
+        np.testing.assert_array_equal(loaded.coefficients, grid.coefficients)
+        xs, ys = np.array([174.05, 174.33, 174.61]), np.array([-36.95, -36.71, -36.62])
+        for values, expected in zip(loaded.evaluate(xs, ys), grid.evaluate(xs, ys)):
+            np.testing.assert_array_equal(values, expected)
+        # not saved, or different shape
+        self.assertFalse(loaded.load(self.directory, 'other'))
+        self.assertFalse(TaylorGrid(grid.x0, grid.y0, grid.step, (5, 8), None).load(self.directory, 'test'))
+        self.assertEqual(os.listdir(self.directory), [grid.file_name('test')]) # no temporary files left
+
+class GridTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_error_bound(self):
+        # grids are within max_error of series everywhere, not just where checked,
+        # and max_error is strictly within 1 mm
+        self.assertLess(NZTM2000Grid.max_error, 1e-3)
+        phis, lmbs = random_points()
+        Es, Ns = NZTM2000Kruger.latlng_to_NZTM_many(phis, lmbs)[:2]
+        Es_, Ns_ = NZTM2000Grid.latlng_to_NZTM_many(phis, lmbs)[:2]
+        self.assertLess(np.hypot(Es_ - Es, Ns_ - Ns).max(), NZTM2000Grid.max_error)
+        phis_, lmbs_ = NZTM2000Grid.NZTM_to_latlng_many(Es, Ns)[:2]
+        self.assertLess(latlng_distances(phis, lmbs, phis_, lmbs_).max(), NZTM2000Grid.max_error)
+
+    def test_check_grid(self):
+        class CoarseGrid(NZTM2000Grid):
+            latlng_step = 1.0
+            grids = {}
+        self.assertRaises(RuntimeError, CoarseGrid.get_grid, 'forward')
+        self.assertEqual(CoarseGrid.grids, {})
+
+    def test_grid_directory(self):
+        class SavedGrid(NZTM2000Grid):
+            grid_directory = self.directory
+            grids = {}
+        class LoadedGrid(SavedGrid):
+            grids = {}
+        phis, lmbs = random_points(1000)
+        Es, Ns = SavedGrid.latlng_to_NZTM_many(phis, lmbs)[:2]
+        self.assertFalse(isinstance(SavedGrid.grids['forward'].coefficients.base, np.memmap))
+        Es_, Ns_ = LoadedGrid.latlng_to_NZTM_many(phis, lmbs)[:2]
+        self.assertTrue(isinstance(LoadedGrid.grids['forward'].coefficients.base, np.memmap))
+        np.testing.assert_array_equal(Es_, Es)
+        np.testing.assert_array_equal(Ns_, Ns)
+
+class KrugerRedfearnTest(unittest.TestCase):
+    def test_forward_difference(self):
+        # series agree to under a millimetre over the NZTM2000 bounds
+        phis, lmbs = random_points()
+        Es, Ns = NZTM2000.latlng_to_NZTM_many(phis, lmbs)[:2]
+        Es_, Ns_ = NZTM2000Kruger.latlng_to_NZTM_many(phis, lmbs)[:2]
+        self.assertLess(np.hypot(Es_ - Es, Ns_ - Ns).max(), 1e-3)
+
+if __name__ == '__main__':
+    unittest.main()
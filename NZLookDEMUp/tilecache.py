@@ -0,0 +1,252 @@
+# coding: utf-8
+
+"""
+TileCache module
+version 1
+Copyright (c) 2014-2016 Tet Woo Lee
+"""
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from google.appengine.api import memcache
+import hashlib
+import logging
+import os
+import threading
+
+class DiskBlockCache:
+    """
+    Size-bounded least-recently-used cache of DEM blocks stored as files in a
+    local directory (e.g. tmpfs or ``/tmp``). Used as a second tier below the
+    in-memory DEM buffers, so data evicted from memory is re-read from local
+    disk rather than fetched again from cloud storage.
+
+    Keys are strings that should identify the DEM file, its generation and the
+    block within it (see ``DEMReader.block_key``), so a changed file is never
+    served from stale blocks. Blocks of old generations are simply never read
+    again and age out of the cache.
+
+    If the directory cannot be created or written to (e.g. on a read-only
+    filesystem such as the dev server sandbox), the cache logs a warning and
+    disables itself; all lookups then miss.
+    """
+
+    def __init__(self, directory, max_size):
+        """
+        Arguments:
+
+            directory : string
+                directory to store cached blocks in, created if missing
+            max_size : int
+                maximum total size of cached blocks in bytes
+
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict() # file name: size, oldest first
+        self.lock = threading.Lock()
+        self.enabled = True
+        try:
+            if not os.path.isdir(directory): os.makedirs(directory)
+            # pick up blocks left by an earlier process, oldest first
+            file_names = [file_name for file_name in os.listdir(directory)
+                          if not file_name.endswith('.tmp')]
+            file_stats = [os.stat(os.path.join(directory, file_name)) for file_name in file_names]
+            for file_stat, file_name in sorted(zip(file_stats, file_names), key=lambda item: item[0].st_atime):
+                self.entries[file_name] = file_stat.st_size
+                self.size += file_stat.st_size
+            self.evict()
+        except (IOError, OSError) as e:
+            self.disable(e)
+
+    def disable(self, error):
+        logging.warning("Disk block cache in %s disabled: %s", self.directory, error)
+        self.enabled = False
+
+    def file_name(self, key):
+        return hashlib.sha1(key).hexdigest()
+
+    def get_multi(self, keys):
+        """
+        Look up several blocks.
+
+        keys : list of strings
+
+        Returns dict of key: data for keys found in the cache.
+
+        """
+        found = {}
+        if not self.enabled: return found
+        for key in keys:
+            file_name = self.file_name(key)
+            with self.lock:
+                if file_name not in self.entries: continue
+                self.entries[file_name] = self.entries.pop(file_name) # mark as most recently used
+            try:
+                with open(os.path.join(self.directory, file_name), 'rb') as block_file:
+                    found[key] = block_file.read()
+            except (IOError, OSError):
+                # evicted by another thread after lookup
+                pass
+        return found
+
+    def set_multi(self, mapping):
+        """
+        Store several blocks, evicting least recently used blocks if cache
+        exceeds ``max_size``.
+
+        mapping : dict of key: data
+
+        """
+        if not self.enabled: return
+        for key, data in mapping.iteritems():
+            file_name = self.file_name(key)
+            file_path = os.path.join(self.directory, file_name)
+            temp_path = '{}.{}.tmp'.format(file_path, threading.current_thread().ident)
+            try:
+                with open(temp_path, 'wb') as block_file:
+                    block_file.write(data)
+                os.rename(temp_path, file_path) # atomic, so readers never see partial blocks
+            except (IOError, OSError) as e:
+                self.disable(e)
+                return
+            with self.lock:
+                self.size += len(data) - self.entries.pop(file_name, 0)
+                self.entries[file_name] = len(data)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used blocks until cache is within ``max_size``.
+        """
+        while True:
+            with self.lock:
+                if self.size <= self.max_size or not self.entries: return
+                file_name, size = self.entries.popitem(last=False)
+                self.size -= size
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except OSError:
+                pass
+
+class MemcacheBlockCache:
+    """
+    Cache of DEM blocks in App Engine memcache, shared by all instances of the
+    application. Used as a tier between instance-local caches and cloud
+    storage, so a new instance can warm its buffers from blocks already 
+    fetched by other instances rather than from cloud storage.
+
+    Memcache may drop blocks at any time, so this is only ever a cache. Blocks
+    must be smaller than the memcache value limit (1 MB).
+    """
+
+    namespace = 'dem_blocks'
+    max_key_length = 250 # memcache key limit, longer keys are hashed
+
+    def __init__(self, time=0):
+        """
+        Arguments:
+
+            time : int
+                expiry time of stored blocks in seconds, 0 for no expiry
+
+        """
+        self.time = time
+
+    def memcache_key(self, key):
+        if len(key) > self.max_key_length: return hashlib.sha1(key).hexdigest()
+        return key
+
+    def get_multi(self, keys):
+        """
+        Look up several blocks.
+
+        keys : list of strings
+
+        Returns dict of key: data for keys found in the cache.
+
+        """
+        if not keys: return {}
+        memcache_keys = dict((self.memcache_key(key), key) for key in keys)
+        found = memcache.get_multi(memcache_keys.keys(), namespace=self.namespace)
+        return dict((memcache_keys[memcache_key], data) for memcache_key, data in found.iteritems())
+
+    def set_multi(self, mapping):
+        """
+        Store several blocks.
+
+        mapping : dict of key: data
+
+        """
+        if not mapping: return
+        memcache.set_multi(dict((self.memcache_key(key), data) for key, data in mapping.iteritems()),
+                           time=self.time, namespace=self.namespace)
+
+class LocalBlockCache:
+    """
+    Size-bounded least-recently-used cache of DEM blocks held in memory, with
+    the same interface as ``MemcacheBlockCache``. Keeps the blocks read by
+    an instance in memory, ahead of its other caches, and stands in for the 
+    shared cache when memcache is not available (e.g. tests and benchmarks), 
+    with all users in one process sharing a single instance.
+    """
+
+    def __init__(self, max_size):
+        """
+        Arguments:
+
+            max_size : int
+                maximum total size of cached blocks in bytes
+
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict() # key: data, oldest first
+        self.lock = threading.Lock()
+
+    def get_multi(self, keys):
+        """
+        Look up several blocks.
+
+        keys : list of strings
+
+        Returns dict of key: data for keys found in the cache.
+
+        """
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    found[key] = self.entries[key] = self.entries.pop(key) # mark as most recently used
+        return found
+
+    def set_multi(self, mapping):
+        """
+        Store several blocks, evicting least recently used blocks if cache
+        exceeds ``max_size``.
+
+        mapping : dict of key: data
+
+        """
+        with self.lock:
+            for key, data in mapping.iteritems():
+                old_data = self.entries.pop(key, None)
+                if old_data is not None: self.size -= len(old_data)
+                self.entries[key] = data
+                self.size += len(data)
+            while self.size > self.max_size and self.entries:
+                key, data = self.entries.popitem(last=False)
+                self.size -= len(data)